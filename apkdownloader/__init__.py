@@ -1,2 +1,17 @@
 from .db import *
-from .googleplay import *
\ No newline at end of file
+from .googleplay import *
+from .wire import *
+from .crawler import *
+from .reviews import *
+from .scheduler import *
+from .mirror import *
+from .store import *
+from .metrics import *
+from .tracing import *
+from .profiling import *
+from .output import *
+from .disk import *
+from .transport import *
+from .singleflight import *
+from .circuit import *
+from .cassette import *
\ No newline at end of file
@@ -6,8 +6,14 @@ import yaml
 import os
 import sys
 import argparse
+import random
+import time
+from collections import OrderedDict
+import requests
+from multiprocessing.pool import ThreadPool
 from colorama import init as colorama_init, Fore
 from clint.textui import progress
+from google.protobuf.message import DecodeError
 if __package__ is None:
     sys.path.insert(
         0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -15,11 +21,68 @@ from apkdownloader import (
     create_db,
     get_access_token,
     get_apks_records,
+    get_apks_updated,
     delete_apks_records,
     update_access_token,
     update_apk_info,
+    update_apk_file,
+    add_transfer,
+    get_throughput,
+    get_delivery,
+    update_delivery,
+    delete_delivery,
+    get_record_writer,
+    plan_records,
+    check_disk_space,
+    DiskSpaceError,
+    start_mirror,
+    BlobStore,
+    crawl_categories,
+    schedule_packages,
+    harvest_reviews,
+    DbReviewSink,
+    GzipReviewSink,
     GooglePlayAPI,
-    ApkInfo,
+    DeadlineError,
+    RequestError,
+    CircuitOpenError,
+    start_metrics_server,
+    write_metrics_file,
+    enable_tracing,
+    trace_span,
+    Profiler,
+)
+from apkdownloader.googleplay_pb2 import AndroidAppDeliveryData
+from apkdownloader.crawler import DEFAULT_CRAWL_WORKERS, DEFAULT_CRAWL_MAX_AGE
+from apkdownloader.scheduler import SCHEDULE_POLICIES, DEFAULT_SCHEDULE_POLICY
+from apkdownloader.mirror import DEFAULT_MIRROR_HOST, DEFAULT_MIRROR_PORT
+from apkdownloader.metrics import (
+    CACHE,
+    DOWNLOAD_BYTES,
+    DOWNLOAD_SECONDS,
+    PACKAGES,
+    RETRIES,
+    UPDATE_SECONDS,
+    DEFAULT_METRICS_HOST,
+)
+from apkdownloader.tracing import TRACE_FORMATS, DEFAULT_TRACE_FORMAT
+from apkdownloader.profiling import DEFAULT_PROFILE_TOP
+from apkdownloader.googleplay import DEFAULT_REQUEST_TIMEOUT
+from apkdownloader.transport import (
+    create_session,
+    warm_up,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_WARM_CONNECTIONS,
+)
+from apkdownloader.disk import (
+    DISK_FULL_POLICIES,
+    DEFAULT_DISK_FULL_POLICY,
+    DEFAULT_DISK_RESERVE,
+)
+from apkdownloader.output import (
+    OUTPUT_FORMATS,
+    OUTPUT_FORMAT_TEXT,
+    DEFAULT_OUTPUT_FORMAT,
 )
 
 logging.basicConfig()
@@ -27,6 +90,15 @@ logger = logging.getLogger('apkdownloader')
 logger.setLevel(logging.INFO)
 
 DOWNLOAD_CHUNK_SIZE = 1024
+DEFAULT_DELIVERY_TTL = 60 * 60
+# the download URL or its cookie of a cached delivery is no longer valid
+DELIVERY_EXPIRED_STATUSES = (403, 410)
+# failures of one package, with --keep-going the others are still updated
+PACKAGE_ERRORS = (
+    requests.RequestException, RequestError, DecodeError, CircuitOpenError)
+DEFAULT_WATCH_INTERVAL = 60 * 60
+DEFAULT_WATCH_JITTER = 0.1
+CONFIG_POLL_INTERVAL = 10
 DEFAULT_CONFIG_FILENAME = "apk.yml"
 DEFAULT_CONFIGS = [
     os.path.expanduser("~/{}".format(DEFAULT_CONFIG_FILENAME)),
@@ -65,7 +137,7 @@ def filter_config_files(*args):
 def read_config(filename):
     try:
         fln = codecs.open(filename, encoding="utf-8")
-        return yaml.load(fln.read())
+        return yaml.safe_load(fln.read())
     except Exception as err:
         logger.error(err)
         return {}
@@ -79,7 +151,8 @@ def meld_configs(result, *options):
             if isinstance(value, (list, tuple)):
                 values = result.get(key, [])
                 values.extend(value)
-                result[key] = list(set((values)))
+                # keep the order, so the requests are the same every run
+                result[key] = list(OrderedDict.fromkeys(values))
             elif isinstance(value, dict):
                 values = result.get(key, {})
                 values.update(value)
@@ -102,14 +175,16 @@ def check_absent_options(options, names):
 
 
 def check_options(options):
-    absent_options = check_absent_options(options, [
+    names = [
         "android_id",
         "email",
         "password",
         "db",
         "directory",
-        "apks",
-    ])
+    ]
+    if not options.get("crawl"):
+        names.append("apks")
+    absent_options = check_absent_options(options, names)
     if absent_options:
         _print_color_line(
             "Absent parameters: {}.\nYou should set them either in the"
@@ -133,20 +208,6 @@ def check_config(filename):
     return filename
 
 
-def get_packages_info(api, apks):
-    apks_info = {}
-    for name in apks:
-        apk_details = api.details(name)
-        doc = apk_details.docV2
-        version_code = doc.details.appDetails.versionCode
-        version_string = doc.details.appDetails.versionString
-        offer_type = doc.offer[0].offerType
-        apk_size = doc.details.appDetails.installationSize
-        apks_info[name] = ApkInfo(
-            name, version_code, version_string, offer_type, apk_size)
-    return apks_info
-
-
 def show_packages_info(new_apks_info, current_apks):
     _print_color_line(
         "{0:<50}{1:<20}{2:<20}{3}".format(
@@ -169,13 +230,44 @@ def show_packages_info(new_apks_info, current_apks):
                 format(apk_info, sizeof_fmt(apk_info.size)), Fore.YELLOW)
 
 
+def write_packages_info(new_apks_info, current_apks, options):
+    """Stream the update plan and the current packages as records."""
+    db = options["db"]
+    plan = schedule_packages(
+        new_apks_info,
+        policy=options.get("schedule", DEFAULT_SCHEDULE_POLICY),
+        priorities=options.get("priorities"),
+        updated=get_apks_updated(db))
+    writer = get_record_writer(options["format"], sys.stdout)
+    try:
+        for record in plan_records(plan, current_apks, get_throughput(db)):
+            writer.write(record)
+    finally:
+        writer.close()
+
+
+def is_package_file(stored_filename, name):
+    """
+    Tell whether stored_filename is an apk of package name, named
+    <name>.<version>.apk. The version must start with a digit, which no
+    part of a package name can, so the apks of com.foo.bar are never taken
+    for those of com.foo.
+    """
+    prefix = name + "."
+    return (stored_filename.startswith(prefix) and
+            stored_filename.endswith(".apk") and
+            stored_filename[len(prefix):len(prefix) + 1].isdigit())
+
+
 def delete_old_package_versions(directory, filenames):
     for root, dirs, files in os.walk(directory):
+        # skip the blob store and other hidden directories
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
         files_to_delete = [
             os.path.join(root, stored_filename) for stored_filename in files
-            for file_prefix, filename in filenames
+            for name, filename in filenames
             if filename != os.path.join(root, stored_filename) and
-            stored_filename.startswith(file_prefix)
+            is_package_file(stored_filename, name)
         ]
         for file_to_delete in files_to_delete:
             try:
@@ -186,38 +278,176 @@ def delete_old_package_versions(directory, filenames):
                     'Cannot delete file {0}: {1}'.format(file_to_delete, ex))
 
 
+def acquire_package(api, db, info, ttl=DEFAULT_DELIVERY_TTL, refresh=False):
+    """
+    Return (delivery data, cached) of the package version. The delivery
+    data is kept in db for ttl seconds, so retried downloads reuse its URL
+    and cookie instead of asking the server again, unless refresh.
+    """
+    if ttl and not refresh:
+        data = get_delivery(db, info.name, info.code, info.offer)
+        CACHE.inc(cache="delivery", result="miss" if data is None else "hit")
+        if data is not None:
+            return AndroidAppDeliveryData.FromString(data), True
+    delivery = api.acquire(info.name, info.code, info.offer)
+    if ttl:
+        update_delivery(
+            db, info.name, info.code, info.offer,
+            delivery.SerializeToString(), time.time() + ttl)
+    return delivery, False
+
+
+def fetch_package(api, db, info, delivery, cached, ttl=DEFAULT_DELIVERY_TTL):
+    """
+    Start the download of the delivery, acquiring the package again when
+    the cached delivery has expired on the server side.
+    """
+    stream = api.fetch(delivery, stream=True)
+    if cached and stream.status_code in DELIVERY_EXPIRED_STATUSES:
+        logger.info("Delivery of {0} has expired, acquire it again".format(
+            info.name))
+        # read the short error body, so the connection is kept alive
+        stream.content
+        stream.close()
+        delete_delivery(db, info.name, info.code, info.offer)
+        RETRIES.inc(operation="acquire")
+        delivery, _ = acquire_package(api, db, info, ttl, refresh=True)
+        stream = api.fetch(delivery, stream=True)
+    stream.raise_for_status()
+    return stream
+
+
+def download_package(api, info, apks_directory, store, show_progress=True,
+                     delivery_ttl=DEFAULT_DELIVERY_TTL):
+    filename = os.path.join(
+        apks_directory, "{0}.{1}.apk".format(info.name, info.version))
+    delivery, cached = acquire_package(api, store.db, info, delivery_ttl)
+    digest = store.find(delivery.downloadSize, delivery.signature)
+    CACHE.inc(cache="blob", result="miss" if digest is None else "hit")
+    seconds = None
+    if digest is not None:
+        _print_color_line(
+            "Apk {0} is already stored, skip downloading".format(info.name),
+            Fore.GREEN)
+        size = delivery.downloadSize
+    else:
+        _print_color_line(
+            "Downloading apk {0} with size {1}...".
+            format(info.name, sizeof_fmt(info.size)), Fore.GREEN)
+        with trace_span("transfer", package=info.name) as span:
+            stream = fetch_package(
+                api, store.db, info, delivery, cached, delivery_ttl)
+            try:
+                chunks = api.within_deadline(
+                    stream.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE))
+                if show_progress:
+                    total_length = int(stream.headers.get('content-length'))
+                    expected_size = total_length / DOWNLOAD_CHUNK_SIZE + 1
+                    chunks = progress.bar(chunks, expected_size=expected_size)
+                start = time.time()
+                digest, size = store.write(
+                    chunks, delivery.signature, delivery.downloadSize)
+                seconds = time.time() - start
+            finally:
+                stream.close()
+            span.set("bytes", size)
+        DOWNLOAD_SECONDS.observe(seconds)
+        DOWNLOAD_BYTES.inc(size)
+    store.link(digest, filename)
+    return filename, size, digest, seconds
+
+
 def download_packages(api, packages_info, options):
+    """
+    Download the packages of packages_info, return the names of the
+    packages which failed with keep_going.
+    """
     db = options["db"]
     dry_run = options["dry_run"]
     directory = options["directory"]
+    workers = options.get("workers", 1)
+    keep_going = options.get("keep_going", False)
+    failed = []
     apks_directory = os.path.normpath(os.path.abspath(directory))
-    packages_names = sorted(packages_info.keys())
-    filenames = []
-    for name in packages_names:
-        info = packages_info[name]
+    store = None if dry_run else BlobStore(apks_directory, db)
+    plan = schedule_packages(
+        packages_info,
+        policy=options.get("schedule", DEFAULT_SCHEDULE_POLICY),
+        priorities=options.get("priorities"),
+        updated=get_apks_updated(db))
+    if not dry_run:
+        plan = check_disk_space(
+            plan, apks_directory,
+            reserve=options.get("reserve", DEFAULT_DISK_RESERVE),
+            policy=options.get("on_disk_full", DEFAULT_DISK_FULL_POLICY))
+
+    def download_planned(info, parent=None):
         _print_color_line(
             "Apk file {0} should be updated to version {1}".
-            format(name, info.version), Fore.RED)
+            format(info.name, info.version), Fore.RED)
+        try:
+            with trace_span("package", parent, package=info.name,
+                            version=info.version, size=info.size):
+                update_package(info)
+        except PACKAGE_ERRORS as err:
+            PACKAGES.inc(result="failed")
+            if not keep_going:
+                raise
+            logger.error("Cannot update {0}: {1}".format(info.name, err))
+            failed.append(info.name)
+            return
+        except Exception:
+            PACKAGES.inc(result="failed")
+            raise
+        PACKAGES.inc(result="updated")
+
+    def update_package(info):
         if not dry_run:
-            _print_color_line(
-                "Downloading apk {0} with size {1}...".
-                format(name, sizeof_fmt(info.size)), Fore.GREEN)
-            stream = api.download(name, info.code, info.offer, stream=True)
-            filename = os.path.join(
-                apks_directory, "{0}.{1}.apk".format(name, info.version))
-            filenames.append(filename)
-            with open(filename, 'wb') as f:
-                total_length = int(stream.headers.get('content-length'))
-                expected_size = total_length / DOWNLOAD_CHUNK_SIZE + 1
-                for chunk in progress.bar(
-                        stream.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
-                        expected_size=expected_size):
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-        delete_old_package_versions(
-            apks_directory, zip(packages_names, filenames))
-        update_apk_info(db, info)
+            filename, size, digest, seconds = download_package(
+                api, info, apks_directory, store,
+                show_progress=workers == 1,
+                delivery_ttl=options.get(
+                    "delivery_ttl", DEFAULT_DELIVERY_TTL))
+            if seconds is not None:
+                add_transfer(db, size, seconds)
+            with trace_span("cleanup", package=info.name):
+                delete_old_package_versions(
+                    apks_directory, [(info.name, filename)])
+            with trace_span("db_update", package=info.name):
+                update_apk_file(
+                    db, info.name, os.path.relpath(filename, apks_directory),
+                    size, digest)
+                update_apk_info(db, info)
+        else:
+            with trace_span("db_update", package=info.name):
+                update_apk_info(db, info)
+
+    with UPDATE_SECONDS.time(), trace_span(
+            "download", packages=len(plan)) as span:
+        if workers > 1:
+            # a free worker takes the next package of the plan, so a large
+            # file holds back only its own worker
+            pool = ThreadPool(workers)
+            try:
+                for _ in pool.imap_unordered(
+                        lambda info: download_planned(info, span), plan):
+                    pass
+            except BaseException:
+                # the packages not started yet are dropped
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        else:
+            for info in plan:
+                download_planned(info)
+    if store is not None:
+        with trace_span("cleanup"):
+            # blobs of the apks replaced after a recreate are unknown
+            store.collect(unknown=options["recreate"])
+    return failed
 
 
 def prepare_parser():
@@ -294,6 +524,269 @@ def prepare_parser():
         type=str,
         help="Apks to download")
 
+    parser.add_argument(
+        "--crawl",
+        required=False,
+        action="store",
+        nargs='+',
+        dest="crawl",
+        type=str,
+        help="Add apks of these Google Play categories (ALL for every one)")
+
+    parser.add_argument(
+        "--crawl-workers",
+        required=False,
+        action="store",
+        dest="crawl_workers",
+        type=int,
+        help="Concurrent requests of the crawler (default {0})".format(
+            DEFAULT_CRAWL_WORKERS))
+
+    parser.add_argument(
+        "--crawl-max-age",
+        required=False,
+        action="store",
+        dest="crawl_max_age",
+        type=int,
+        help="Seconds before crawled pages are fetched again "
+             "(default {0})".format(DEFAULT_CRAWL_MAX_AGE))
+
+    parser.add_argument(
+        "--reviews",
+        required=False,
+        action="store_true",
+        dest="reviews",
+        default=False,
+        help="Harvest reviews of apks into the database instead of "
+             "downloading them")
+
+    parser.add_argument(
+        "--reviews-file",
+        required=False,
+        action="store",
+        dest="reviews_file",
+        type=str,
+        help="Harvest reviews of apks into a gzip compressed JSON lines file "
+             "instead of downloading them")
+
+    parser.add_argument(
+        "--schedule",
+        required=False,
+        action="store",
+        dest="schedule",
+        choices=SCHEDULE_POLICIES,
+        help="Download order, packages listed in the priorities config "
+             "option always go first (default {0})".format(
+                 DEFAULT_SCHEDULE_POLICY))
+
+    parser.add_argument(
+        "--reserve",
+        required=False,
+        action="store",
+        dest="reserve",
+        type=int,
+        help="Bytes to keep free in the download directory "
+             "(default {0})".format(DEFAULT_DISK_RESERVE))
+
+    parser.add_argument(
+        "--on-disk-full",
+        required=False,
+        action="store",
+        dest="on_disk_full",
+        choices=DISK_FULL_POLICIES,
+        help="When the planned apks do not fit, fail before downloading or "
+             "trim the plan to the packages which fit in download order "
+             "(default {0})".format(DEFAULT_DISK_FULL_POLICY))
+
+    parser.add_argument(
+        "--record",
+        required=False,
+        action="store",
+        dest="record",
+        help="Append the anonymized API traffic to a cassette file")
+
+    parser.add_argument(
+        "--replay",
+        required=False,
+        action="store",
+        dest="replay",
+        help="Answer the API requests from a cassette file instead of "
+             "the network")
+
+    parser.add_argument(
+        "--warm-connections",
+        required=False,
+        action="store",
+        dest="warm_connections",
+        type=int,
+        help="Connections to the API opened while the database is loading, "
+             "and to a download host once the first delivery points to it "
+             "(default the number of workers, at least {0})".format(
+                 DEFAULT_WARM_CONNECTIONS))
+
+    parser.add_argument(
+        "--timeout",
+        required=False,
+        action="store",
+        dest="timeout",
+        type=float,
+        help="Seconds an API request may take, the timeouts of single "
+             "endpoints can be set in the config file as a timeouts "
+             "mapping (default {0})".format(DEFAULT_REQUEST_TIMEOUT))
+
+    parser.add_argument(
+        "--deadline",
+        required=False,
+        action="store",
+        dest="deadline",
+        type=float,
+        help="Seconds a run (or a watch cycle) may take, requests started "
+             "later fail (default no deadline)")
+
+    parser.add_argument(
+        "--hedge",
+        required=False,
+        action="store_true",
+        dest="hedge",
+        default=None,
+        help="Send a duplicate of the details, bulkDetails, search and "
+             "list requests slower than the p95 latency, the first answer "
+             "wins (default False)")
+
+    parser.add_argument(
+        "--delivery-ttl",
+        required=False,
+        action="store",
+        dest="delivery_ttl",
+        type=int,
+        help="Seconds to reuse the download URL of a package for retried "
+             "downloads, 0 to ask the server every time "
+             "(default {0})".format(DEFAULT_DELIVERY_TTL))
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        action="store",
+        dest="workers",
+        type=int,
+        help="Parallel downloads (default 1)")
+
+    parser.add_argument(
+        "--watch",
+        required=False,
+        action="store_true",
+        dest="watch",
+        default=False,
+        help="Keep running and check apks for updates periodically")
+
+    parser.add_argument(
+        "--interval",
+        required=False,
+        action="store",
+        dest="interval",
+        type=int,
+        help="Seconds between checks of a package in the watch mode "
+             "(default {0})".format(DEFAULT_WATCH_INTERVAL))
+
+    parser.add_argument(
+        "--jitter",
+        required=False,
+        action="store",
+        dest="jitter",
+        type=float,
+        help="Random spread of the check interval as a fraction of it "
+             "(default {0})".format(DEFAULT_WATCH_JITTER))
+
+    parser.add_argument(
+        "--mirror",
+        required=False,
+        action="store_true",
+        dest="mirror",
+        default=False,
+        help="Serve the downloaded apks over HTTP with an index at "
+             "/index.json, in the background of the watch mode")
+
+    parser.add_argument(
+        "--mirror-host",
+        required=False,
+        action="store",
+        dest="mirror_host",
+        type=str,
+        help="Mirror server address (default {0})".format(
+            DEFAULT_MIRROR_HOST))
+
+    parser.add_argument(
+        "--mirror-port",
+        required=False,
+        action="store",
+        dest="mirror_port",
+        type=int,
+        help="Mirror server port (default {0})".format(DEFAULT_MIRROR_PORT))
+
+    parser.add_argument(
+        "--metrics-port",
+        required=False,
+        action="store",
+        dest="metrics_port",
+        type=int,
+        help="Serve Prometheus metrics at /metrics on this port")
+
+    parser.add_argument(
+        "--metrics-file",
+        required=False,
+        action="store",
+        dest="metrics_file",
+        type=str,
+        help="Write Prometheus metrics to this file after every run, "
+             "for the node_exporter textfile collector")
+
+    parser.add_argument(
+        "--trace",
+        required=False,
+        action="store",
+        dest="trace",
+        type=str,
+        help="Write timing spans of the run phases to this file when the "
+             "run ends")
+
+    parser.add_argument(
+        "--trace-format",
+        required=False,
+        action="store",
+        dest="trace_format",
+        choices=TRACE_FORMATS,
+        help="Trace file format, OpenTelemetry JSON or Chrome trace events "
+             "for chrome://tracing and Perfetto (default {0})".format(
+                 DEFAULT_TRACE_FORMAT))
+
+    parser.add_argument(
+        "--profile",
+        required=False,
+        action="store",
+        dest="profile",
+        type=str,
+        help="Profile the run and write PROFILE.pstats, PROFILE.alloc.txt "
+             "with the top allocations of every phase and, with a sampler, "
+             "PROFILE.collapsed stacks")
+
+    parser.add_argument(
+        "--profile-sampler",
+        required=False,
+        action="store",
+        dest="profile_sampler",
+        type=str,
+        help="Stack sampler of the profile, thread or a module:Class path")
+
+    parser.add_argument(
+        "--profile-top",
+        required=False,
+        action="store",
+        dest="profile_top",
+        type=int,
+        help="Allocation lines by phase in the profile report "
+             "(default {0})".format(DEFAULT_PROFILE_TOP))
+
     parser.add_argument(
         "-f",
         "--force",
@@ -320,6 +813,15 @@ def prepare_parser():
         default=False,
         help="Do not download apk packages")
 
+    parser.add_argument(
+        "--keep-going",
+        required=False,
+        action="store_true",
+        dest="keep_going",
+        default=False,
+        help="Go on with the other packages when one fails to download, "
+             "exit with 1 at the end")
+
     parser.add_argument(
         "-s",
         "--info",
@@ -329,64 +831,327 @@ def prepare_parser():
         default=False,
         help="Show info about packages")
 
+    parser.add_argument(
+        "--format",
+        required=False,
+        action="store",
+        dest="format",
+        choices=OUTPUT_FORMATS,
+        help="Output format of --info, json, ndjson and csv print one "
+             "record a package in download order with the code delta and "
+             "the transfer time estimated from the past downloads "
+             "(default {0})".format(DEFAULT_OUTPUT_FORMAT))
+
     return parser
 
 
-def main():
-    parser = prepare_parser()
-    args_options = {
-        k: v for k, v in vars(parser.parse_args()).items() if v is not None
-    }
+def get_config_files(args_options):
     allowed_configs = DEFAULT_CONFIGS + [args_options.get("config")]
-    config_files = list(filter_config_files(*allowed_configs))
+    return list(filter_config_files(*allowed_configs))
+
+
+def read_options(args_options):
+    config_files = get_config_files(args_options)
     options = read_configs(*config_files)
     options.update(args_options)
-    if not check_options(options):
-        parser.print_help()
-        return
-    if not os.path.isdir(options["directory"]):
-        logger.error("Direcory {} is not exists.".format(options["directory"]))
-        parser.print_help()
-        return
+    return options, config_files
+
+
+def get_files_state(filenames):
+    state = []
+    for filename in filenames:
+        try:
+            state.append((filename, os.path.getmtime(filename)))
+        except OSError:
+            state.append((filename, None))
+    return state
+
+
+def get_pool_size(options):
+    return max(
+        options.get("workers", 1),
+        options.get("crawl_workers", DEFAULT_CRAWL_WORKERS),
+        DEFAULT_POOL_SIZE)
+
+
+def get_warm_connections(options):
+    return options.get("warm_connections", max(
+        options.get("workers", 1), DEFAULT_WARM_CONNECTIONS))
+
+
+def create_api(options, session=None):
+    params = {
+        "androidId": options["android_id"],
+        "email": options["email"],
+        "password": options["password"],
+        "auth_sub_token": get_access_token(options["db"]),
+        "url_login": options.get("url_login"),
+        "url_api": options.get("url_api"),
+        "timeout": options.get("timeout"),
+        "timeouts": options.get("timeouts"),
+        "deadline": options.get("deadline"),
+        "hedge": options.get("hedge", False),
+        "session": session,
+        "record": options.get("record"),
+        "replay": options.get("replay"),
+        "pool_size": get_pool_size(options),
+        "warm_connections": get_warm_connections(options),
+        "debug": True
+    }
+    return GooglePlayAPI(**params)
+
+
+def get_apks(api, options):
+    apks = options.get("apks", [])
+    if options.get("crawl"):
+        crawled_apks = crawl_categories(
+            api, options["db"], options["crawl"],
+            workers=options.get("crawl_workers", DEFAULT_CRAWL_WORKERS),
+            max_age=options.get("crawl_max_age", DEFAULT_CRAWL_MAX_AGE))
+        apks = sorted(set(apks) | crawled_apks)
+    return apks
+
+
+def update_packages(api, options, apks, checked_apks=None):
+    """
+    Drop the records of packages which are not in apks anymore, then look
+    up checked_apks (all apks by default) and download the new versions.
+    Returns the names of the packages which failed with keep_going.
+    """
     db = options["db"]
     force = options["force"]
-    recreate = options["recreate"]
-    create_db(db, recreate)
-    access_token = get_access_token(db)
+    if checked_apks is None:
+        checked_apks = apks
     current_apks = get_apks_records(db)
-    apks = options["apks"]
     outdated_packages = set(current_apks) - set(apks)
     if outdated_packages:
         delete_apks_records(db, tuple(outdated_packages))
         current_apks = get_apks_records(db)
-    params = {
-        "androidId": options["android_id"],
-        "email": options["email"],
-        "password": options["password"],
-        "auth_sub_token": access_token,
-        "debug": True
-    }
-    api = GooglePlayAPI(**params)
-    apks_details = api.bulkDetails(apks)
+        if not options["dry_run"]:
+            BlobStore(options["directory"], db).collect()
+    apks_details = api.bulkDetailsInfo(checked_apks)
     update_access_token(db, api.get_token())
     apks_data = {
-        name: m.doc.details.appDetails.versionCode
-        for name, m in zip(apks, apks_details.entry)
+        name: info
+        for name, info in zip(checked_apks, apks_details) if info
     }
-    new_apks = [
-        name
-        for name, ver in apks_data.items()
-        if force or (name not in current_apks or current_apks[name].code < ver)
-    ]
-    colorama_init()
-    new_apks_info = get_packages_info(api, new_apks)
+    missing_apks = [name for name in checked_apks if name not in apks_data]
+    if missing_apks:
+        logger.error("Cannot find packages: {0}".format(
+            ", ".join(sorted(missing_apks))))
+        PACKAGES.inc(len(missing_apks), result="missing")
+    new_apks_info = {
+        name: info
+        for name, info in apks_data.items()
+        if force or (
+            name not in current_apks or current_apks[name].code < info.code)
+    }
+    PACKAGES.inc(len(apks_data) - len(new_apks_info), result="skipped")
     if options["info"]:
-        show_packages_info(new_apks_info, current_apks)
-        return
+        if options.get("format", DEFAULT_OUTPUT_FORMAT) == OUTPUT_FORMAT_TEXT:
+            show_packages_info(new_apks_info, current_apks)
+        else:
+            write_packages_info(new_apks_info, current_apks, options)
+        return []
     if not new_apks_info:
         _print_color_line("There are no new apk packages to update", Fore.RED)
+        return []
+    return download_packages(api, new_apks_info, options)
+
+
+def next_check_time(options):
+    interval = options.get("interval", DEFAULT_WATCH_INTERVAL)
+    jitter = options.get("jitter", DEFAULT_WATCH_JITTER)
+    return time.time() + interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+def watch(api, options, args_options, config_files):
+    """
+    Keep checking apks until interrupted. Every package is checked on its own
+    jittered interval, the config files are re-read when they change.
+    Categories are crawled again on config reload or after crawl_max_age.
+    A client created for new credentials shares the session of api, which
+    the caller closes.
+    """
+    config_state = get_files_state(config_files)
+    apks = get_apks(api, options)
+    crawled = time.time()
+    next_checks = {}
+    while True:
+        new_config_state = get_files_state(get_config_files(args_options))
+        if new_config_state != config_state:
+            config_state = new_config_state
+            new_options, new_config_files = read_options(args_options)
+            if check_options(new_options):
+                logger.info("Reloaded config from {0}".format(
+                    ", ".join(new_config_files)))
+                if any(new_options.get(name) != options.get(name)
+                       for name in ("android_id", "email", "password")):
+                    api = create_api(new_options, api.session)
+                if new_options["db"] != options["db"]:
+                    create_db(new_options["db"])
+                options = new_options
+                apks = get_apks(api, options)
+                crawled = time.time()
+        now = time.time()
+        next_checks = dict(
+            (name, next_checks.get(name, now)) for name in apks)
+        due_apks = [name for name in apks if next_checks[name] <= now]
+        if due_apks:
+            api.set_deadline(options.get("deadline"))
+            try:
+                if options.get("crawl") and time.time() - crawled >= \
+                        options.get("crawl_max_age", DEFAULT_CRAWL_MAX_AGE):
+                    apks = get_apks(api, options)
+                    crawled = time.time()
+                update_packages(api, options, apks, due_apks)
+            except Exception as err:
+                logger.error("Cannot update packages: {0}".format(err))
+            for name in due_apks:
+                next_checks[name] = next_check_time(options)
+            save_metrics(options)
+        wakeup = min(next_checks.values()) if next_checks else None
+        timeout = CONFIG_POLL_INTERVAL
+        if wakeup is not None:
+            timeout = min(timeout, max(0, wakeup - time.time()))
+        time.sleep(timeout)
+
+
+def log_breaker_stats(api):
+    for name, breaker in sorted(api.breakers.items()):
+        stats = breaker.stats()
+        if stats["trips"]:
+            logger.error(
+                "Circuit of {0} tripped {1} times and failed {2} requests "
+                "fast, last error: {3}".format(
+                    name, stats["trips"], stats["rejected"],
+                    stats["last_error"]))
+
+
+def save_metrics(options):
+    if options.get("metrics_file"):
+        try:
+            write_metrics_file(options["metrics_file"])
+        except (OSError, IOError) as err:
+            logger.error("Cannot write metrics: {0}".format(err))
+
+
+def main():
+    parser = prepare_parser()
+    args_options = {
+        k: v for k, v in vars(parser.parse_args()).items() if v is not None
+    }
+    if not args_options.get("trace") and not args_options.get("profile"):
+        run(parser, args_options)
         return
-    download_packages(api, new_apks_info, options)
+    tracer = enable_tracing()
+    profiler = None
+    if args_options.get("profile"):
+        profiler = Profiler(
+            args_options["profile"],
+            sampler=args_options.get("profile_sampler"),
+            top=args_options.get("profile_top", DEFAULT_PROFILE_TOP))
+        tracer.add_hook(profiler)
+        profiler.start()
+    try:
+        with trace_span("run"):
+            run(parser, args_options)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            tracer.remove_hook(profiler)
+            try:
+                logger.info("Saved profile to {0}".format(
+                    ", ".join(profiler.save())))
+            except (OSError, IOError) as err:
+                logger.error("Cannot write profile: {0}".format(err))
+        if args_options.get("trace"):
+            try:
+                tracer.export(
+                    args_options["trace"],
+                    args_options.get("trace_format", DEFAULT_TRACE_FORMAT))
+            except (OSError, IOError) as err:
+                logger.error("Cannot write trace: {0}".format(err))
+
+
+def run(parser, args_options):
+    with trace_span("config"):
+        options, config_files = read_options(args_options)
+    if not check_options(options):
+        parser.print_help()
+        return
+    if not os.path.isdir(options["directory"]):
+        logger.error("Direcory {} is not exists.".format(options["directory"]))
+        parser.print_help()
+        return
+    session = None
+    if not options.get("replay") and (
+            options["watch"] or not options["mirror"]):
+        # handshakes of the first connections overlap with the database
+        session = create_session(get_pool_size(options))
+        warm_up(
+            session, [options.get("url_api") or GooglePlayAPI.URL_API],
+            get_warm_connections(options))
+    db = options["db"]
+    with trace_span("db_open"):
+        create_db(db, options["recreate"])
+    if options["recreate"] and not options["dry_run"]:
+        # the blobs of the dropped database are unknown to the new one
+        BlobStore(options["directory"], db).collect(unknown=True)
+    colorama_init()
+    if options.get("metrics_port"):
+        start_metrics_server(
+            options["metrics_port"],
+            host=options.get("metrics_host", DEFAULT_METRICS_HOST))
+    if options["mirror"]:
+        try:
+            start_mirror(
+                options["directory"], db,
+                host=options.get("mirror_host", DEFAULT_MIRROR_HOST),
+                port=options.get("mirror_port", DEFAULT_MIRROR_PORT),
+                background=options["watch"])
+        except KeyboardInterrupt:
+            return
+        if not options["watch"]:
+            return
+    api = create_api(options, session)
+    try:
+        run_api(api, options, args_options, config_files)
+    finally:
+        api.close()
+
+
+def run_api(api, options, args_options, config_files):
+    db = options["db"]
+    if options["watch"]:
+        try:
+            watch(api, options, args_options, config_files)
+        except KeyboardInterrupt:
+            pass
+        return
+    apks = get_apks(api, options)
+    if options["reviews"] or options.get("reviews_file"):
+        if options.get("reviews_file"):
+            sink = GzipReviewSink(options["reviews_file"])
+        else:
+            sink = DbReviewSink(db)
+        harvest_reviews(api, apks, sink)
+        update_access_token(db, api.get_token())
+        save_metrics(options)
+        return
+    try:
+        failed = update_packages(api, options, apks)
+        if failed:
+            logger.error("Cannot update packages: {0}".format(
+                ", ".join(sorted(failed))))
+            sys.exit(1)
+    except (DiskSpaceError, DeadlineError, CircuitOpenError,
+            RequestError) as err:
+        logger.error("Cannot update packages: {0}".format(err))
+        sys.exit(1)
+    finally:
+        save_metrics(options)
+        log_breaker_stats(api)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+"""
+Record and replay of the HTTP traffic of GooglePlayAPI.
+
+RecordingAdapter sits in front of the transport of a session and appends
+every exchange to a cassette, a gzip compressed file with one JSON object
+a line: method, path and query, a hash of the request body, status, a few
+response headers and the response body. Bodies of streamed responses (apk
+downloads) are not kept, only their size. ReplayAdapter answers the
+requests from a cassette without any network, downloads get synthetic
+bodies of the recorded size.
+
+Cassettes are anonymized: request headers are never stored, the auth token
+is replaced, the download URLs and cookies in delivery data are rewritten,
+and so are the URLs of the requests to other hosts than the API and the
+login (downloads and their redirects), so cassettes of real accounts can
+be shared.
+
+    api = GooglePlayAPI(..., record="run.cassette.gz")
+    api = GooglePlayAPI(..., replay="run.cassette.gz")
+"""
+from __future__ import absolute_import
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import re
+import threading
+import requests
+try:
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    from urlparse import urljoin, urlsplit
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from google.protobuf.message import DecodeError
+from . import googleplay_pb2
+
+__all__ = (
+    'RecordingAdapter',
+    'ReplayAdapter',
+    'read_cassette',
+    'record_session',
+    'replay_session',
+)
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_HEADERS = (
+    "Content-Type", "Content-Length", "Content-Range", "Accept-Ranges")
+ANONYMOUS_TOKEN = "anonymized"
+ANONYMOUS_HOST = "https://cdn.invalid"
+AUTH_TOKEN_RE = re.compile(br"^(Auth|SID|LSID)=.*$", re.MULTILINE)
+REPLAY_BLOCK_SIZE = 64 * 1024
+
+
+def request_key(method, url, body):
+    """Return the (method, path and query, body hash) of a request."""
+    parts = urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    if body is not None and not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    return method, path, hashlib.sha1(body).hexdigest() if body else None
+
+
+def anonymous_url(url):
+    """Return a URL standing for url which tells nothing about it."""
+    return "{0}/{1}".format(
+        ANONYMOUS_HOST, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+
+def anonymize_delivery(delivery):
+    delivery.downloadUrl = anonymous_url(delivery.downloadUrl)
+    for cookie in delivery.downloadAuthCookie:
+        cookie.value = ANONYMOUS_TOKEN
+
+
+def anonymize_content(content):
+    """
+    Return (content, download URLs) of a response, with the auth tokens
+    and the download URLs and cookies of delivery data replaced.
+    """
+    if content.startswith((b"SID=", b"Auth=")):
+        return AUTH_TOKEN_RE.sub(
+            lambda match: match.group(1) + b"=" + ANONYMOUS_TOKEN.encode(
+                "ascii"), content), []
+    try:
+        message = googleplay_pb2.ResponseWrapper.FromString(content)
+    except (DecodeError, ValueError):
+        return content, []
+    payload = message.payload
+    deliveries = []
+    if payload.HasField("buyResponse"):
+        deliveries.append(
+            payload.buyResponse.purchaseStatusResponse.appDeliveryData)
+    if payload.HasField("deliveryResponse"):
+        deliveries.append(payload.deliveryResponse.appDeliveryData)
+    deliveries = [delivery for delivery in deliveries if delivery.downloadUrl]
+    if not deliveries:
+        return content, []
+    urls = []
+    for delivery in deliveries:
+        urls.append(delivery.downloadUrl)
+        anonymize_delivery(delivery)
+    return message.SerializeToString(), urls
+
+
+def read_cassette(filename):
+    """Yield the records of a cassette."""
+    with gzip.open(filename, "rb") as f:
+        for line in f:
+            record = json.loads(line.decode("utf-8"))
+            if record["content"] is not None:
+                record["content"] = base64.b64decode(record["content"])
+            yield record
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Transport adapter passing the requests to adapter and appending the
+    exchanges to the cassette filename. hosts are the host[:port] of the
+    API and the login, the URLs of the requests to any other host are
+    anonymized, as well as the download URLs of delivery data.
+    """
+
+    def __init__(self, adapter, filename, anonymize=True, hosts=None):
+        super(RecordingAdapter, self).__init__()
+        self.adapter = adapter
+        self.anonymize = anonymize
+        self.hosts = hosts
+        self.file = gzip.open(filename, "ab")
+        self.lock = threading.Lock()
+        self.records = 0
+        # download URLs of the recorded delivery data
+        self.downloads = set()
+
+    def send(self, request, stream=False, **kwargs):
+        response = self.adapter.send(request, stream=stream, **kwargs)
+        url = request.url
+        body = request.body
+        if self.anonymize:
+            if urlsplit(url).path.rstrip("/").endswith("/auth"):
+                # the login request carries the password
+                body = None
+            url = self.anonymous_url(url)
+        key = request_key(request.method, url, body)
+        record = {
+            "method": key[0],
+            "path": key[1],
+            "body": key[2],
+            "status": response.status_code,
+            "headers": dict(
+                (name, response.headers[name]) for name in CASSETTE_HEADERS
+                if name in response.headers),
+            "content": None,
+        }
+        location = response.headers.get("Location")
+        if location:
+            # redirects are replayed to the anonymized URL of the target
+            location = urljoin(request.url, location)
+            if self.anonymize:
+                location = self.anonymous_url(location)
+            record["headers"]["Location"] = location
+        if not stream:
+            content = response.content
+            if self.anonymize:
+                content, urls = anonymize_content(content)
+                with self.lock:
+                    self.downloads.update(urls)
+            record["content"] = base64.b64encode(content).decode("ascii")
+        line = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+        with self.lock:
+            self.file.write(line)
+            self.records += 1
+        return response
+
+    def anonymous_url(self, url):
+        """Return the URL recorded for url."""
+        if self.hosts is not None and urlsplit(url).netloc not in self.hosts:
+            return anonymous_url(url)
+        with self.lock:
+            if url in self.downloads:
+                return anonymous_url(url)
+        return url
+
+    def close(self):
+        self.adapter.close()
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+                logger.info("Recorded {0} requests".format(self.records))
+
+
+class ReplayRaw(io.RawIOBase):
+    """Synthetic body of a replayed download, the same for the same path."""
+
+    def __init__(self, path, size):
+        super(ReplayRaw, self).__init__()
+        seed = hashlib.sha256(path.encode("utf-8")).digest()
+        self.block = seed * (REPLAY_BLOCK_SIZE // len(seed))
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.size - self.position)
+        offset = self.position % len(self.block)
+        count = min(count, len(self.block) - offset)
+        buffer[:count] = self.block[offset:offset + count]
+        self.position += count
+        return count
+
+    def stream(self, amt=REPLAY_BLOCK_SIZE, decode_content=True):
+        while True:
+            data = self.read(amt)
+            if not data:
+                break
+            yield data
+
+    def release_conn(self):
+        pass
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter answering the requests from a cassette. Identical
+    requests get the recorded answers in order, the last one once they are
+    used up. Unknown requests raise requests.ConnectionError.
+    """
+
+    def __init__(self, filename):
+        super(ReplayAdapter, self).__init__()
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.served = {}
+        for record in read_cassette(filename):
+            key = (record["method"], record["path"], record["body"])
+            self.responses.setdefault(key, []).append(record)
+
+    def find(self, request):
+        key = request_key(request.method, request.url, request.body)
+        records = self.responses.get(key)
+        if records is None:
+            # login requests are recorded without their body
+            key = key[:2] + (None,)
+            records = self.responses.get(key)
+        if records is None:
+            return None
+        with self.lock:
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+        return records[min(index, len(records) - 1)]
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        record = self.find(request)
+        if record is None:
+            raise requests.ConnectionError(
+                "No recorded response for {0} {1}".format(
+                    request.method, request.url), request=request)
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.headers = CaseInsensitiveDict(record["headers"])
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        if record["content"] is not None:
+            response.raw = io.BytesIO(record["content"])
+        else:
+            response.raw = ReplayRaw(
+                record["path"],
+                int(record["headers"].get("Content-Length") or 0))
+        if not stream:
+            response.content
+        return response
+
+    def close(self):
+        pass
+
+
+def record_session(session, filename, anonymize=True, urls=None):
+    """
+    Record the traffic of all the transports of session to filename. urls
+    are of the API and the login, requests to other hosts are anonymized.
+    """
+    hosts = None
+    if urls is not None:
+        hosts = set(urlsplit(url).netloc for url in urls)
+    recorders = {}
+    for prefix, adapter in list(session.adapters.items()):
+        recorder = recorders.get(id(adapter))
+        if recorder is None:
+            recorder = recorders[id(adapter)] = RecordingAdapter(
+                adapter, filename, anonymize, hosts)
+        session.mount(prefix, recorder)
+
+
+def replay_session(session, filename):
+    """Answer all the requests of session from the cassette filename."""
+    adapter = ReplayAdapter(filename)
+    for prefix in list(session.adapters):
+        session.mount(prefix, adapter)
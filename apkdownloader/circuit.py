@@ -0,0 +1,109 @@
+"""
+Circuit breakers of the remote services.
+
+A breaker counts the failures in a row of the requests to one service
+(connection errors, timeouts, 429 and 5xx answers). After threshold of
+them it opens: the next requests fail at once with CircuitOpenError
+instead of reaching the broken service. After reset_timeout seconds one
+request is let through as a probe (half open), its success closes the
+breaker again, its failure keeps it open for another reset_timeout.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+import time
+from .metrics import BREAKER_REJECTED, BREAKER_TRIPS
+
+__all__ = (
+    'CircuitBreaker',
+    'CircuitOpenError',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30.0
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, threshold=DEFAULT_BREAKER_THRESHOLD,
+                 reset_timeout=DEFAULT_BREAKER_RESET, clock=time.time):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+        self.last_error = None
+
+    def before(self):
+        """Raise CircuitOpenError unless a request may be sent now."""
+        with self.lock:
+            if self.state == STATE_OPEN and \
+                    self.clock() - self.opened >= self.reset_timeout:
+                self.state = STATE_HALF_OPEN
+            if self.state == STATE_CLOSED or (
+                    self.state == STATE_HALF_OPEN and not self.probing):
+                self.probing = self.state == STATE_HALF_OPEN
+                return
+            self.rejected += 1
+        BREAKER_REJECTED.inc(breaker=self.name)
+        raise CircuitOpenError(
+            "Circuit of {0} is open after: {1}".format(
+                self.name, self.last_error))
+
+    def success(self):
+        with self.lock:
+            if self.state != STATE_CLOSED:
+                logger.info("Circuit of {0} is closed".format(self.name))
+            self.state = STATE_CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.last_error = error
+            self.probing = False
+            if self.state == STATE_OPEN or (
+                    self.state == STATE_CLOSED and
+                    self.failures < self.threshold):
+                return
+            self.state = STATE_OPEN
+            self.opened = self.clock()
+            self.trips += 1
+        BREAKER_TRIPS.inc(breaker=self.name)
+        logger.warning("Circuit of {0} is open for {1} seconds: {2}".format(
+            self.name, self.reset_timeout, error))
+
+    def release(self):
+        """Forget a request which neither succeeded nor failed."""
+        with self.lock:
+            self.probing = False
+
+    def stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,140 @@
+"""
+Category crawler built on browse() and list().
+
+Every (category, subcategory) listing is walked page by page in a bounded
+thread pool. Pages are checkpointed into the crawl_page table with a digest
+of their raw bytes, so an interrupted crawl resumes where it stopped and a
+re-crawl skips listings whose first page did not change.
+"""
+from __future__ import absolute_import
+import hashlib
+import logging
+from multiprocessing.pool import ThreadPool
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+import requests
+from .db import (
+    get_crawl_pages,
+    update_crawl_page,
+    touch_crawl_pages,
+    CrawlPage,
+)
+from .metrics import CACHE
+from .wire import scan_container_docs, LIST_DOC_PATH
+
+__all__ = (
+    'crawl_categories',
+    'ALL_CATEGORIES',
+)
+
+logger = logging.getLogger(__name__)
+
+ALL_CATEGORIES = "ALL"
+DEFAULT_CRAWL_WORKERS = 4
+DEFAULT_CRAWL_MAX_AGE = 24 * 60 * 60
+
+
+def get_categories(api):
+    categories = []
+    for link in api.browse().category:
+        query = parse_qs(urlparse(link.dataUrl).query)
+        if "cat" in query:
+            categories.append(query["cat"][0])
+    return categories
+
+
+def get_subcategories(api, category):
+    return [
+        (category, doc.docid) for doc in api.list(category).doc if doc.docid
+    ]
+
+
+def listing_path(category, subcategory):
+    return "list?c=3&cat=%s&ctr=%s" % (
+        requests.utils.quote(category), requests.utils.quote(subcategory))
+
+
+def crawl_listing(api, db, listing, max_age=DEFAULT_CRAWL_MAX_AGE):
+    """
+    Return the docids of a listing, following its next page links.
+    Pages checkpointed less than max_age seconds ago are not fetched again.
+    When the first page is fetched and its digest did not change, the rest
+    of the checkpointed pages are reused as they are.
+    """
+    pages = get_crawl_pages(db, listing)
+    docids = []
+    reuse = False
+    visited = set()
+    path = listing
+    while path and path not in visited:
+        visited.add(path)
+        page = pages.get(path)
+        if page is not None and (reuse or page.age < max_age):
+            CACHE.inc(cache="crawl_page", result="hit")
+            docids.extend(page.docids)
+            path = page.next_path
+            continue
+        CACHE.inc(cache="crawl_page", result="miss")
+        data = api.executeRequestRaw(path)
+        digest = hashlib.sha1(data).hexdigest()
+        records, next_path = scan_container_docs(data, LIST_DOC_PATH)
+        fetched = CrawlPage(
+            path, listing, digest, [record.name for record in records],
+            next_path, 0)
+        if page is None or page.digest != digest:
+            update_crawl_page(db, fetched)
+        elif path == listing:
+            touch_crawl_pages(db, list(pages))
+            reuse = True
+        else:
+            touch_crawl_pages(db, [path])
+        docids.extend(fetched.docids)
+        path = next_path
+    return docids
+
+
+def _crawl_listing_safe(api, db, listing, max_age):
+    try:
+        return crawl_listing(api, db, listing, max_age)
+    except Exception as err:
+        logger.error("Cannot crawl {0}: {1}".format(listing, err))
+        pages = get_crawl_pages(db, listing)
+        return [docid for page in pages.values() for docid in page.docids]
+
+
+def crawl_categories(api, db, categories=None,
+                     workers=DEFAULT_CRAWL_WORKERS,
+                     max_age=DEFAULT_CRAWL_MAX_AGE):
+    """
+    Crawl every subcategory of categories (all of them when categories is
+    empty or contains ALL_CATEGORIES) with at most workers requests in
+    flight. Returns the set of found package names. A listing that fails
+    falls back to its last checkpoint.
+    """
+    if not categories or ALL_CATEGORIES in categories:
+        categories = get_categories(api)
+    # login once before the first requests of the pool run concurrently
+    api.ensure_token()
+    pool = ThreadPool(workers)
+    try:
+        listings = [
+            listing_path(category, subcategory)
+            for subcategories in pool.imap_unordered(
+                lambda category: get_subcategories(api, category),
+                categories)
+            for category, subcategory in subcategories
+        ]
+        packages = set()
+        for docids in pool.imap_unordered(
+                lambda listing: _crawl_listing_safe(
+                    api, db, listing, max_age),
+                listings):
+            packages.update(docids)
+    finally:
+        pool.close()
+        pool.join()
+    logger.info("Crawled {0} packages in {1} listings".format(
+        len(packages), len(listings)))
+    return packages
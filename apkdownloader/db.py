@@ -1,22 +1,62 @@
 import os
 import sqlite3
+import threading
+import time
 from collections import namedtuple
+from .metrics import DB_COMMIT_SECONDS
 
 __all__ = (
     'create_db',
     'get_access_token',
     'get_apks_records',
+    'get_apks_updated',
     'delete_apks_records',
     'update_access_token',
     'update_apk_info',
+    'get_crawl_pages',
+    'update_crawl_page',
+    'touch_crawl_pages',
+    'insert_reviews',
+    'get_apks_files',
+    'update_apk_file',
+    'get_blob',
+    'add_blob',
+    'get_unreferenced_blobs',
+    'get_blobs',
+    'delete_blob',
+    'add_transfer',
+    'get_throughput',
+    'get_delivery',
+    'update_delivery',
+    'delete_delivery',
     'ApkInfo',
+    'ApkFile',
+    'CrawlPage',
+    'ReviewInfo',
 )
 
 
 DB_APK_TABLE_NAME = "apk"
 DB_APK_TRIGGER_NAME = "apk_trig"
 DB_TOKEN_TABLE_NAME = "token"
-DB_TABLES = [DB_APK_TABLE_NAME, DB_TOKEN_TABLE_NAME, DB_APK_TRIGGER_NAME]
+DB_CRAWL_TABLE_NAME = "crawl_page"
+DB_REVIEW_TABLE_NAME = "review"
+DB_FILE_TABLE_NAME = "apk_file"
+DB_BLOB_TABLE_NAME = "blob"
+DB_TRANSFER_TABLE_NAME = "transfer"
+DB_TRANSFER_HISTORY = 1000
+DB_DELIVERY_TABLE_NAME = "delivery"
+DB_TABLES = [
+    DB_APK_TABLE_NAME,
+    DB_TOKEN_TABLE_NAME,
+    DB_APK_TRIGGER_NAME,
+    DB_CRAWL_TABLE_NAME,
+    DB_REVIEW_TABLE_NAME,
+    DB_FILE_TABLE_NAME,
+    DB_BLOB_TABLE_NAME,
+    DB_TRANSFER_TABLE_NAME,
+    DB_DELIVERY_TABLE_NAME,
+]
 DB_APK_TABLE_SQL = """
 create table {0} (
     name text not null,
@@ -39,12 +79,137 @@ create table {0} (
     token text not null
 );
 """.format(DB_TOKEN_TABLE_NAME)
+DB_CRAWL_TABLE_SQL = """
+create table {0} (
+    path text not null,
+    listing text not null,
+    digest text not null,
+    docids text not null,
+    next_path text,
+    updated datetime not null default current_timestamp,
+    unique(path) on conflict replace
+);
+""".format(DB_CRAWL_TABLE_NAME)
+DB_REVIEW_TABLE_SQL = """
+create table {0} (
+    name text not null,
+    id text not null,
+    author text not null,
+    version text not null,
+    timestamp int not null,
+    rating int not null,
+    title text not null,
+    comment text not null,
+    unique(name, id) on conflict ignore
+);
+""".format(DB_REVIEW_TABLE_NAME)
+DB_FILE_TABLE_SQL = """
+create table {0} (
+    name text not null,
+    filename text not null,
+    size int not null,
+    hash text not null,
+    unique(name) on conflict replace
+);
+""".format(DB_FILE_TABLE_NAME)
+DB_BLOB_TABLE_SQL = """
+create table {0} (
+    hash text not null,
+    size int not null,
+    signature text not null,
+    refs int not null default 0,
+    unique(hash) on conflict ignore
+);
+""".format(DB_BLOB_TABLE_NAME)
+DB_TRANSFER_TABLE_SQL = """
+create table {0} (
+    size int not null,
+    seconds real not null,
+    updated datetime not null default current_timestamp
+);
+""".format(DB_TRANSFER_TABLE_NAME)
+DB_DELIVERY_TABLE_SQL = """
+create table {0} (
+    name text not null,
+    code int not null,
+    offer int not null,
+    data blob not null,
+    expires real not null,
+    unique(name, code, offer) on conflict replace
+);
+""".format(DB_DELIVERY_TABLE_NAME)
 DB_TABLES_SQL = {
     DB_APK_TABLE_NAME: DB_APK_TABLE_SQL,
     DB_APK_TRIGGER_NAME: DB_APK_TRIGGER_SQL,
-    DB_TOKEN_TABLE_NAME: DB_TOKEN_TABLE_SQL
+    DB_TOKEN_TABLE_NAME: DB_TOKEN_TABLE_SQL,
+    DB_CRAWL_TABLE_NAME: DB_CRAWL_TABLE_SQL,
+    DB_REVIEW_TABLE_NAME: DB_REVIEW_TABLE_SQL,
+    DB_FILE_TABLE_NAME: DB_FILE_TABLE_SQL,
+    DB_BLOB_TABLE_NAME: DB_BLOB_TABLE_SQL,
+    DB_TRANSFER_TABLE_NAME: DB_TRANSFER_TABLE_SQL,
+    DB_DELIVERY_TABLE_NAME: DB_DELIVERY_TABLE_SQL,
 }
 ApkInfo = namedtuple("ApkInfo", ["name", "code", "version", "offer", "size"])
+CrawlPage = namedtuple(
+    "CrawlPage", ["path", "listing", "digest", "docids", "next_path", "age"])
+ApkFile = namedtuple(
+    "ApkFile", ["name", "code", "version", "size", "hash", "filename"])
+ReviewInfo = namedtuple(
+    "ReviewInfo", ["name", "id", "author", "version", "timestamp", "rating",
+                   "title", "comment"])
+
+
+_connections = threading.local()
+_writes = {"count": 0, "enabled": False}
+_writes_lock = threading.Lock()
+DB_WRITE_STATEMENTS = ("insert", "update", "delete", "replace")
+
+
+def _count_write(statement):
+    if statement.lstrip()[:7].lower().startswith(DB_WRITE_STATEMENTS):
+        with _writes_lock:
+            _writes["count"] += 1
+
+
+def track_writes():
+    """
+    Count the write statements of the connections opened from now on,
+    see get_writes_count. Needs sqlite3 trace callbacks (python 3.3).
+    """
+    _writes["enabled"] = True
+
+
+def get_writes_count():
+    return _writes["count"]
+
+
+def connect(db):
+    """
+    Return the connection to db of the current thread. It is opened once
+    and kept for the next calls, so long running processes do not reopen
+    the database for every query.
+    """
+    connections = getattr(_connections, "value", None)
+    if connections is None:
+        connections = _connections.value = {}
+    conn = connections.get(db)
+    if conn is None:
+        conn = connections[db] = sqlite3.connect(db)
+        if _writes["enabled"] and hasattr(conn, "set_trace_callback"):
+            conn.set_trace_callback(_count_write)
+    return conn
+
+
+def _commit(conn, function):
+    with DB_COMMIT_SECONDS.time(function=function):
+        conn.commit()
+
+
+def disconnect(db):
+    connections = getattr(_connections, "value", {})
+    conn = connections.pop(db, None)
+    if conn is not None:
+        conn.close()
 
 
 def check_db_tables(cursor):
@@ -57,19 +222,20 @@ def check_db_tables(cursor):
 
 def create_db(db, force=False):
     if force and os.path.isfile(db):
+        disconnect(db)
         os.remove(db)
-    conn = sqlite3.connect(db)
+    conn = connect(db)
     cursor = conn.cursor()
     absent_tables = check_db_tables(cursor)
     for table in absent_tables:
         table_sql = DB_TABLES_SQL[table]
         cursor.execute(table_sql)
-    conn.commit()
+    _commit(conn, "create_db")
     cursor.close()
 
 
 def get_access_token(db):
-    conn = sqlite3.connect(db)
+    conn = connect(db)
     cursor = conn.cursor()
     cursor.execute("Select token from {}".format(DB_TOKEN_TABLE_NAME))
     records = cursor.fetchone()
@@ -79,7 +245,7 @@ def get_access_token(db):
 
 
 def update_access_token(db, token):
-    conn = sqlite3.connect(db)
+    conn = connect(db)
     cursor = conn.cursor()
     cursor.execute("Select token from {0}".format(DB_TOKEN_TABLE_NAME))
     records = cursor.fetchone()
@@ -90,12 +256,12 @@ def update_access_token(db, token):
     else:
         cursor.execute(
             "Update {0} set token = ?".format(DB_TOKEN_TABLE_NAME), [token])
-    conn.commit()
+    _commit(conn, "update_access_token")
     cursor.close()
 
 
 def get_apks_records(db):
-    conn = sqlite3.connect(db)
+    conn = connect(db)
     cursor = conn.cursor()
     cursor.execute(
         "Select name, code, version, offer, size from {}".
@@ -105,20 +271,41 @@ def get_apks_records(db):
     return dict((record[0], ApkInfo(*record)) for record in records)
 
 
+def get_apks_updated(db):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Select name, updated from {}".format(DB_APK_TABLE_NAME))
+    records = cursor.fetchall()
+    cursor.close()
+    return dict(records)
+
+
 def delete_apks_records(db, records):
-    conn = sqlite3.connect(db)
+    conn = connect(db)
     cursor = conn.cursor()
     cursor.execute(
-        "Delete from {} where name in ({})".format(
-            DB_APK_TABLE_NAME,
+        """
+        Update {0} set refs = refs -
+        (Select count(*) from {1} where {1}.hash = {0}.hash and name in ({2}))
+        where hash in (Select hash from {1} where name in ({2}))
+        """.format(
+            DB_BLOB_TABLE_NAME,
+            DB_FILE_TABLE_NAME,
             ','.join('?' * len(records))
-        ), records)
-    conn.commit()
+        ), tuple(records) * 2)
+    for table in (DB_APK_TABLE_NAME, DB_FILE_TABLE_NAME):
+        cursor.execute(
+            "Delete from {} where name in ({})".format(
+                table,
+                ','.join('?' * len(records))
+            ), records)
+    _commit(conn, "delete_apks_records")
     cursor.close()
 
 
 def update_apk_info(db, info):
-    conn = sqlite3.connect(db)
+    conn = connect(db)
     cursor = conn.cursor()
     cursor.execute(
         "Select name from {0} where name = ?".
@@ -138,5 +325,235 @@ def update_apk_info(db, info):
             where name = ?
             """.format(DB_APK_TABLE_NAME),
             [info.code, info.version, info.offer, info.size, info.name])
-    conn.commit()
+    _commit(conn, "update_apk_info")
+    cursor.close()
+
+
+def get_crawl_pages(db, listing):
+    """Return {path: CrawlPage} of a listing, age is in seconds."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        Select path, listing, digest, docids, next_path,
+        (julianday('now') - julianday(updated)) * 86400
+        from {0} where listing = ?
+        """.format(DB_CRAWL_TABLE_NAME), [listing])
+    records = cursor.fetchall()
+    cursor.close()
+    return dict(
+        (record[0], CrawlPage(*(
+            record[:3] + (record[3].split(), ) + record[4:])))
+        for record in records)
+
+
+def update_crawl_page(db, page):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        Insert into {0} (path, listing, digest, docids, next_path)
+        values(?, ?, ?, ?, ?)
+        """.format(DB_CRAWL_TABLE_NAME),
+        [page.path, page.listing, page.digest, "\n".join(page.docids),
+         page.next_path])
+    _commit(conn, "update_crawl_page")
+    cursor.close()
+
+
+def touch_crawl_pages(db, paths):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Update {0} set updated = datetime('now') where path in ({1})".format(
+            DB_CRAWL_TABLE_NAME,
+            ','.join('?' * len(paths))
+        ), paths)
+    _commit(conn, "touch_crawl_pages")
+    cursor.close()
+
+
+def insert_reviews(db, reviews):
+    """Store reviews in one transaction, already known ids are ignored."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.executemany(
+        """
+        Insert into {0}
+        (name, id, author, version, timestamp, rating, title, comment)
+        values(?, ?, ?, ?, ?, ?, ?, ?)
+        """.format(DB_REVIEW_TABLE_NAME), reviews)
+    _commit(conn, "insert_reviews")
+    cursor.close()
+
+
+def get_apks_files(db):
+    """Return ApkFile records of the downloaded apks ordered by name."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        Select a.name, a.code, a.version, f.size, f.hash, f.filename
+        from {0} a join {1} f on a.name = f.name order by a.name
+        """.format(DB_APK_TABLE_NAME, DB_FILE_TABLE_NAME))
+    records = cursor.fetchall()
+    cursor.close()
+    return [ApkFile(*record) for record in records]
+
+
+def update_apk_file(db, name, filename, size, digest):
+    """
+    Point the apk name to the blob digest, moving the blob reference from
+    the previous file of the apk.
+    """
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Select hash from {0} where name = ?".format(DB_FILE_TABLE_NAME),
+        [name])
+    records = cursor.fetchone()
+    if records:
+        cursor.execute(
+            "Update {0} set refs = refs - 1 where hash = ?".format(
+                DB_BLOB_TABLE_NAME), [records[0]])
+    cursor.execute(
+        "Update {0} set refs = refs + 1 where hash = ?".format(
+            DB_BLOB_TABLE_NAME), [digest])
+    cursor.execute(
+        """
+        Insert into {0} (name, filename, size, hash) values(?, ?, ?, ?)
+        """.format(DB_FILE_TABLE_NAME), [name, filename, size, digest])
+    _commit(conn, "update_apk_file")
+    cursor.close()
+
+
+def get_blob(db, size, signature):
+    """Return the hash of a stored blob with this size and signature."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Select hash from {0} where size = ? and signature = ?".format(
+            DB_BLOB_TABLE_NAME), [size, signature])
+    records = cursor.fetchone()
+    cursor.close()
+    if records:
+        return records[0]
+
+
+def add_blob(db, digest, size, signature):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Insert into {0} (hash, size, signature) values(?, ?, ?)".format(
+            DB_BLOB_TABLE_NAME), [digest, size, signature])
+    _commit(conn, "add_blob")
+    cursor.close()
+
+
+def get_unreferenced_blobs(db):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Select hash from {0} where refs <= 0".format(DB_BLOB_TABLE_NAME))
+    records = cursor.fetchall()
+    cursor.close()
+    return [record[0] for record in records]
+
+
+def get_blobs(db):
+    """Return the set of the hashes of all the known blobs."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute("Select hash from {0}".format(DB_BLOB_TABLE_NAME))
+    records = cursor.fetchall()
+    cursor.close()
+    return set(record[0] for record in records)
+
+
+def delete_blob(db, digest):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Delete from {0} where hash = ? and refs <= 0".format(
+            DB_BLOB_TABLE_NAME), [digest])
+    _commit(conn, "delete_blob")
+    cursor.close()
+
+
+def add_transfer(db, size, seconds):
+    """Record a download, only the last DB_TRANSFER_HISTORY are kept."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Insert into {0} (size, seconds) values(?, ?)".format(
+            DB_TRANSFER_TABLE_NAME), [size, seconds])
+    cursor.execute(
+        "Delete from {0} where rowid <= ?".format(DB_TRANSFER_TABLE_NAME),
+        [cursor.lastrowid - DB_TRANSFER_HISTORY])
+    _commit(conn, "add_transfer")
+    cursor.close()
+
+
+def get_throughput(db, limit=100):
+    """
+    Return the bytes per second of the last limit downloads, None without
+    history.
+    """
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        Select sum(size), sum(seconds) from
+        (Select size, seconds from {0} order by rowid desc limit ?)
+        """.format(DB_TRANSFER_TABLE_NAME), [limit])
+    size, seconds = cursor.fetchone()
+    cursor.close()
+    if size and seconds:
+        return size / seconds
+    return None
+
+
+def get_delivery(db, name, code, offer):
+    """
+    Return the serialized delivery data of the package version, None if it
+    is not cached or has expired.
+    """
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+        Select data from {0}
+        where name = ? and code = ? and offer = ? and expires > ?
+        """.format(DB_DELIVERY_TABLE_NAME),
+        [name, code, offer, time.time()])
+    records = cursor.fetchone()
+    cursor.close()
+    if records:
+        return bytes(records[0])
+
+
+def update_delivery(db, name, code, offer, data, expires):
+    """Cache the delivery data until expires, dropping the expired ones."""
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Delete from {0} where expires <= ?".format(DB_DELIVERY_TABLE_NAME),
+        [time.time()])
+    cursor.execute(
+        """
+        Insert into {0} (name, code, offer, data, expires)
+        values(?, ?, ?, ?, ?)
+        """.format(DB_DELIVERY_TABLE_NAME),
+        [name, code, offer, sqlite3.Binary(data), expires])
+    _commit(conn, "update_delivery")
+    cursor.close()
+
+
+def delete_delivery(db, name, code, offer):
+    conn = connect(db)
+    cursor = conn.cursor()
+    cursor.execute(
+        "Delete from {0} where name = ? and code = ? and offer = ?".format(
+            DB_DELIVERY_TABLE_NAME), [name, code, offer])
+    _commit(conn, "delete_delivery")
     cursor.close()
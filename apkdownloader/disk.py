@@ -0,0 +1,92 @@
+"""
+Free space checks of the download directory.
+
+The plan is checked against the free space of the filesystem minus a
+reserve before anything is downloaded, so a run does not stop halfway
+with the disk full. It either fails or keeps the packages which fit, in
+plan order, so the ones with the highest priority are kept.
+"""
+from __future__ import absolute_import
+import errno
+import logging
+import os
+
+__all__ = (
+    'DiskSpaceError',
+    'check_disk_space',
+    'get_free_space',
+    'preallocate',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISK_RESERVE = 64 * 1024 * 1024
+DISK_FULL_FAIL = "fail"
+DISK_FULL_TRIM = "trim"
+DISK_FULL_POLICIES = (DISK_FULL_FAIL, DISK_FULL_TRIM)
+DEFAULT_DISK_FULL_POLICY = DISK_FULL_FAIL
+
+
+class DiskSpaceError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def get_free_space(directory):
+    """Return the bytes available to the user in directory, None if unknown."""
+    if not hasattr(os, "statvfs"):
+        return None
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def check_disk_space(plan, directory, reserve=DEFAULT_DISK_RESERVE,
+                     policy=DEFAULT_DISK_FULL_POLICY):
+    """
+    Return the part of the ordered plan which fits into the free space of
+    directory minus reserve bytes. With the fail policy DiskSpaceError is
+    raised unless the whole plan fits.
+    """
+    if policy not in DISK_FULL_POLICIES:
+        raise ValueError("Unknown disk full policy: {0}".format(policy))
+    free = get_free_space(directory)
+    if free is None:
+        return plan
+    available = free - reserve
+    required = sum(info.size for info in plan)
+    if required <= available:
+        return plan
+    if policy == DISK_FULL_FAIL:
+        raise DiskSpaceError(
+            "{0} bytes are needed in {1}, {2} are free with a reserve of "
+            "{3}".format(required, directory, max(0, available), reserve))
+    fitting = []
+    for info in plan:
+        if info.size <= available:
+            fitting.append(info)
+            available -= info.size
+        else:
+            logger.warning(
+                "Not enough disk space for {0}, skip it".format(info.name))
+    return fitting
+
+
+def preallocate(fd, size):
+    """
+    Reserve size bytes for the open file fd, so the filesystem can lay it
+    out contiguously and a full disk is found before writing. Does nothing
+    where posix_fallocate or the filesystem support is missing.
+    """
+    if not size or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as ex:
+        if ex.errno == errno.ENOSPC:
+            raise DiskSpaceError("No space left for {0} bytes".format(size))
+        if ex.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
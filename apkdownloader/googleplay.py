@@ -1,27 +1,91 @@
 from __future__ import absolute_import
 import requests
+import collections
 import functools
+import hashlib
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 from google.protobuf import descriptor
 from google.protobuf.internal.containers import RepeatedCompositeFieldContainer
 from google.protobuf import text_format
 from google.protobuf.message import Message
 from . import googleplay_pb2
+from .metrics import (
+    CACHE,
+    COALESCED,
+    DOWNLOAD_BYTES,
+    FIRST_BYTE_SECONDS,
+    HEDGED,
+    REQUESTS,
+    REQUEST_SECONDS,
+    RESPONSE_BYTES,
+    RETRIES,
+)
+from .cassette import record_session, replay_session
+from .circuit import (
+    CircuitBreaker,
+    DEFAULT_BREAKER_RESET,
+    DEFAULT_BREAKER_THRESHOLD,
+)
+from .singleflight import SingleFlight
+from .tracing import trace_span
+from .transport import (
+    create_session,
+    warm_up,
+    DEFAULT_POOL_SIZE,
+)
+from .wire import (
+    scan_bulk_details,
+    scan_container_docs,
+    scan_prefetch,
+    SEARCH_DOC_PATH,
+)
 
 
 __all__ = (
     'LoginError',
     'RequestError',
+    'DeadlineError',
     'GooglePlayAPI',
 )
 
 requests.packages.urllib3.disable_warnings()
 
+DEFAULT_REQUEST_TIMEOUT = 30.0
+# fetch is a streamed download, its timeout is between two reads
+DEFAULT_TIMEOUTS = {
+    "fetch": 60.0,
+}
+# idempotent endpoints which hedging may send twice
+HEDGED_ENDPOINTS = ("details", "bulkDetails", "search", "list")
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+# responses the server sent ahead of their requests which are kept
+PREFETCH_CACHE_SIZE = 1024
+# the requests of auth, the fdfe API and the apk downloads go to different
+# services which fail on their own
+BREAKER_AUTH = "auth"
+BREAKER_API = "api"
+BREAKER_CDN = "cdn"
+ENDPOINT_BREAKERS = {
+    "auth": BREAKER_AUTH,
+    "fetch": BREAKER_CDN,
+}
+
 
 def check_auth_token(func):
     @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
-        if not self.has_token():
-            self.login()
+        self.ensure_token()
         return func(self, *args, **kwargs)
     return wrapper
 
@@ -43,6 +107,89 @@ class RequestError(Exception):
     def __str__(self):
         return repr(self.value)
 
+
+class DeadlineError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class LatencyWindow(object):
+    """Latencies of the last requests of an endpoint."""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent, min_samples=HEDGE_MIN_SAMPLES):
+        """Return the percentile of the latencies, None with few samples."""
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, len(samples) * percent // 100)]
+
+
+class PrefetchCache(object):
+    """Raw responses the server sent ahead, the latest size of them."""
+
+    def __init__(self, size=PREFETCH_CACHE_SIZE):
+        self.size = size
+        self.responses = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            return self.responses.get(url)
+
+    def put(self, url, response):
+        with self.lock:
+            self.responses.pop(url, None)
+            self.responses[url] = response
+            if len(self.responses) > self.size:
+                self.responses.popitem(last=False)
+
+    def __contains__(self, url):
+        with self.lock:
+            return url in self.responses
+
+    def __len__(self):
+        with self.lock:
+            return len(self.responses)
+
+
+class PageFetcher(threading.Thread):
+    """Fetch one raw API page in background."""
+
+    def __init__(self, api, path):
+        super(PageFetcher, self).__init__()
+        self.daemon = True
+        self.api = api
+        self.path = path
+        self.data = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.data = self.api.executeRequestRaw(self.path)
+        except Exception as err:
+            self.error = err
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+
 API_DFE_EXPERIMENTS = [
     "nocache:billing.use_charging_poller",
     "market_emails",
@@ -81,14 +228,20 @@ API_DEFAULT_HEADERS = {
 
 class GooglePlayAPI(object):
     """Google Play Unofficial API Class
-    Usual APIs methods are login(), search(), details(), bulkDetails(),
-    download(), browse(), reviews() and list().
+    Usual APIs methods are login(), search(), iter_search(), details(),
+    bulkDetails(), bulkDetailsInfo(), delivery(), purchase(), acquire(),
+    fetch(), download(), browse(), reviews() and list().
     toStr() can be used to pretty print the result (protobuf object) of the
     previous methods.
-    toDict() converts the result into a dict, for easier introspection."""
+    toDict() converts the result into a dict, for easier introspection.
+
+    An instance is safe to share between threads, which then share its
+    token, caches and connection pool: the token is got by a single login
+    and renewed once when the server refuses it."""
     SERVICE = "androidmarket"
     # "https://www.google.com/accounts/ClientLogin"
     URL_LOGIN = "https://android.clients.google.com/auth"
+    URL_API = "https://android.clients.google.com/fdfe/"
     ACCOUNT_TYPE_GOOGLE = "GOOGLE"
     ACCOUNT_TYPE_HOSTED = "HOSTED"
     ACCOUNT_TYPE_HOSTED_OR_GOOGLE = "HOSTED_OR_GOOGLE"
@@ -105,9 +258,14 @@ class GooglePlayAPI(object):
             raise ValueError(
                 "You should provide at least authSubToken or "
                 "(email and password)")
-        self.preFetch = {}
+        self.preFetch = PrefetchCache()
         self.androidId = androidId
         self.auth_sub_token = auth_sub_token
+        # threads needing a new token wait for the login of the first one
+        self.token_lock = threading.Lock()
+        # apps delivery() had nothing for, acquire() purchases them at once
+        self.unowned = set()
+        self.unowned_lock = threading.Lock()
         self.debug = debug
         self.lang = lang or self.DEFAULT_LANG
         self.email = email
@@ -118,6 +276,61 @@ class GooglePlayAPI(object):
             "device_lang", self.DEFAULT_DEVICE_LANG)
         self.operator_country = kwargs.get(
             "operator_country", self.DEFAULT_OPERATOR_COUNTRY)
+        # url_login and url_api point the client to another server,
+        # for example a local fakeplay instance
+        self.url_login = kwargs.get("url_login") or self.URL_LOGIN
+        self.url_api = kwargs.get("url_api") or self.URL_API
+        # every request goes through one session, so connections are kept
+        # alive and shared between threads, it may be created (and warmed
+        # up) beforehand
+        self.session = kwargs.get("session") or create_session(
+            kwargs.get("pool_size") or DEFAULT_POOL_SIZE)
+        # the traffic can be recorded to or replayed from a cassette file
+        if kwargs.get("replay"):
+            replay_session(self.session, kwargs["replay"])
+        elif kwargs.get("record"):
+            record_session(
+                self.session, kwargs["record"],
+                urls=(self.url_api, self.url_login))
+        # connections opened to a download host as soon as the first
+        # delivery points to it, the API host is warmed up by the caller
+        self.warm_connections = 0 if kwargs.get("replay") else (
+            kwargs.get("warm_connections") or 0)
+        self.warmed_hosts = set()
+        self.warmed_lock = threading.Lock()
+        # identical concurrent requests share one network call, raw bytes
+        # and decoded messages are coalesced separately
+        self.raw_flights = SingleFlight()
+        self.message_flights = SingleFlight()
+        # seconds a request may take by endpoint (auth, fetch and the API
+        # endpoints), never more than what is left until the deadline
+        self.timeout = kwargs.get("timeout") or DEFAULT_REQUEST_TIMEOUT
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        self.timeouts.update(kwargs.get("timeouts") or {})
+        # time of the deadline, the latencies and the circuit breakers, a
+        # simulation gives its virtual clock
+        self.clock = kwargs.get("clock") or time.time
+        self.deadline = None
+        self.set_deadline(kwargs.get("deadline"))
+        # send a duplicate of the idempotent requests slower than the p95
+        # latency of their endpoint, the first answer wins
+        self.hedge = kwargs.get("hedge", False)
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
+        # requests to a failing service fail fast until it recovers
+        self.breakers = dict(
+            (name, CircuitBreaker(
+                name,
+                threshold=kwargs.get(
+                    "breaker_threshold") or DEFAULT_BREAKER_THRESHOLD,
+                reset_timeout=kwargs.get(
+                    "breaker_reset") or DEFAULT_BREAKER_RESET,
+                clock=self.clock))
+            for name in (BREAKER_AUTH, BREAKER_API, BREAKER_CDN))
+
+    def close(self):
+        """Close the connections, and the cassette when recording."""
+        self.session.close()
 
     def toDictSingle(self, protoObj):
         """
@@ -164,7 +377,109 @@ class GooglePlayAPI(object):
         fields = [i.name for i, _ in protoObj.ListFields()]
         if ("preFetch" in fields):
             for p in protoObj.preFetch:
-                self.preFetch[p.url] = p.response
+                self.preFetch.put(p.url, p.response.SerializeToString())
+
+    def _register_raw_preFetch(self, data):
+        for url, response in scan_prefetch(data):
+            self.preFetch.put(url, response)
+
+    def _iter_pages(self, path, doc_path, limit=None):
+        """
+        Follow the next page links starting from path and yield ApkInfo
+        records of the docs found at doc_path. Page N+1 is requested as soon
+        as page N is decoded, so the network round trip overlaps with the
+        caller consuming page N. Only one page is held in memory.
+        """
+        count = 0
+        page = PageFetcher(self, path)
+        while page is not None:
+            data = page.result()
+            self._register_raw_preFetch(data)
+            records, next_path = scan_container_docs(data, doc_path)
+            data = page = None
+            if (next_path and records and
+                    (limit is None or count + len(records) < limit)):
+                page = PageFetcher(self, next_path)
+            for record in records:
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield record
+
+    def set_deadline(self, seconds):
+        """
+        Make the requests fail with DeadlineError seconds from now, None
+        removes the deadline.
+        """
+        self.deadline = self.clock() + seconds if seconds else None
+
+    def get_timeout(self, endpoint):
+        timeout = self.timeouts.get(endpoint, self.timeout)
+        # another thread may set the deadline meanwhile
+        deadline = self.deadline
+        if deadline is not None:
+            left = deadline - self.clock()
+            if left <= 0:
+                raise DeadlineError(
+                    "Deadline exceeded before a {0} request".format(endpoint))
+            timeout = min(timeout, left)
+        return timeout
+
+    def within_deadline(self, chunks):
+        """
+        Yield the chunks of a streamed body, raising DeadlineError once the
+        deadline passes: the timeout of a stream is only between reads.
+        """
+        for chunk in chunks:
+            deadline = self.deadline
+            if deadline is not None and self.clock() >= deadline:
+                raise DeadlineError("Deadline exceeded during a download")
+            yield chunk
+
+    def get_breaker(self, endpoint):
+        return self.breakers[ENDPOINT_BREAKERS.get(endpoint, BREAKER_API)]
+
+    def _request(self, endpoint, method, url, **kwargs):
+        """
+        Send a request with the timeout of the endpoint, through the circuit
+        breaker of its service.
+        """
+        timeout = self.get_timeout(endpoint)
+        breaker = self.get_breaker(endpoint)
+        breaker.before()
+        try:
+            response = self.session.request(
+                method, url, verify=False, timeout=timeout, **kwargs)
+        except requests.Timeout as err:
+            deadline = self.deadline
+            if deadline is not None and self.clock() >= deadline:
+                breaker.release()
+                raise DeadlineError(
+                    "Deadline exceeded during a {0} request".format(endpoint))
+            breaker.failure("{0}: {1}".format(endpoint, err))
+            raise
+        except requests.RequestException as err:
+            breaker.failure("{0}: {1}".format(endpoint, err))
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        # elapsed ends when the headers are parsed, before the body is read
+        FIRST_BYTE_SECONDS.observe(
+            response.elapsed.total_seconds(), endpoint=endpoint)
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.failure("{0}: HTTP {1}".format(
+                endpoint, response.status_code))
+        else:
+            breaker.success()
+        return response
+
+    def get_latencies(self, endpoint):
+        with self.latencies_lock:
+            latencies = self.latencies.get(endpoint)
+            if latencies is None:
+                latencies = self.latencies[endpoint] = LatencyWindow()
+            return latencies
 
     def has_token(self):
         return bool(self.auth_sub_token)
@@ -172,6 +487,28 @@ class GooglePlayAPI(object):
     def get_token(self):
         return self.auth_sub_token
 
+    def ensure_token(self):
+        """Login unless there is a token, once for all the threads."""
+        if self.has_token():
+            return
+        with self.token_lock:
+            if not self.has_token():
+                self.login()
+
+    def refresh_token(self, stale):
+        """
+        Login again after the server refused the token stale, unless
+        another thread already did. Returns False when there is no
+        password to login with.
+        """
+        if not (self.email and self.password):
+            return False
+        with self.token_lock:
+            if self.auth_sub_token == stale:
+                RETRIES.inc(operation="login")
+                self.login()
+        return True
+
     def login(self):
         """
         Login to your Google Account. You must provide either:
@@ -195,8 +532,9 @@ class GooglePlayAPI(object):
         headers = {
             "Accept-Encoding": "",
         }
-        response = requests.post(
-            self.URL_LOGIN, data=params, headers=headers, verify=False)
+        with trace_span("login"):
+            response = self._request(
+                "auth", "POST", self.url_login, data=params, headers=headers)
         data = response.text.split()
         params = {}
         for d in data:
@@ -211,27 +549,166 @@ class GooglePlayAPI(object):
         else:
             raise LoginError("Auth token not found.")
 
-    def executeRequestApi2(
+    def _flight_key(self, path, datapost):
+        if datapost is None:
+            return path, None
+        if not isinstance(datapost, bytes):
+            datapost = datapost.encode("utf-8")
+        return path, hashlib.sha1(datapost).hexdigest()
+
+    def executeRequestRaw(
             self, path, datapost=None, post_content_type=API_CONTENT_TYPE):
-        if (datapost is None and path in self.preFetch):
-            data = self.preFetch[path]
+        """
+        Return the undecoded ResponseWrapper bytes for an API call.
+        Concurrent calls with the same path and body share one request.
+        """
+        data, shared = self.raw_flights.do(
+            self._flight_key(path, datapost), self._executeRequestRaw,
+            path, datapost, post_content_type)
+        if shared:
+            COALESCED.inc(endpoint=path.split("?")[0])
+        return data
+
+    def _executeRequestRaw(self, path, datapost, post_content_type):
+        """
+        Send an API request, once more with a new token when the server
+        refuses the current one. Raises RequestError on other HTTP errors
+        instead of returning the error body as data.
+        """
+        endpoint = path.split("?")[0]
+        data = self.preFetch.get(path) if datapost is None else None
+        if data is not None:
+            CACHE.inc(cache="prefetch", result="hit")
         else:
-            headers = {
-                "Accept-Language": self.lang,
-                "Authorization": "GoogleLogin auth={0}".format(
-                    self.auth_sub_token),
-                "X-DFE-Device-Id": self.androidId,
-            }
-            headers.update(API_DEFAULT_HEADERS)
-            if datapost is not None:
-                headers["Content-Type"] = post_content_type
-            url = "https://android.clients.google.com/fdfe/{0}".format(path)
+            if datapost is None:
+                CACHE.inc(cache="prefetch", result="miss")
+            url = "{0}{1}".format(self.url_api, path)
+            start = self.clock()
+            with trace_span(endpoint, path=path) as span:
+                token = self.auth_sub_token
+                response = self._send(endpoint, url, datapost, self._headers(
+                    token, datapost, post_content_type))
+                if response.status_code == 401 and self.refresh_token(token):
+                    response = self._send(
+                        endpoint, url, datapost, self._headers(
+                            self.auth_sub_token, datapost, post_content_type))
+                data = response.content
+                span.set("status", response.status_code)
+                span.set("bytes", len(data))
+            REQUEST_SECONDS.observe(self.clock() - start, endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+            RESPONSE_BYTES.inc(len(data), endpoint=endpoint)
+            if not 200 <= response.status_code < 300:
+                raise RequestError("{0} request failed with HTTP {1}".format(
+                    endpoint, response.status_code))
+        return data
+
+    def _headers(self, token, datapost, post_content_type):
+        headers = {
+            "Accept-Language": self.lang,
+            "Authorization": "GoogleLogin auth={0}".format(token),
+            "X-DFE-Device-Id": self.androidId,
+        }
+        headers.update(API_DEFAULT_HEADERS)
+        if datapost is not None:
+            headers["Content-Type"] = post_content_type
+        return headers
+
+    def _send(self, endpoint, url, datapost, headers):
+        def send():
+            start = self.clock()
             if datapost is not None:
-                response = requests.post(
-                    url, data=datapost, headers=headers, verify=False)
+                response = self._request(
+                    endpoint, "POST", url, data=datapost, headers=headers)
             else:
-                response = requests.get(url, headers=headers, verify=False)
-            data = response.content
+                response = self._request(endpoint, "GET", url, headers=headers)
+            latencies.add(self.clock() - start)
+            return response
+
+        latencies = self.get_latencies(endpoint)
+        if not self.hedge or endpoint not in HEDGED_ENDPOINTS:
+            return send()
+        delay = latencies.percentile(HEDGE_PERCENTILE)
+        if delay is None:
+            return send()
+        return self._hedged(endpoint, send, delay)
+
+    def _hedged(self, endpoint, send, delay):
+        """
+        Return send(), calling it a second time from another thread when
+        the first call takes more than delay seconds. The first successful
+        answer wins, the other one is closed when it arrives.
+        """
+        results = queue.Queue()
+        lock = threading.Lock()
+        settled = threading.Event()
+
+        def run(hedge):
+            try:
+                response, error = send(), None
+            except Exception as err:
+                response, error = None, err
+            with lock:
+                if not settled.is_set():
+                    results.put((hedge, response, error))
+                    return
+            if response is not None:
+                response.close()
+
+        def start(hedge):
+            thread = threading.Thread(target=run, args=(hedge,))
+            thread.daemon = True
+            thread.start()
+
+        start(False)
+        pending = 1
+        hedged = False
+        try:
+            result = results.get(timeout=delay)
+        except queue.Empty:
+            start(True)
+            pending += 1
+            hedged = True
+            result = results.get()
+        while True:
+            pending -= 1
+            hedge, response, error = result
+            if error is None or not pending:
+                break
+            result = results.get()
+        with lock:
+            settled.set()
+        # a losing answer which came in meanwhile
+        while True:
+            try:
+                _, loser, _ = results.get_nowait()
+            except queue.Empty:
+                break
+            if loser is not None:
+                loser.close()
+        if hedged:
+            HEDGED.inc(endpoint=endpoint,
+                       winner="hedge" if hedge else "primary")
+        if error is not None:
+            raise error
+        return response
+
+    def executeRequestApi2(
+            self, path, datapost=None, post_content_type=API_CONTENT_TYPE):
+        """
+        Return the decoded ResponseWrapper of an API call. Concurrent calls
+        with the same path and body share the request and the message,
+        which must not be modified.
+        """
+        message, shared = self.message_flights.do(
+            self._flight_key(path, datapost), self._executeRequestApi2,
+            path, datapost, post_content_type)
+        if shared:
+            COALESCED.inc(endpoint=path.split("?")[0])
+        return message
+
+    def _executeRequestApi2(self, path, datapost, post_content_type):
+        data = self.executeRequestRaw(path, datapost, post_content_type)
         message = googleplay_pb2.ResponseWrapper.FromString(data)
         self._try_register_preFetch(message)
         return message
@@ -251,6 +728,18 @@ class GooglePlayAPI(object):
         message = self.executeRequestApi2(path)
         return message.payload.searchResponse
 
+    @check_auth_token
+    def iter_search(self, query, limit=None, nb_results=None):
+        """
+        Iterate over search results across pages, yielding ApkInfo records.
+        limit caps the total number of results, nb_results is the page size
+        asked from the server.
+        """
+        path = "search?c=3&q=%s" % requests.utils.quote(query)
+        if (nb_results is not None):
+            path += "&n=%d" % int(nb_results)
+        return self._iter_pages(path, SEARCH_DOC_PATH, limit)
+
     @check_auth_token
     def details(self, packageName):
         """
@@ -276,6 +765,23 @@ class GooglePlayAPI(object):
         message = self.executeRequestApi2(path, data, "application/x-protobuf")
         return message.payload.bulkDetailsResponse
 
+    @check_auth_token
+    def bulkDetailsInfo(self, packageNames):
+        """
+        Same request as bulkDetails(), but only packageName, versionCode,
+        versionString, offerType and installationSize are decoded for each
+        doc, straight from the wire format.
+        Returns a list of ApkInfo records in the order of packageNames,
+        with None for unknown packages.
+        """
+        path = "bulkDetails"
+        req = googleplay_pb2.BulkDetailsRequest()
+        req.docid.extend(packageNames)
+        data = req.SerializeToString()
+        data = self.executeRequestRaw(path, data, "application/x-protobuf")
+        self._register_raw_preFetch(data)
+        return scan_bulk_details(data)
+
     @check_auth_token
     def browse(self, cat=None, ctr=None):
         """
@@ -326,24 +832,89 @@ class GooglePlayAPI(object):
         return message.payload.reviewResponse
 
     @check_auth_token
-    def download(self, packageName, versionCode, offerType=1, stream=False):
+    def purchase(self, packageName, versionCode, offerType=1):
+        """
+        Acquire an app and return its AndroidAppDeliveryData, which holds
+        the download URL, cookies, downloadSize and signature of the APK.
         """
-        Download an app and return its raw data (APK file).
-        packageName is the app unique ID (usually starting with 'com.').
-        versionCode can be grabbed by using the details() method on the given
-        app."""
         path = "purchase"
         data = "ot=%d&doc=%s&vc=%d" % (offerType, packageName, versionCode)
         message = self.executeRequestApi2(path, data)
-        url = message.payload.buyResponse.purchaseStatusResponse.\
-            appDeliveryData.downloadUrl
-        cookie = message.payload.buyResponse.purchaseStatusResponse.\
-            appDeliveryData.downloadAuthCookie[0]
+        return message.payload.buyResponse.purchaseStatusResponse.\
+            appDeliveryData
+
+    @check_auth_token
+    def delivery(self, packageName, versionCode, offerType=1):
+        """
+        Return the AndroidAppDeliveryData of an app the account already
+        owns, None when the server has none and the app must be purchased.
+        It is a single GET, lighter than the purchase flow.
+        """
+        path = "delivery?ot=%d&doc=%s&vc=%d" % (
+            offerType, packageName, versionCode)
+        message = self.executeRequestApi2(path)
+        deliveryData = message.payload.deliveryResponse.appDeliveryData
+        if not deliveryData.downloadUrl:
+            return None
+        return deliveryData
+
+    def acquire(self, packageName, versionCode, offerType=1):
+        """
+        Return the AndroidAppDeliveryData of an app, from delivery() for
+        owned apps, falling back to purchase() for the others. Apps which
+        already fell back are purchased without asking delivery() again.
+        """
+        with self.unowned_lock:
+            unowned = packageName in self.unowned
+        deliveryData = None
+        if not unowned:
+            deliveryData = self.delivery(packageName, versionCode, offerType)
+            if deliveryData is None:
+                with self.unowned_lock:
+                    self.unowned.add(packageName)
+        if deliveryData is None:
+            deliveryData = self.purchase(packageName, versionCode, offerType)
+        self._warm_up_host(deliveryData.downloadUrl)
+        return deliveryData
+
+    def _warm_up_host(self, url):
+        """
+        Open connections to the host of url the first time it is seen,
+        return the warm-up threads.
+        """
+        if not self.warm_connections or not url:
+            return []
+        parts = urlsplit(url)
+        origin = "{0}://{1}/".format(parts.scheme, parts.netloc)
+        with self.warmed_lock:
+            if origin in self.warmed_hosts:
+                return []
+            self.warmed_hosts.add(origin)
+        return warm_up(self.session, [origin], self.warm_connections)
+
+    def fetch(self, deliveryData, stream=False):
+        """Download the APK described by an AndroidAppDeliveryData."""
+        cookie = deliveryData.downloadAuthCookie[0]
         cookies = {str(cookie.name): str(cookie.value)}
         headers = {
             "User-Agent": DOWNLOADER_USER_AGENT,
             "Accept-Encoding": "",
         }
-        response = requests.get(
-            url, stream=stream, headers=headers, cookies=cookies, verify=False)
+        with trace_span("fetch", stream=stream) as span:
+            response = self._request(
+                "fetch", "GET", deliveryData.downloadUrl, stream=stream,
+                headers=headers, cookies=cookies)
+            if not stream:
+                DOWNLOAD_BYTES.inc(len(response.content))
+                span.set("bytes", len(response.content))
         return response
+
+    @check_auth_token
+    def download(self, packageName, versionCode, offerType=1, stream=False):
+        """
+        Download an app and return its raw data (APK file).
+        packageName is the app unique ID (usually starting with 'com.').
+        versionCode can be grabbed by using the details() method on the given
+        app."""
+        deliveryData = self.acquire(packageName, versionCode, offerType)
+        return self.fetch(deliveryData, stream)
@@ -0,0 +1,277 @@
+"""
+Run metrics in the Prometheus text format.
+
+Counters and histograms of the API requests, downloads, caches and database
+commits are kept in process. They can be served over HTTP at /metrics for
+long running processes (watch mode) or written to a file for the textfile
+collector of node_exporter after cron runs.
+"""
+from __future__ import absolute_import
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+__all__ = (
+    'Counter',
+    'Histogram',
+    'MetricsRegistry',
+    'start_metrics_server',
+    'write_metrics_file',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_HOST = "0.0.0.0"
+METRICS_PATH = "/metrics"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    60.0, 300.0)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{{{0}}}".format(",".join(
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").
+                           replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in zip(names, values)))
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{0} has labels {1}, got {2}".format(
+                self.name, self.labels, sorted(labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def lines(self):
+        yield "# HELP {0} {1}".format(self.name, self.documentation)
+        yield "# TYPE {0} {1}".format(self.name, self.type)
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            for line in self.sample_lines(key, value):
+                yield line
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def sample_lines(self, key, value):
+        yield "{0}{1} {2}".format(
+            self.name, format_labels(self.labels, key), format_value(value))
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # bucket counts, then the sum and the number of observations
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get(self, **labels):
+        """Return (number of observations, sum) of the labels."""
+        counts = self.values.get(self.key(labels))
+        return (counts[-1], counts[-2]) if counts else (0, 0)
+
+    def sample_lines(self, key, counts):
+        names = self.labels + ("le",)
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            yield "{0}_bucket{1} {2}".format(
+                self.name, format_labels(names, key + (format_value(bound),)),
+                total)
+        yield "{0}_bucket{1} {2}".format(
+            self.name, format_labels(names, key + ("+Inf",)), counts[-1])
+        labels = format_labels(self.labels, key)
+        yield "{0}_sum{1} {2}".format(self.name, labels, format_value(
+            counts[-2]))
+        yield "{0}_count{1} {2}".format(self.name, labels, counts[-1])
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def exposition(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_SECONDS = Histogram(
+    "apkdownloader_request_seconds",
+    "Latency of Google Play API requests.", ["endpoint"])
+REQUESTS = Counter(
+    "apkdownloader_requests_total",
+    "Google Play API requests by HTTP status.", ["endpoint", "status"])
+FIRST_BYTE_SECONDS = Histogram(
+    "apkdownloader_first_byte_seconds",
+    "Time to the response headers of requests, connecting included.",
+    ["endpoint"])
+RESPONSE_BYTES = Counter(
+    "apkdownloader_response_bytes_total",
+    "Bytes of Google Play API responses.", ["endpoint"])
+DOWNLOAD_SECONDS = Histogram(
+    "apkdownloader_download_seconds", "Duration of apk downloads.")
+DOWNLOAD_BYTES = Counter(
+    "apkdownloader_download_bytes_total", "Bytes of downloaded apks.")
+RETRIES = Counter(
+    "apkdownloader_retries_total", "Retried operations.", ["operation"])
+COALESCED = Counter(
+    "apkdownloader_coalesced_requests_total",
+    "API requests served by an identical request already in flight.",
+    ["endpoint"])
+HEDGED = Counter(
+    "apkdownloader_hedged_requests_total",
+    "Duplicate API requests sent after the p95 latency, by the request "
+    "which answered first.", ["endpoint", "winner"])
+BREAKER_TRIPS = Counter(
+    "apkdownloader_circuit_trips_total",
+    "Circuit breakers opened by failing requests.", ["breaker"])
+BREAKER_REJECTED = Counter(
+    "apkdownloader_circuit_rejected_total",
+    "Requests failed fast by an open circuit breaker.", ["breaker"])
+CACHE = Counter(
+    "apkdownloader_cache_total", "Cache lookups by result.",
+    ["cache", "result"])
+DB_COMMIT_SECONDS = Histogram(
+    "apkdownloader_db_commit_seconds",
+    "Latency of database commits.", ["function"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0))
+PACKAGES = Counter(
+    "apkdownloader_packages_total",
+    "Checked packages by result (updated, skipped, missing, failed).",
+    ["result"])
+UPDATE_SECONDS = Histogram(
+    "apkdownloader_update_seconds",
+    "Duration of downloading a set of updated packages.")
+
+
+def write_metrics_file(filename, registry=REGISTRY):
+    """
+    Write the metrics to filename, replacing it atomically as the textfile
+    collector may read it at any time.
+    """
+    temp_filename = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(temp_filename, "w") as f:
+        f.write(registry.exposition())
+    os.rename(temp_filename, filename)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path.split("?")[0] != METRICS_PATH:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, registry=REGISTRY):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.registry = registry
+
+
+def start_metrics_server(port, host=DEFAULT_METRICS_HOST, registry=REGISTRY):
+    """Serve the metrics at /metrics from a daemon thread."""
+    server = MetricsServer((host, port), registry)
+    logger.info("Serving metrics on http://{0}:{1}{2}".format(
+        host, server.server_address[1], METRICS_PATH))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,185 @@
+"""
+HTTP mirror of the downloaded apks.
+
+Files of the download directory are served with Range support and sent
+with sendfile where the platform has it. /index.json lists the downloaded
+apks from the database, so clients can sync by diffing it instead of
+listing directories.
+"""
+from __future__ import absolute_import
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlparse
+from .db import get_apks_files
+
+__all__ = (
+    'MirrorServer',
+    'start_mirror',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIRROR_HOST = "0.0.0.0"
+DEFAULT_MIRROR_PORT = 8080
+MIRROR_INDEX_PATH = "/index.json"
+MIRROR_COPY_BUFFER_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) of a single byte range header, end included.
+    None means the whole file, ValueError an unsatisfiable range.
+    Multiple ranges are answered with the whole file.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if not start:
+        length = int(end)
+        if not length:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def send_file(connection, f, offset, count):
+    """Send count bytes of f from offset, zero-copy when possible."""
+    if hasattr(connection, "sendfile"):
+        connection.sendfile(f, offset, count)
+        return
+    f.seek(offset)
+    while count > 0:
+        chunk = f.read(min(count, MIRROR_COPY_BUFFER_SIZE))
+        if not chunk:
+            break
+        connection.sendall(chunk)
+        count -= len(chunk)
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes on kept alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request(head=False)
+
+    def handle_request(self, head):
+        path = unquote(urlparse(self.path).path)
+        if path == MIRROR_INDEX_PATH:
+            self.send_index(head)
+        else:
+            self.send_apk(path, head)
+
+    def send_empty(self, code, headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_index(self, head):
+        apks = [apk._asdict() for apk in get_apks_files(self.server.db)]
+        body = json.dumps(apks, sort_keys=True).encode("utf-8")
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_empty(304, {"ETag": etag})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_apk(self, path, head):
+        root = self.server.directory
+        filename = os.path.normpath(os.path.join(root, path.lstrip("/")))
+        if (not filename.startswith(root + os.sep) or
+                not os.path.isfile(filename)):
+            self.send_empty(404)
+            return
+        with open(filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            try:
+                byte_range = parse_range(self.headers.get("Range"), size)
+            except ValueError:
+                self.send_empty(416, {"Content-Range": "bytes */%d" % size})
+                return
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.send_header(
+                "Content-Type", "application/vnd.android.package-archive")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header(
+                "Last-Modified", self.date_time_string(stat.st_mtime))
+            self.end_headers()
+            if not head and size:
+                self.wfile.flush()
+                send_file(self.connection, f, start, end - start + 1)
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, directory, db):
+        HTTPServer.__init__(self, address, MirrorHandler)
+        self.directory = os.path.normpath(os.path.abspath(directory))
+        self.db = db
+
+
+def start_mirror(directory, db, host=DEFAULT_MIRROR_HOST,
+                 port=DEFAULT_MIRROR_PORT, background=False):
+    """
+    Serve directory and the index of db on host:port. With background the
+    server runs in a daemon thread and is returned, otherwise this call
+    blocks.
+    """
+    server = MirrorServer((host, port), directory, db)
+    logger.info("Serving {0} on http://{1}:{2}/".format(
+        directory, host, server.server_address[1]))
+    if not background:
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        return server
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
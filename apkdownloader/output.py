@@ -0,0 +1,142 @@
+"""
+Machine readable output of the package info and the update plan.
+
+Records are plain dicts written one by one as they are produced, as a JSON
+array, as JSON lines or as CSV, so a consumer can start working before the
+whole plan is printed.
+"""
+from __future__ import absolute_import
+import csv
+import json
+
+__all__ = (
+    'get_record_writer',
+    'plan_records',
+    'OUTPUT_FORMATS',
+)
+
+OUTPUT_FORMAT_TEXT = "text"
+OUTPUT_FORMAT_JSON = "json"
+OUTPUT_FORMAT_NDJSON = "ndjson"
+OUTPUT_FORMAT_CSV = "csv"
+OUTPUT_FORMATS = (
+    OUTPUT_FORMAT_TEXT,
+    OUTPUT_FORMAT_JSON,
+    OUTPUT_FORMAT_NDJSON,
+    OUTPUT_FORMAT_CSV,
+)
+DEFAULT_OUTPUT_FORMAT = OUTPUT_FORMAT_TEXT
+RECORD_STATUS_UPDATE = "update"
+RECORD_STATUS_CURRENT = "current"
+RECORD_FIELDS = (
+    "order",
+    "name",
+    "status",
+    "code",
+    "current_code",
+    "code_delta",
+    "version",
+    "current_version",
+    "offer",
+    "size",
+    "estimated_seconds",
+)
+
+
+class JsonRecordWriter(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, record):
+        self.stream.write("[\n" if not self.count else ",\n")
+        self.stream.write(json.dumps(record, sort_keys=True))
+        self.stream.flush()
+        self.count += 1
+
+    def close(self):
+        self.stream.write("\n]\n" if self.count else "[]\n")
+        self.stream.flush()
+
+
+class NdjsonRecordWriter(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, record):
+        self.stream.write(json.dumps(record, sort_keys=True) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class CsvRecordWriter(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.DictWriter(stream, RECORD_FIELDS)
+        self.writer.writeheader()
+
+    def write(self, record):
+        self.writer.writerow(record)
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+RECORD_WRITERS = {
+    OUTPUT_FORMAT_JSON: JsonRecordWriter,
+    OUTPUT_FORMAT_NDJSON: NdjsonRecordWriter,
+    OUTPUT_FORMAT_CSV: CsvRecordWriter,
+}
+
+
+def get_record_writer(format, stream):
+    if format not in RECORD_WRITERS:
+        raise ValueError("Unknown output format: {0}".format(format))
+    return RECORD_WRITERS[format](stream)
+
+
+def plan_records(plan, current_apks, throughput=None):
+    """
+    Yield a record for every ApkInfo of the ordered plan, then for the
+    current_apks which are not in it. estimated_seconds is the size over
+    throughput (bytes per second), None without download history.
+    """
+    planned = set()
+    for order, info in enumerate(plan, 1):
+        planned.add(info.name)
+        current = current_apks.get(info.name)
+        yield {
+            "order": order,
+            "name": info.name,
+            "status": RECORD_STATUS_UPDATE,
+            "code": info.code,
+            "current_code": current.code if current else None,
+            "code_delta": info.code - current.code if current else None,
+            "version": info.version,
+            "current_version": current.version if current else None,
+            "offer": info.offer,
+            "size": info.size,
+            "estimated_seconds": (
+                round(info.size / throughput, 3) if throughput else None),
+        }
+    for name in sorted(set(current_apks) - planned):
+        current = current_apks[name]
+        yield {
+            "order": None,
+            "name": name,
+            "status": RECORD_STATUS_CURRENT,
+            "code": current.code,
+            "current_code": current.code,
+            "code_delta": 0,
+            "version": current.version,
+            "current_version": current.version,
+            "offer": current.offer,
+            "size": current.size,
+            "estimated_seconds": None,
+        }
@@ -0,0 +1,249 @@
+"""
+CPU and allocation profiling of a run.
+
+Profiler runs cProfile in the main thread and in every thread started while
+it is active, and saves the merged statistics in the pstats format. With
+tracemalloc (python 3.4) the allocations of every phase of the run, the
+spans directly under the root span of the tracer, are compared and the top
+lines are written to a text report. A sampler backend can be plugged in to
+get collapsed stacks for flame graph tools (flamegraph.pl, speedscope).
+"""
+from __future__ import absolute_import
+import cProfile
+import importlib
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__all__ = (
+    'Profiler',
+    'ThreadSampler',
+    'register_sampler',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_TOP = 10
+DEFAULT_SAMPLE_INTERVAL = 0.005
+PROFILE_STATS_SUFFIX = ".pstats"
+PROFILE_COLLAPSED_SUFFIX = ".collapsed"
+PROFILE_ALLOCATIONS_SUFFIX = ".alloc.txt"
+TRACEMALLOC_IGNORED_FILES = (
+    "<frozen importlib._bootstrap>",
+    "<frozen importlib._bootstrap_external>",
+    "<unknown>",
+)
+
+
+class ThreadSampler(object):
+    """
+    Sample the stacks of every thread from a background thread. A sampler
+    backend has start(), stop() and stacks(), the last one returns a dict of
+    root first tuples of frame names to the number of samples.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def run(self):
+        own = threading.current_thread().ident
+        while self.running.is_set():
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{0}:{1}".format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack = tuple(reversed(stack))
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            time.sleep(self.interval)
+
+    def stacks(self):
+        return dict(self.counts)
+
+
+SAMPLERS = {
+    "thread": ThreadSampler,
+}
+
+
+def register_sampler(name, sampler_class):
+    SAMPLERS[name] = sampler_class
+
+
+def get_sampler(name):
+    """
+    Return a sampler by registered name or by a module:Class path, for
+    backends living outside of this package.
+    """
+    if name in SAMPLERS:
+        return SAMPLERS[name]()
+    if ":" in name:
+        module, cls = name.split(":", 1)
+        return getattr(importlib.import_module(module), cls)()
+    raise ValueError("Unknown sampler: {0}".format(name))
+
+
+class Phase(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.peak = None
+        self.allocations = []
+
+
+class Profiler(object):
+    """
+    Profile from start() to stop(). Add the profiler as a hook of the
+    tracer to get the allocation report by phase, save() writes
+    <prefix>.pstats, <prefix>.collapsed with a sampler and
+    <prefix>.alloc.txt with tracemalloc.
+    """
+
+    def __init__(self, prefix, sampler=None, top=DEFAULT_PROFILE_TOP):
+        self.prefix = prefix
+        self.sampler = get_sampler(sampler) if sampler else None
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.lock = threading.Lock()
+        self.phases = []
+        self.current_phase = None
+        self.snapshot = None
+
+    def start(self):
+        if tracemalloc is not None:
+            tracemalloc.start()
+            self.snapshot = self.take_snapshot()
+        if self.sampler is not None:
+            self.sampler.start()
+        threading.setprofile(self.profile_thread)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        threading.setprofile(None)
+        if self.sampler is not None:
+            self.sampler.stop()
+        if tracemalloc is not None:
+            if self.current_phase is not None:
+                self.end_phase()
+            tracemalloc.stop()
+
+    def profile_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # python 3.12 profilers already see every thread
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.thread_profiles.append(profile)
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot()
+
+    def is_ignored(self, stat):
+        filename = stat.traceback[0].filename
+        return (filename in TRACEMALLOC_IGNORED_FILES or
+                filename in (tracemalloc.__file__, __file__))
+
+    def is_phase(self, span):
+        return span.parent is not None and span.parent.parent is None
+
+    def span_started(self, span):
+        if tracemalloc is None or not self.is_phase(span):
+            return
+        with self.lock:
+            if self.current_phase is not None:
+                self.end_phase()
+            self.current_phase = Phase(span.name)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+    def span_finished(self, span):
+        if tracemalloc is None or not self.is_phase(span):
+            return
+        with self.lock:
+            if (self.current_phase is not None and
+                    self.current_phase.name == span.name):
+                self.end_phase()
+
+    def end_phase(self):
+        phase = self.current_phase
+        self.current_phase = None
+        phase.duration = time.time() - phase.start
+        phase.peak = tracemalloc.get_traced_memory()[1]
+        snapshot = self.take_snapshot()
+        # filtering the statistics is much cheaper than filtering the traces
+        phase.allocations = [
+            stat for stat in snapshot.compare_to(self.snapshot, "lineno")
+            if not self.is_ignored(stat)][:self.top]
+        self.snapshot = snapshot
+        self.phases.append(phase)
+
+    def stats(self):
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            profiles = list(self.thread_profiles)
+        for profile in profiles:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # the thread never made a call after being profiled
+                pass
+        return stats
+
+    def save(self):
+        """Write the profile files and return their names."""
+        filenames = [self.prefix + PROFILE_STATS_SUFFIX]
+        self.stats().dump_stats(filenames[-1])
+        if self.sampler is not None:
+            filenames.append(self.prefix + PROFILE_COLLAPSED_SUFFIX)
+            with open(filenames[-1], "w") as f:
+                for stack, count in sorted(self.sampler.stacks().items()):
+                    f.write("{0} {1}\n".format(";".join(stack), count))
+        if self.phases:
+            filenames.append(self.prefix + PROFILE_ALLOCATIONS_SUFFIX)
+            with open(filenames[-1], "w") as f:
+                self.write_allocations(f)
+        return filenames
+
+    def write_allocations(self, f):
+        for phase in self.phases:
+            f.write("{0}: {1:.3f} s, peak {2:.1f} KiB\n".format(
+                phase.name, phase.duration, phase.peak / 1024.0))
+            for stat in phase.allocations:
+                frame = stat.traceback[0]
+                f.write("    {0:+10.1f} KiB {1:+8d} blocks  {2}:{3}\n".format(
+                    stat.size_diff / 1024.0, stat.count_diff,
+                    frame.filename, frame.lineno))
@@ -0,0 +1,151 @@
+"""
+Bulk review harvesting.
+
+Reviews of many packages are fetched concurrently page by page and handed
+to a sink in sorted, de-duplicated batches through a bounded queue, so
+memory stays the same whatever the number of reviews is.
+"""
+from __future__ import absolute_import
+import gzip
+import json
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import requests
+from .db import insert_reviews
+from .wire import scan_reviews
+
+__all__ = (
+    'harvest_reviews',
+    'DbReviewSink',
+    'GzipReviewSink',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REVIEW_WORKERS = 4
+DEFAULT_REVIEW_PAGE_SIZE = 100
+DEFAULT_REVIEW_BATCH_SIZE = 1000
+DEFAULT_REVIEW_SORT = 2
+
+
+class DbReviewSink(object):
+    """Store reviews in the review table, ids are unique per package."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def write(self, reviews):
+        insert_reviews(self.db, reviews)
+
+    def close(self):
+        pass
+
+
+class GzipReviewSink(object):
+    """
+    Append reviews to a gzip compressed file, one JSON object a line.
+    Every batch is sorted and de-duplicated on its own, the file is not:
+    a review may be in two batches and the batches follow each other in
+    the order they were harvested. Load the file into the review table
+    (or sort -u it) for a global order without duplicates.
+    """
+
+    def __init__(self, filename):
+        self.file = gzip.open(filename, "ab")
+
+    def write(self, reviews):
+        self.file.writelines(
+            (json.dumps(review._asdict()) + "\n").encode("utf-8")
+            for review in reviews)
+
+    def close(self):
+        self.file.close()
+
+
+def iter_review_pages(api, name, sort=DEFAULT_REVIEW_SORT,
+                      nb_results=DEFAULT_REVIEW_PAGE_SIZE):
+    """
+    Yield the reviews of a package page by page. Reviews already seen on
+    the previous page are dropped, as pages can overlap when new reviews
+    arrive during paging.
+    """
+    path = "rev?doc=%s&sort=%d&n=%d" % (
+        requests.utils.quote(name), sort, nb_results)
+    previous_ids = set()
+    visited = set()
+    while path and path not in visited:
+        visited.add(path)
+        reviews, path = scan_reviews(api.executeRequestRaw(path), name)
+        page = [review for review in reviews if review.id not in previous_ids]
+        previous_ids = set(review.id for review in reviews)
+        if page:
+            yield page
+
+
+def sort_reviews(reviews):
+    """Sort by (package, review id) and drop duplicates."""
+    result = []
+    for review in sorted(reviews, key=lambda review: (review.name, review.id)):
+        if (not result or result[-1].name != review.name or
+                result[-1].id != review.id):
+            result.append(review)
+    return result
+
+
+def harvest_reviews(api, packages, sink, workers=DEFAULT_REVIEW_WORKERS,
+                    batch_size=DEFAULT_REVIEW_BATCH_SIZE,
+                    sort=DEFAULT_REVIEW_SORT,
+                    nb_results=DEFAULT_REVIEW_PAGE_SIZE):
+    """
+    Fetch every review of packages with workers concurrent requests and
+    write them to sink in batches of about batch_size reviews.
+    Returns the number of written reviews.
+    """
+    api.ensure_token()
+    pages = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+
+    def harvest(name):
+        try:
+            for page in iter_review_pages(api, name, sort, nb_results):
+                if stop.is_set():
+                    return
+                pages.put(page)
+        except Exception as err:
+            logger.error("Cannot fetch reviews of {0}: {1}".format(name, err))
+
+    pool = ThreadPool(workers)
+    pool.map_async(
+        harvest, packages, chunksize=1, callback=lambda _: pages.put(None))
+    pool.close()
+    count = 0
+    batch, page = [], []
+    try:
+        while True:
+            page = pages.get()
+            if page is not None:
+                batch.extend(page)
+            if batch and (page is None or len(batch) >= batch_size):
+                batch = sort_reviews(batch)
+                sink.write(batch)
+                count += len(batch)
+                batch = []
+            if page is None:
+                break
+    except BaseException:
+        # unblock the workers before waiting for them
+        stop.set()
+        while page is not None:
+            page = pages.get()
+        raise
+    finally:
+        pool.join()
+        sink.close()
+    logger.info("Harvested {0} reviews of {1} packages".format(
+        count, len(packages)))
+    return count
@@ -0,0 +1,50 @@
+"""
+Ordering of the download plan.
+
+Packages with an explicit priority in the config always go first, the
+policy breaks the remaining ties. Parallel workers take the packages from
+the plan in this order as they become free.
+"""
+from __future__ import absolute_import
+
+__all__ = (
+    'schedule_packages',
+    'SCHEDULE_POLICIES',
+)
+
+SCHEDULE_NAME = "name"
+SCHEDULE_SMALLEST = "smallest"
+SCHEDULE_STALE = "stale"
+SCHEDULE_PRIORITY = "priority"
+SCHEDULE_POLICIES = (
+    SCHEDULE_NAME,
+    SCHEDULE_SMALLEST,
+    SCHEDULE_STALE,
+    SCHEDULE_PRIORITY,
+)
+DEFAULT_SCHEDULE_POLICY = SCHEDULE_NAME
+
+
+def schedule_packages(packages_info, policy=DEFAULT_SCHEDULE_POLICY,
+                      priorities=None, updated=None):
+    """
+    Return the ApkInfo values of packages_info in download order.
+    priorities maps package names to numbers, higher goes first.
+    updated maps package names to the time they were last downloaded and is
+    used by the stale policy, packages never downloaded go first.
+    """
+    if policy not in SCHEDULE_POLICIES:
+        raise ValueError("Unknown schedule policy: {0}".format(policy))
+    priorities = priorities or {}
+    updated = updated or {}
+
+    def key(info):
+        if policy == SCHEDULE_SMALLEST:
+            policy_key = info.size
+        elif policy == SCHEDULE_STALE:
+            policy_key = (info.name in updated, updated.get(info.name))
+        else:
+            policy_key = None
+        return -priorities.get(info.name, 0), policy_key, info.name
+
+    return sorted(packages_info.values(), key=key)
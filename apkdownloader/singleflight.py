@@ -0,0 +1,65 @@
+"""
+Coalescing of duplicate concurrent calls.
+
+When a call with the same key is already running, SingleFlight waits for
+it and returns its result (or raises its error) instead of running the
+call again. Nothing is cached, a call started after the previous one
+finished runs again.
+"""
+from __future__ import absolute_import
+import threading
+
+__all__ = (
+    'SingleFlight',
+)
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) unless a call of the same key is already
+        running. Returns (result, shared), shared is True when the result
+        came from the call of another thread.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        with self.lock:
+            return {"calls": self.calls, "coalesced": self.coalesced}
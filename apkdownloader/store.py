@@ -0,0 +1,177 @@
+"""
+Content-addressed storage of the downloaded apks.
+
+Every apk is stored once as .blobs/<hash[:2]>/<hash> (sha256) inside the
+download directory. The usual {name}.{version}.apk files are hard links to
+the blobs, or symbolic links where hard links are not possible. The blob
+table counts how many apks of the database point to each blob, blobs
+nobody points to are removed by collect().
+"""
+from __future__ import absolute_import
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+from .db import (
+    add_blob,
+    get_blob,
+    get_blobs,
+    get_unreferenced_blobs,
+    delete_blob,
+)
+from .disk import preallocate
+
+__all__ = (
+    'BlobStore',
+)
+
+logger = logging.getLogger(__name__)
+
+BLOBS_DIRECTORY = ".blobs"
+BLOBS_TEMP_DIRECTORY = "tmp"
+
+
+class BlobStore(object):
+
+    def __init__(self, directory, db):
+        self.directory = os.path.normpath(os.path.abspath(directory))
+        self.blobs_directory = os.path.join(self.directory, BLOBS_DIRECTORY)
+        self.temp_directory = os.path.join(
+            self.blobs_directory, BLOBS_TEMP_DIRECTORY)
+        self.db = db
+        if not os.path.isdir(self.temp_directory):
+            os.makedirs(self.temp_directory)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_directory, digest[:2], digest)
+
+    def find(self, size, signature):
+        """
+        Return the hash of a stored blob with this size and server signature,
+        None when it has to be downloaded.
+        """
+        if not size or not signature:
+            return None
+        digest = get_blob(self.db, size, signature)
+        if digest and os.path.isfile(self.blob_path(digest)):
+            return digest
+        return None
+
+    def write(self, chunks, signature="", expected_size=None):
+        """
+        Store the data of the chunks iterable and return (hash, size).
+        Data already stored under the same hash is not kept twice.
+        expected_size bytes are preallocated when given.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_filename = tempfile.mkstemp(dir=self.temp_directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                preallocate(f.fileno(), expected_size)
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                if expected_size:
+                    # drop the preallocated tail of a shorter download
+                    f.truncate()
+            digest = digest.hexdigest()
+            filename = self.blob_path(digest)
+            if os.path.isfile(filename):
+                logger.info("Blob {0} is already stored".format(digest))
+                os.remove(temp_filename)
+            else:
+                if not os.path.isdir(os.path.dirname(filename)):
+                    try:
+                        os.makedirs(os.path.dirname(filename))
+                    except OSError as ex:
+                        if ex.errno != errno.EEXIST:
+                            raise
+                os.rename(temp_filename, filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        add_blob(self.db, digest, size, signature)
+        return digest, size
+
+    def link(self, digest, filename):
+        """Make filename point to the blob, replacing it atomically."""
+        blob_filename = self.blob_path(digest)
+        if (os.path.exists(filename) and
+                os.path.samefile(blob_filename, filename)):
+            return
+        temp_filename = "{0}.{1}.tmp".format(filename, os.getpid())
+        if os.path.lexists(temp_filename):
+            os.remove(temp_filename)
+        try:
+            os.link(blob_filename, temp_filename)
+        except (OSError, AttributeError):
+            os.symlink(
+                os.path.relpath(blob_filename, os.path.dirname(filename)),
+                temp_filename)
+        os.rename(temp_filename, filename)
+
+    def unknown_blobs(self):
+        """Yield the hashes of the stored blobs the database does not know."""
+        known = get_blobs(self.db)
+        for root, dirs, files in os.walk(self.blobs_directory):
+            dirs[:] = [name for name in dirs if name != BLOBS_TEMP_DIRECTORY]
+            for digest in files:
+                if digest not in known:
+                    yield digest
+
+    def linked_blobs(self):
+        """
+        Return the hashes of the blobs symbolic links in the directory point
+        to, they do not count in the number of links of a blob.
+        """
+        blobs_directory = os.path.realpath(self.blobs_directory)
+        digests = set()
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [name for name in dirs if name != BLOBS_DIRECTORY]
+            for name in files:
+                filename = os.path.join(root, name)
+                if not os.path.islink(filename):
+                    continue
+                target = os.path.realpath(filename)
+                if os.path.dirname(os.path.dirname(target)) == \
+                        blobs_directory:
+                    digests.add(os.path.basename(target))
+        return digests
+
+    def collect(self, unknown=False):
+        """
+        Remove the blobs no apk of the database points to. Blobs which
+        still have hard or symbolic links from outside of this database
+        are kept. With unknown, blobs missing from the database (after it
+        was recreated) are removed as well.
+        """
+        removed = 0
+        linked = None
+        digests = get_unreferenced_blobs(self.db)
+        if unknown:
+            digests.extend(self.unknown_blobs())
+        for digest in digests:
+            filename = self.blob_path(digest)
+            try:
+                if os.stat(filename).st_nlink > 1:
+                    continue
+                if linked is None:
+                    linked = self.linked_blobs()
+                if digest in linked:
+                    continue
+                os.remove(filename)
+                removed += 1
+            except (OSError, IOError) as ex:
+                if ex.errno != errno.ENOENT:
+                    logger.error(
+                        'Cannot delete blob {0}: {1}'.format(filename, ex))
+                    continue
+            delete_blob(self.db, digest)
+        if removed:
+            logger.info('Removed {0} unreferenced blobs'.format(removed))
+        return removed
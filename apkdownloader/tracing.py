@@ -0,0 +1,228 @@
+"""
+Timing spans of the run phases.
+
+Spans nest per thread, carry attributes like the package name or byte
+counts and are kept in memory until exported, either as OpenTelemetry
+(OTLP/JSON) spans or as Chrome trace events, which chrome://tracing,
+Perfetto and speedscope show as a timeline or a flame chart. Tracing is off
+until enable_tracing() is called, spans are then no-ops.
+"""
+from __future__ import absolute_import
+import json
+import os
+import random
+import threading
+import time
+
+__all__ = (
+    'Tracer',
+    'enable_tracing',
+    'trace_span',
+)
+
+TRACE_FORMAT_OTLP = "otlp"
+TRACE_FORMAT_CHROME = "chrome"
+TRACE_FORMATS = (TRACE_FORMAT_OTLP, TRACE_FORMAT_CHROME)
+DEFAULT_TRACE_FORMAT = TRACE_FORMAT_OTLP
+TRACE_SERVICE_NAME = "apkdownloader"
+OTLP_STATUS_OK = 1
+OTLP_STATUS_ERROR = 2
+OTLP_SPAN_KIND_INTERNAL = 1
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.span_id = "{0:016x}".format(random.getrandbits(64))
+        self.attributes = attributes
+        self.thread = threading.current_thread().ident
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.tracer.push(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_type is not None:
+            self.error = "{0}: {1}".format(exc_type.__name__, exc_value)
+        self.tracer.pop(self)
+        return False
+
+
+class NullSpan(object):
+
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_id = "{0:032x}".format(random.getrandbits(128))
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.hooks = []
+
+    def stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current(self):
+        """Return the innermost open span of this thread, if any."""
+        stack = self.stack()
+        return stack[-1] if stack else None
+
+    def span(self, name, parent=None, **attributes):
+        """
+        Return a span to use as a context manager. parent defaults to the
+        current span of the thread, it has to be given for spans of worker
+        threads to hang under the span which started them.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        if parent is None or parent is NULL_SPAN:
+            parent = self.current()
+        return Span(self, name, parent, attributes)
+
+    def add_hook(self, hook):
+        """
+        Call hook.span_started(span) and hook.span_finished(span) around
+        every span, the profiler uses it to split its report by phase.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def push(self, span):
+        self.stack().append(span)
+        for hook in self.hooks:
+            hook.span_started(span)
+
+    def pop(self, span):
+        for hook in self.hooks:
+            hook.span_finished(span)
+        stack = self.stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        with self.lock:
+            self.spans.append(span)
+
+    def to_otlp(self):
+        """Return the finished spans as an OTLP/JSON export request."""
+        with self.lock:
+            spans = list(self.spans)
+        return {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({
+                "service.name": TRACE_SERVICE_NAME,
+                "process.pid": os.getpid(),
+            })},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [otlp_span(self.trace_id, span) for span in spans],
+            }],
+        }]}
+
+    def to_chrome(self):
+        """Return the finished spans as Chrome trace complete events."""
+        with self.lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = []
+        for span in sorted(spans, key=lambda span: span.start):
+            args = dict(span.attributes)
+            if span.error is not None:
+                args["error"] = span.error
+            events.append({
+                "name": span.name,
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": (span.end - span.start) * 1e6,
+                "pid": pid,
+                "tid": span.thread,
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, filename, format=DEFAULT_TRACE_FORMAT):
+        if format not in TRACE_FORMATS:
+            raise ValueError("Unknown trace format: {0}".format(format))
+        data = self.to_otlp() if format == TRACE_FORMAT_OTLP else \
+            self.to_chrome()
+        with open(filename, "w") as f:
+            json.dump(data, f)
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 values are strings in OTLP/JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes):
+    return [
+        {"key": key, "value": otlp_value(value)}
+        for key, value in sorted(attributes.items())
+    ]
+
+
+def otlp_span(trace_id, span):
+    data = {
+        "traceId": trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": OTLP_SPAN_KIND_INTERNAL,
+        "startTimeUnixNano": str(int(span.start * 1e9)),
+        "endTimeUnixNano": str(int(span.end * 1e9)),
+        "attributes": otlp_attributes(
+            dict(span.attributes, **{"thread.id": span.thread})),
+        "status": {"code": OTLP_STATUS_OK},
+    }
+    if span.parent is not None:
+        data["parentSpanId"] = span.parent.span_id
+    if span.error is not None:
+        data["status"] = {"code": OTLP_STATUS_ERROR, "message": span.error}
+    return data
+
+
+TRACER = Tracer()
+
+
+def enable_tracing():
+    TRACER.enabled = True
+    return TRACER
+
+
+def trace_span(name, parent=None, **attributes):
+    """Return a span of the global tracer, see Tracer.span."""
+    return TRACER.span(name, parent, **attributes)
@@ -0,0 +1,72 @@
+"""
+HTTP session of the API client.
+
+GooglePlayAPI sends everything through one requests.Session, so
+connections are kept alive and shared by the threads, in the urllib3
+connection pools of requests (HTTP/1.1, one request a connection at a
+time).
+
+warm_up() opens connections ahead of the first requests, so the TCP and
+TLS handshakes overlap with the startup work.
+"""
+from __future__ import absolute_import
+import logging
+import threading
+import time
+import requests
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    from cookielib import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+
+__all__ = (
+    'create_session',
+    'warm_up',
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_WARM_CONNECTIONS = 2
+DEFAULT_WARM_TIMEOUT = 10.0
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    """Return a requests.Session keeping up to pool_size connections a host."""
+    session = requests.Session()
+    # the API does not rely on cookies, keep requests independent
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def warm_up(session, urls, connections=DEFAULT_WARM_CONNECTIONS,
+            timeout=DEFAULT_WARM_TIMEOUT):
+    """
+    Send HEAD requests to urls from daemon threads, so connections to their
+    hosts are open and kept alive in the pools of session by the time of
+    the first real requests. Returns the threads, failures are logged and
+    left to the real requests.
+    """
+    def run(url):
+        start = time.time()
+        try:
+            session.head(url, verify=False, timeout=timeout).close()
+        except requests.RequestException as err:
+            logger.debug("Cannot warm up a connection to {0}: {1}".format(
+                url, err))
+        else:
+            logger.debug("Warmed up a connection to {0} in {1:.3f}s".format(
+                url, time.time() - start))
+
+    threads = []
+    for url in urls:
+        for _ in range(connections):
+            thread = threading.Thread(target=run, args=(url,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    return threads
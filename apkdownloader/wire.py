@@ -0,0 +1,320 @@
+"""
+Minimal reader for the protobuf wire format.
+
+It is used to pull a handful of fields out of large API responses without
+building the whole googleplay_pb2 message tree. Submessages are addressed
+by (start, end) offsets into the original buffer, so nothing is copied
+until a scalar value is actually read.
+"""
+from __future__ import absolute_import
+import hashlib
+from .db import ApkInfo, ReviewInfo
+
+__all__ = (
+    'WireError',
+    'scan_bulk_details',
+    'scan_container_docs',
+    'scan_prefetch',
+    'scan_reviews',
+)
+
+WIRETYPE_VARINT = 0
+WIRETYPE_FIXED64 = 1
+WIRETYPE_LENGTH_DELIMITED = 2
+WIRETYPE_START_GROUP = 3
+WIRETYPE_END_GROUP = 4
+WIRETYPE_FIXED32 = 5
+
+# ResponseWrapper.payload -> Payload.bulkDetailsResponse -> entry
+BULK_DETAILS_ENTRY_PATH = (1, 19, 1)
+# ResponseWrapper.payload -> Payload.searchResponse -> doc
+SEARCH_DOC_PATH = (1, 5, 5)
+# ResponseWrapper.payload -> Payload.listResponse -> doc
+LIST_DOC_PATH = (1, 1, 2)
+# ResponseWrapper.payload -> Payload.reviewResponse
+REVIEW_RESPONSE_PATH = (1, 3)
+# ResponseWrapper.preFetch
+PREFETCH_PATH = (3,)
+BULK_DETAILS_ENTRY_DOC = 1
+PREFETCH_URL = 1
+PREFETCH_RESPONSE = 2
+CONTAINER_NEXT_PAGE_URL = 2
+REVIEW_RESPONSE_GET_RESPONSE = 1
+REVIEW_RESPONSE_NEXT_PAGE_URL = 2
+GET_REVIEWS_REVIEW = 1
+REVIEW_FIELDS = {
+    1: "author",
+    4: "version",
+    5: "timestamp",
+    6: "rating",
+    7: "title",
+    8: "comment",
+    9: "id",
+}
+DOC_DOCID = 1
+DOC_OFFER = 8
+DOC_CHILD = 11
+DOC_CONTAINER_METADATA = 12
+DOC_DETAILS = 13
+OFFER_TYPE = 8
+DETAILS_APP_DETAILS = 1
+APP_DETAILS_VERSION_CODE = 3
+APP_DETAILS_VERSION_STRING = 4
+APP_DETAILS_INSTALLATION_SIZE = 9
+APP_DETAILS_PACKAGE_NAME = 14
+
+
+class WireError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise WireError("Truncated varint at {0}".format(pos))
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise WireError("Too long varint at {0}".format(pos))
+
+
+def skip_group(data, pos, end, number):
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire_type = key & 0x7
+        if wire_type == WIRETYPE_END_GROUP:
+            if key >> 3 != number:
+                raise WireError("Unmatched end group at {0}".format(pos))
+            return pos
+        pos = skip_value(data, pos, end, key >> 3, wire_type)
+    raise WireError("Truncated group {0}".format(number))
+
+
+def skip_value(data, pos, end, number, wire_type):
+    if wire_type == WIRETYPE_VARINT:
+        _, pos = read_varint(data, pos)
+    elif wire_type == WIRETYPE_FIXED64:
+        pos += 8
+    elif wire_type == WIRETYPE_LENGTH_DELIMITED:
+        length, pos = read_varint(data, pos)
+        pos += length
+    elif wire_type == WIRETYPE_START_GROUP:
+        pos = skip_group(data, pos, end, number)
+    elif wire_type == WIRETYPE_FIXED32:
+        pos += 4
+    else:
+        raise WireError("Unknown wire type {0} at {1}".format(wire_type, pos))
+    if pos > end:
+        raise WireError("Field {0} overruns the message".format(number))
+    return pos
+
+
+def iter_fields(data, start=0, end=None):
+    """
+    Yield (number, wire_type, value) for each field of the message stored in
+    data[start:end]. value is an int for varints and a (start, end) tuple
+    for everything else.
+    """
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos < end:
+        # keys and lengths below 128 are by far the most common case
+        key = data[pos]
+        if key & 0x80:
+            key, pos = read_varint(data, pos)
+        else:
+            pos += 1
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == WIRETYPE_LENGTH_DELIMITED:
+            if pos >= end:
+                raise WireError("Truncated field {0}".format(number))
+            length = data[pos]
+            if length & 0x80:
+                length, pos = read_varint(data, pos)
+            else:
+                pos += 1
+            value = (pos, pos + length)
+            pos += length
+            if pos > end:
+                raise WireError("Field {0} overruns the message".format(
+                    number))
+        elif wire_type == WIRETYPE_VARINT:
+            value, pos = read_varint(data, pos)
+        else:
+            value_start = pos
+            pos = skip_value(data, pos, end, number, wire_type)
+            value = (value_start, pos)
+        yield number, wire_type, value
+
+
+def iter_path(data, path, start=0, end=None):
+    """
+    Yield (start, end) extents of every submessage reached by following the
+    field numbers in path. Repeated fields fan out at each level.
+    """
+    if not path:
+        yield start, len(data) if end is None else end
+        return
+    number = path[0]
+    for field, wire_type, value in iter_fields(data, start, end):
+        if field == number and wire_type == WIRETYPE_LENGTH_DELIMITED:
+            for extent in iter_path(data, path[1:], *value):
+                yield extent
+
+
+def _text(data, extent):
+    return data[extent[0]:extent[1]].decode("utf-8")
+
+
+def _signed(value):
+    # int32/int64 negatives are sent as 10-byte two's complement varints
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def scan_app_details(data, start, end):
+    code, version, size, name = 0, "", 0, None
+    for number, wire_type, value in iter_fields(data, start, end):
+        if number == APP_DETAILS_VERSION_CODE:
+            code = _signed(value)
+        elif number == APP_DETAILS_VERSION_STRING:
+            version = _text(data, value)
+        elif number == APP_DETAILS_INSTALLATION_SIZE:
+            size = _signed(value)
+        elif number == APP_DETAILS_PACKAGE_NAME:
+            name = _text(data, value)
+    return code, version, size, name
+
+
+def scan_doc(data, start, end):
+    """
+    Decode the update check fields of a DocV2 message into an ApkInfo.
+    packageName falls back to docid, offerType is taken from the first offer.
+    """
+    docid, offer, app_details = "", None, (0, "", 0, None)
+    for number, wire_type, value in iter_fields(data, start, end):
+        if number == DOC_DOCID:
+            docid = _text(data, value)
+        elif number == DOC_OFFER and offer is None:
+            offer = 0
+            for field, _, offer_value in iter_fields(data, *value):
+                if field == OFFER_TYPE:
+                    offer = _signed(offer_value)
+        elif number == DOC_DETAILS:
+            for extent in iter_path(data, (DETAILS_APP_DETAILS,), *value):
+                app_details = scan_app_details(data, *extent)
+    code, version, size, name = app_details
+    return ApkInfo(name or docid, code, version, offer or 0, size)
+
+
+def _buffer(data):
+    # indexing has to give ints, which python 2 str does not
+    if isinstance(data, bytearray) or bytes is not str:
+        return data
+    return bytearray(data)
+
+
+def scan_bulk_details(data):
+    """
+    Decode a bulkDetails ResponseWrapper into a list of ApkInfo records in
+    the order of the request. Entries without a doc (unknown packages) are
+    returned as None.
+    """
+    data = _buffer(data)
+    result = []
+    for entry in iter_path(data, BULK_DETAILS_ENTRY_PATH):
+        info = None
+        for extent in iter_path(data, (BULK_DETAILS_ENTRY_DOC,), *entry):
+            info = scan_doc(data, *extent)
+        result.append(info)
+    return result
+
+
+def scan_container_docs(data, path):
+    """
+    Decode the child docs of the container docs found at path (for example
+    SEARCH_DOC_PATH or LIST_DOC_PATH) into ApkInfo records.
+    Returns (records, next_page_url), next_page_url is None on the last page.
+    """
+    data = _buffer(data)
+    records, next_page_url = [], None
+    for start, end in iter_path(data, path):
+        for number, wire_type, value in iter_fields(data, start, end):
+            if number == DOC_CHILD:
+                records.append(scan_doc(data, *value))
+            elif number == DOC_CONTAINER_METADATA:
+                for field, _, url in iter_fields(data, *value):
+                    if field == CONTAINER_NEXT_PAGE_URL:
+                        next_page_url = _text(data, url)
+    return records, next_page_url or None
+
+
+def scan_review(data, start, end, name):
+    values = {
+        "author": "", "version": "", "timestamp": 0, "rating": 0,
+        "title": "", "comment": "", "id": "",
+    }
+    for number, wire_type, value in iter_fields(data, start, end):
+        field = REVIEW_FIELDS.get(number)
+        if field is None:
+            continue
+        if wire_type == WIRETYPE_LENGTH_DELIMITED:
+            value = _text(data, value)
+        else:
+            value = _signed(value)
+        values[field] = value
+    if not values["id"]:
+        # reviews are unique by id, derive one for those without it
+        values["id"] = "sha1:" + hashlib.sha1(u"\n".join((
+            values["author"], str(values["timestamp"]),
+            values["comment"])).encode("utf-8")).hexdigest()
+    return ReviewInfo(name=name, **values)
+
+
+def scan_reviews(data, name):
+    """
+    Decode a reviews ResponseWrapper into ReviewInfo records of package name.
+    Returns (records, next_page_url), next_page_url is None on the last page.
+    """
+    data = _buffer(data)
+    records, next_page_url = [], None
+    for start, end in iter_path(data, REVIEW_RESPONSE_PATH):
+        for number, wire_type, value in iter_fields(data, start, end):
+            if number == REVIEW_RESPONSE_GET_RESPONSE:
+                for review_start, review_end in iter_path(
+                        data, (GET_REVIEWS_REVIEW,), *value):
+                    records.append(
+                        scan_review(data, review_start, review_end, name))
+            elif number == REVIEW_RESPONSE_NEXT_PAGE_URL:
+                next_page_url = _text(data, value)
+    return records, next_page_url or None
+
+
+def scan_prefetch(data):
+    """Return the preFetch entries of a ResponseWrapper as (url, bytes)."""
+    data = _buffer(data)
+    result = []
+    for start, end in iter_path(data, PREFETCH_PATH):
+        url, response = None, b""
+        for number, wire_type, value in iter_fields(data, start, end):
+            if number == PREFETCH_URL:
+                url = _text(data, value)
+            elif number == PREFETCH_RESPONSE:
+                response = bytes(data[value[0]:value[1]])
+        if url is not None:
+            result.append((url, response))
+    return result
@@ -0,0 +1,4 @@
+"""
+The fake Google Play server, the network simulator and the benchmarks of
+apkdownloader. They are not a part of the installed package.
+"""
@@ -0,0 +1,659 @@
+"""
+End to end benchmarks of the update pipeline.
+
+Every scenario runs the apk.py flow in a child process against a local
+FakePlayServer: the database is seeded with the current versions of the
+catalog, a part of the packages gets a new release, and the measured run
+checks all the packages and downloads the outdated ones. Wall time,
+requests by endpoint, transferred bytes, peak RSS of the client, its
+database writes, the mean latency of a download (getting the delivery
+data and the transfer) and the time to the first byte of the startup
+requests are saved as JSON, and two result files can be compared.
+
+    python -m benchmarks.bench --output before.json
+    python -m benchmarks.bench --output after.json --compare before.json
+
+With --simulate the scenarios run in process through the network
+simulator instead: update_packages() of apk.py looks up the packages and
+stores the outdated ones, a package failing on an injected reset or 429
+is counted and the others go on. The wall time is the virtual time of the
+simulated network. It scales to 100000 packages.
+
+    python -m benchmarks.bench --simulate --packages 100000 --workers 16
+
+With --stress one GooglePlayAPI is shared by many threads calling details,
+bulkDetails and downloading apks from a local FakePlay which keeps
+expiring the auth token. Every answer is checked, and the threads must
+share one login per token. It exits with 1 on a failure.
+
+    python -m benchmarks.bench --stress 32
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from apkdownloader.db import (
+    create_db,
+    disconnect,
+    update_apk_info,
+    track_writes,
+    get_writes_count,
+    ApkInfo,
+)
+from benchmarks.fakeplay import FakePlay, start_fakeplay
+from apkdownloader.googleplay import GooglePlayAPI
+from benchmarks.netsim import (
+    SimulatedAdapter,
+    simulate_session,
+    constant_latency,
+    lognormal_latency,
+    DEFAULT_SIM_BANDWIDTH,
+    DEFAULT_SIM_CONNECTIONS,
+    DEFAULT_SIM_LATENCY,
+)
+
+__all__ = (
+    'run_scenario',
+    'run_simulation',
+    'run_stress',
+    'run_benchmarks',
+    'compare_results',
+)
+
+logger = logging.getLogger(__name__)
+
+BENCH_PACKAGES = (10, 1000, 10000)
+BENCH_OUTDATED = (0, 10, 100)
+BENCH_APK_SIZES = {
+    "small": 32 * 1024,
+    "large": 2 * 1024 * 1024,
+}
+DEFAULT_BENCH_MAX_BYTES = 2 * 1024 * 1024 * 1024
+BENCH_METRICS = (
+    "wall_time", "requests", "bytes", "peak_rss", "db_writes",
+    "download_latency", "first_byte")
+# requests getting the delivery data of an apk
+ACQUIRE_ENDPOINTS = ("delivery", "purchase")
+# requests of a run before the downloads
+STARTUP_ENDPOINTS = ("auth", "bulkDetails")
+DEFAULT_BENCH_OWNED = 100
+DEFAULT_STRESS_CALLS = 50
+DEFAULT_STRESS_PACKAGES = 1000
+DEFAULT_STRESS_APK_SIZE = 16 * 1024
+DEFAULT_STRESS_BULK_SIZE = 20
+# seconds between two expirations of the auth token
+DEFAULT_STRESS_EXPIRE = 1.0
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scenario_name(packages, outdated, apk_size, owned=DEFAULT_BENCH_OWNED):
+    name = "{0}-packages-{1}-outdated-{2}".format(
+        packages, outdated, apk_size)
+    if owned != DEFAULT_BENCH_OWNED:
+        name += "-{0}-owned".format(owned)
+    return name
+
+
+def outdated_packages(names, outdated):
+    """Pick outdated percents of names, spread over the whole list."""
+    count = len(names) * outdated // 100
+    if not count:
+        return []
+    step = float(len(names)) / count
+    return [names[int(index * step)] for index in range(count)]
+
+
+def seed_db(db, fake):
+    create_db(db)
+    for app in fake.apps.values():
+        update_apk_info(db, ApkInfo(
+            app.name, app.code, "{0}.0".format(app.code), app.offer,
+            app.size))
+    disconnect(db)
+
+
+def write_config(filename, server, db, directory, names, workers):
+    config = {
+        "android_id": "0123456789abcdef",
+        "email": "bench@example.com",
+        "password": "bench",
+        "url_login": server.url_login,
+        "url_api": server.url_api,
+        "db": db,
+        "directory": directory,
+        "apks": names,
+        "workers": workers,
+    }
+    # JSON is valid YAML
+    with open(filename, "w") as f:
+        json.dump(config, f)
+
+
+def run_client(stats_filename, argv):
+    """
+    Run apk.py with argv in this process and write its own numbers and
+    exit code to stats_filename, even when it exits with an error. It is
+    the entry point of the child process, which exits with the same code.
+    """
+    import resource
+    from apkdownloader.db import track_writes, get_writes_count
+    from apkdownloader.metrics import (
+        DOWNLOAD_SECONDS, FIRST_BYTE_SECONDS, REQUEST_SECONDS)
+    from apkdownloader.apk import main
+    track_writes()
+    sys.argv = ["apk.py"] + argv
+    start = time.time()
+    exit_code = 0
+    try:
+        main()
+    except SystemExit as ex:
+        exit_code = ex.code or 0
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    downloads, seconds = DOWNLOAD_SECONDS.get()
+    for endpoint in ACQUIRE_ENDPOINTS:
+        seconds += REQUEST_SECONDS.get(endpoint=endpoint)[1]
+    startup_requests, first_byte = 0, 0.0
+    for endpoint in STARTUP_ENDPOINTS:
+        count, total = FIRST_BYTE_SECONDS.get(endpoint=endpoint)
+        startup_requests += count
+        first_byte += total
+    with open(stats_filename, "w") as f:
+        json.dump({
+            "client_time": elapsed,
+            "peak_rss": peak_rss,
+            "db_writes": get_writes_count(),
+            "download_latency": seconds / downloads if downloads else None,
+            "first_byte": (first_byte / startup_requests
+                           if startup_requests else None),
+            "exit_code": exit_code,
+        }, f)
+    if exit_code:
+        sys.exit(exit_code)
+
+
+def run_scenario(packages, outdated, apk_size, workers=1, latency=0.0,
+                 bandwidth=None, owned=DEFAULT_BENCH_OWNED,
+                 connect_latency=0.0, warm_connections=None, verbose=False):
+    """
+    Run one scenario: packages in the catalog, outdated percents of them
+    with a new version, apks of apk_size bytes, owned percents of them
+    served by delivery without a purchase. Returns a dict of results.
+    """
+    fake = FakePlay(packages=packages, apk_size=apk_size,
+                    owned_rate=owned / 100.0)
+    server = start_fakeplay(fake, latency=latency, bandwidth=bandwidth,
+                            connect_latency=connect_latency)
+    directory = tempfile.mkdtemp(prefix="apkbench")
+    try:
+        db = os.path.join(directory, "apk.db")
+        apks_directory = os.path.join(directory, "apks")
+        os.mkdir(apks_directory)
+        names = list(fake.apps)
+        seed_db(db, fake)
+        fake.release(outdated_packages(names, outdated))
+        config = os.path.join(directory, "apk.yml")
+        write_config(config, server, db, apks_directory, names, workers)
+        client_args = ["--config", config]
+        if warm_connections is not None:
+            # zeros are dropped from config files
+            client_args += ["--warm-connections", str(warm_connections)]
+        stats_filename = os.path.join(directory, "stats.json")
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [PACKAGE_ROOT, env.get("PYTHONPATH")]))
+        output = None if verbose else open(os.devnull, "w")
+        start = time.time()
+        command = [sys.executable, "-m", "benchmarks.bench", "--client",
+                   stats_filename] + client_args
+        try:
+            exit_code = subprocess.call(
+                command, env=env, cwd=directory, stdout=output,
+                stderr=output)
+        finally:
+            if output is not None:
+                output.close()
+        wall_time = time.time() - start
+        if not os.path.isfile(stats_filename):
+            # the client crashed before it could write its numbers
+            raise subprocess.CalledProcessError(exit_code, command)
+        with open(stats_filename) as f:
+            stats = json.load(f)
+        if stats["exit_code"]:
+            logger.warning("Client exited with {0}".format(
+                stats["exit_code"]))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+    result = {
+        "name": scenario_name(packages, outdated, apk_size, owned),
+        "packages": packages,
+        "outdated": outdated,
+        "apk_size": apk_size,
+        "workers": workers,
+        "owned": owned,
+        "wall_time": wall_time,
+        "requests": sum(fake.requests.values()),
+        "requests_by_endpoint": fake.requests,
+        "bytes": fake.bytes_sent,
+    }
+    result.update(stats)
+    return result
+
+
+@contextlib.contextmanager
+def client_output(verbose):
+    """Hide the output and the logs of the apk.py code run in process."""
+    if verbose:
+        yield
+        return
+    stdout = sys.stdout
+    client_logger = logging.getLogger("apkdownloader")
+    level = client_logger.level
+    sys.stdout = open(os.devnull, "w")
+    client_logger.setLevel(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        client_logger.setLevel(level)
+
+
+def run_simulation(packages, outdated, apk_size, workers=1, latency=0.0,
+                   bandwidth=None, owned=DEFAULT_BENCH_OWNED,
+                   connections=DEFAULT_SIM_CONNECTIONS, reset_rate=0.0,
+                   rate_limit=None, seed=0, verbose=False):
+    """
+    Run one scenario against the network simulator in this process:
+    update_packages() of apk.py checks the packages and stores the new
+    versions in a temporary directory, going on when a package fails. When
+    the lookup fails, every outdated package counts as failed.
+    latency is the median of a lognormal distribution. Returns a dict of
+    results, wall_time is the virtual time of the run.
+    """
+    import resource
+    from apkdownloader.apk import update_packages, PACKAGE_ERRORS
+    fake = FakePlay(packages=packages, apk_size=apk_size,
+                    owned_rate=owned / 100.0, rate_limit=rate_limit,
+                    seed=seed)
+    names = list(fake.apps)
+    adapter = SimulatedAdapter(
+        fake, latency=lognormal_latency(latency) if latency else
+        constant_latency(DEFAULT_SIM_LATENCY),
+        bandwidth=bandwidth or DEFAULT_SIM_BANDWIDTH,
+        connections=connections, reset_rate=reset_rate, seed=seed)
+    # the deadline, the hedging and the circuit breakers run on the
+    # virtual time of the requests
+    api = GooglePlayAPI(
+        androidId="0123456789abcdef", email="bench@example.com",
+        password="bench", pool_size=workers, clock=adapter.clock.time)
+    simulate_session(api.session, adapter)
+    directory = tempfile.mkdtemp(prefix="apksim")
+    db = os.path.join(directory, "apk.db")
+    try:
+        apks_directory = os.path.join(directory, "apks")
+        os.mkdir(apks_directory)
+        seed_db(db, fake)
+        released = outdated_packages(names, outdated)
+        fake.release(released)
+        options = {
+            "db": db,
+            "directory": apks_directory,
+            "workers": workers,
+            "dry_run": False,
+            "force": False,
+            "info": False,
+            "recreate": False,
+            "keep_going": True,
+        }
+        track_writes()
+        writes = get_writes_count()
+        start = time.time()
+        error = None
+        with client_output(verbose):
+            try:
+                failures = update_packages(api, options, names)
+            except PACKAGE_ERRORS as err:
+                # the login or the lookup failed, nothing was updated
+                error, failures = err, released
+        real_time = time.time() - start
+        if error is not None:
+            logger.warning("Cannot check the packages: {0}".format(error))
+        writes = get_writes_count() - writes
+    finally:
+        api.close()
+        disconnect(db)
+        shutil.rmtree(directory, ignore_errors=True)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return {
+        "name": scenario_name(
+            packages, outdated, apk_size, owned=owned) + "-simulated",
+        "packages": packages,
+        "outdated": outdated,
+        "apk_size": apk_size,
+        "workers": workers,
+        "owned": owned,
+        "wall_time": adapter.clock.elapsed(),
+        "real_time": real_time,
+        "requests": adapter.stats["requests"],
+        "requests_by_endpoint": fake.requests,
+        "bytes": adapter.stats["bytes"],
+        "connection_waits": adapter.stats["waits"],
+        "resets": adapter.stats["resets"],
+        "failures": len(failures),
+        "error": str(error) if error is not None else None,
+        "peak_rss": peak_rss,
+        "db_writes": writes,
+    }
+
+
+def check_call(api, fake, operation, rng):
+    """Call an operation of api, return a message when its answer is bad."""
+    names = list(fake.apps)
+    if operation == "details":
+        name = rng.choice(names)
+        docid = api.details(name).docV2.docid
+        if docid != name:
+            return "details of {0} returned {1}".format(name, docid)
+    elif operation == "bulkDetails":
+        chosen = rng.sample(names, DEFAULT_STRESS_BULK_SIZE)
+        for name, info in zip(chosen, api.bulkDetailsInfo(chosen)):
+            if info is None or info.name != name or \
+                    info.code != fake.apps[name].code:
+                return "bulkDetails of {0} returned {1}".format(name, info)
+    else:
+        app = fake.apps[rng.choice(names)]
+        response = api.download(app.name, app.code, app.offer)
+        if response.status_code != 200 or len(response.content) != app.size:
+            return "download of {0} returned {1} with {2} bytes".format(
+                app.name, response.status_code, len(response.content))
+    return None
+
+
+def run_stress(threads, calls=DEFAULT_STRESS_CALLS,
+               packages=DEFAULT_STRESS_PACKAGES,
+               expire=DEFAULT_STRESS_EXPIRE, seed=0):
+    """
+    Share one GooglePlayAPI between threads, each making calls random
+    requests to a local FakePlay which expires the auth token every
+    expire seconds. Returns a dict of results, errors lists the failed
+    calls and wrong answers.
+    """
+    fake = FakePlay(packages=packages, apk_size=DEFAULT_STRESS_APK_SIZE,
+                    seed=seed)
+    server = start_fakeplay(fake)
+    api = GooglePlayAPI(
+        androidId="0123456789abcdef", email="bench@example.com",
+        password="bench", url_login=server.url_login,
+        url_api=server.url_api, pool_size=threads)
+    errors = []
+    expirations = [0]
+    done = threading.Event()
+
+    def expire_tokens():
+        while not done.wait(expire):
+            fake.expire_tokens()
+            expirations[0] += 1
+
+    def hammer(index):
+        rng = random.Random(seed + index)
+        for _ in range(calls):
+            operation = rng.choice(("details", "bulkDetails", "download"))
+            try:
+                error = check_call(api, fake, operation, rng)
+            except Exception as err:
+                error = "{0} failed: {1!r}".format(operation, err)
+            if error is not None:
+                errors.append(error)
+
+    expirer = threading.Thread(target=expire_tokens)
+    expirer.daemon = True
+    workers = [threading.Thread(target=hammer, args=(index,))
+               for index in range(threads)]
+    start = time.time()
+    try:
+        expirer.start()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall_time = time.time() - start
+        done.set()
+        expirer.join()
+    finally:
+        done.set()
+        api.close()
+        server.shutdown()
+        server.server_close()
+    logins = fake.requests.get("auth", 0)
+    if logins > expirations[0] + 1:
+        errors.append("{0} logins for {1} tokens".format(
+            logins, expirations[0] + 1))
+    return {
+        "name": "stress-{0}-threads".format(threads),
+        "threads": threads,
+        "calls": threads * calls,
+        "wall_time": wall_time,
+        "requests": sum(fake.requests.values()),
+        "requests_by_endpoint": fake.requests,
+        "logins": logins,
+        "expirations": expirations[0],
+        "errors": errors,
+    }
+
+
+def run_benchmarks(packages=BENCH_PACKAGES, outdated=BENCH_OUTDATED,
+                   sizes=tuple(BENCH_APK_SIZES), workers=1, latency=0.0,
+                   bandwidth=None, owned=DEFAULT_BENCH_OWNED,
+                   connect_latency=0.0, warm_connections=None, simulate=False,
+                   connections=DEFAULT_SIM_CONNECTIONS, reset_rate=0.0,
+                   rate_limit=None, max_bytes=DEFAULT_BENCH_MAX_BYTES,
+                   verbose=False):
+    """
+    Run every combination of the scenario parameters. Scenarios which
+    would download more than max_bytes are skipped. With simulate, they
+    run against the network simulator, which has connections a host,
+    resets reset_rate of the requests and answers 429 beyond rate_limit
+    requests a second.
+    """
+    results = []
+    if simulate:
+        for count in packages:
+            for percent in outdated:
+                for size in sizes:
+                    apk_size = BENCH_APK_SIZES[size]
+                    name = scenario_name(count, percent, size, owned=owned)
+                    if count * percent // 100 * apk_size > max_bytes:
+                        logger.warning("Skip {0}: more than {1} bytes".format(
+                            name, max_bytes))
+                        continue
+                    logger.info("Simulate {0}".format(name))
+                    results.append(run_simulation(
+                        count, percent, apk_size, workers=workers,
+                        latency=latency, bandwidth=bandwidth, owned=owned,
+                        connections=connections, reset_rate=reset_rate,
+                        rate_limit=rate_limit, verbose=verbose))
+        return results
+    for count in packages:
+        for percent in outdated:
+            for size in sizes:
+                apk_size = BENCH_APK_SIZES[size]
+                name = scenario_name(count, percent, size, owned)
+                if count * percent // 100 * apk_size > max_bytes:
+                    logger.warning("Skip {0}: more than {1} bytes".format(
+                        name, max_bytes))
+                    continue
+                logger.info("Run {0}".format(name))
+                result = run_scenario(
+                    count, percent, apk_size, workers=workers,
+                    latency=latency, bandwidth=bandwidth, owned=owned,
+                    connect_latency=connect_latency,
+                    warm_connections=warm_connections, verbose=verbose)
+                result["name"] = name
+                results.append(result)
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=PACKAGE_ROOT,
+            stderr=open(os.devnull, "w")).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous, current):
+    """
+    Return (name, metric, previous, current, ratio) for the scenarios of
+    both result lists.
+    """
+    previous = dict((result["name"], result) for result in previous)
+    rows = []
+    for result in current:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        for metric in BENCH_METRICS:
+            if metric not in old or metric not in result:
+                continue
+            ratio = None
+            if old[metric] and result[metric] is not None:
+                ratio = float(result[metric]) / old[metric]
+            rows.append(
+                (result["name"], metric, old[metric], result[metric], ratio))
+    return rows
+
+
+def print_results(results):
+    print("{0:<40}{1:>10}{2:>10}{3:>14}{4:>12}{5:>10}{6:>10}".format(
+        "scenario", "time", "requests", "bytes", "rss", "writes",
+        "latency"))
+    for result in results:
+        latency = result.get("download_latency")
+        print("{0[name]:<40}{0[wall_time]:>10.2f}{0[requests]:>10}"
+              "{0[bytes]:>14}{0[peak_rss]:>12}{0[db_writes]:>10}{1:>10}".
+              format(result, "{0:.4f}".format(latency)
+                     if latency is not None else "-"))
+
+
+def print_comparison(rows):
+    for name, metric, old, new, ratio in rows:
+        print("{0:<40}{1:<12}{2:>14}{3:>14}{4:>10}".format(
+            name, metric, old, new,
+            "{0:+.1%}".format(ratio - 1) if ratio is not None else "-"))
+
+
+def print_stress(result):
+    print("{0[name]}: {0[calls]} calls in {0[wall_time]:.2f}s, "
+          "{0[requests]} requests, {0[logins]} logins for {0[expirations]} "
+          "expired tokens, {1} errors".format(result, len(result["errors"])))
+    for error in result["errors"]:
+        print("  {0}".format(error))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--client":
+        run_client(sys.argv[2], sys.argv[3:])
+        return
+    parser = argparse.ArgumentParser(
+        prog="bench", description="End to end benchmarks of apk.py")
+    parser.add_argument(
+        "--packages", type=int, nargs="+", default=list(BENCH_PACKAGES))
+    parser.add_argument(
+        "--outdated", type=int, nargs="+", default=list(BENCH_OUTDATED),
+        help="Percents of packages with a new version")
+    parser.add_argument(
+        "--sizes", nargs="+", choices=sorted(BENCH_APK_SIZES),
+        default=sorted(BENCH_APK_SIZES))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="Seconds added to every request of the fake server")
+    parser.add_argument(
+        "--bandwidth", type=int,
+        help="Bytes per second per connection of the fake server")
+    parser.add_argument(
+        "--connect-latency", type=float, default=0.0,
+        help="Seconds added to every new connection of the fake server")
+    parser.add_argument(
+        "--warm-connections", type=int,
+        help="Connections the client opens ahead of the first requests")
+    parser.add_argument(
+        "--owned", type=int, default=DEFAULT_BENCH_OWNED,
+        help="Percents of packages the account owns, the others are "
+             "purchased")
+    parser.add_argument(
+        "--simulate", action="store_true", default=False,
+        help="Run in process against the network simulator")
+    parser.add_argument(
+        "--connections", type=int, default=DEFAULT_SIM_CONNECTIONS,
+        help="Connections a host of the simulator")
+    parser.add_argument(
+        "--reset-rate", type=float, default=0.0,
+        help="Fraction of simulated requests failing with a reset")
+    parser.add_argument(
+        "--rate-limit", type=float,
+        help="Simulated requests per second before answering with 429")
+    parser.add_argument(
+        "--stress", type=int, metavar="THREADS",
+        help="Share one API instance between threads and check it")
+    parser.add_argument(
+        "--calls", type=int, default=DEFAULT_STRESS_CALLS,
+        help="Calls of every thread of the stress run")
+    parser.add_argument(
+        "--max-bytes", type=int, default=DEFAULT_BENCH_MAX_BYTES,
+        help="Skip scenarios downloading more")
+    parser.add_argument("--output", help="Save the results to a JSON file")
+    parser.add_argument(
+        "--compare", help="Compare with the results of a JSON file")
+    parser.add_argument("--verbose", action="store_true", default=False)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.stress:
+        result = run_stress(args.stress, args.calls)
+        print_stress(result)
+        if result["errors"]:
+            sys.exit(1)
+        return
+    results = run_benchmarks(
+        packages=args.packages, outdated=args.outdated, sizes=args.sizes,
+        workers=args.workers, latency=args.latency, bandwidth=args.bandwidth,
+        owned=args.owned, connect_latency=args.connect_latency,
+        warm_connections=args.warm_connections, simulate=args.simulate,
+        connections=args.connections, reset_rate=args.reset_rate,
+        rate_limit=args.rate_limit, max_bytes=args.max_bytes,
+        verbose=args.verbose)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "revision": get_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.time(),
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(compare_results(json.load(f)["results"], results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,553 @@
+"""
+Local stand-in for the Google Play API.
+
+FakePlay answers the requests sent by GooglePlayAPI (auth, details,
+bulkDetails, search, list, browse, rev, delivery and purchase) from a
+synthetic catalog, and serves the apks themselves from generated blobs. It
+can inject server errors, throttle clients with 429 responses, expire
+the auth tokens given so far and the download cookies of past purchases.
+FakePlayServer puts it behind a local HTTP server with configurable
+latency and bandwidth.
+
+    python -m benchmarks.fakeplay --port 8000 --packages 1000
+
+and point the client to it with the url_login and url_api options.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import base64
+import hashlib
+import logging
+import random
+import threading
+import time
+from collections import namedtuple, OrderedDict
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse, quote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote
+    from urlparse import parse_qs, urlparse
+from apkdownloader import googleplay_pb2
+from apkdownloader.mirror import parse_range
+
+__all__ = (
+    'FakePlay',
+    'FakePlayServer',
+    'start_fakeplay',
+)
+
+logger = logging.getLogger(__name__)
+
+FAKE_AUTH_TOKEN = "fakeplay-token"
+FAKE_COOKIE_NAME = "MarketDA"
+DEFAULT_FAKE_PACKAGES = 100
+DEFAULT_FAKE_APK_SIZE = 1024 * 1024
+DEFAULT_FAKE_CATEGORIES = ("GAME", "TOOLS", "COMMUNICATION")
+FAKE_SUBCATEGORIES = ("apps_topselling_free", "apps_topselling_paid")
+DEFAULT_FAKE_PAGE_SIZE = 20
+DEFAULT_FAKE_REVIEWS = 20
+FAKE_BLOB_BLOCK_SIZE = 64 * 1024
+FAKE_DESCRIPTION = "<p>{0}</p>".format("Synthetic application. " * 40)
+FAKE_IMAGES = 8
+
+FakeApp = namedtuple("FakeApp", ["name", "code", "size", "offer", "category"])
+FakeResponse = namedtuple(
+    "FakeResponse", ["status", "headers", "body", "size"])
+
+
+def blob_chunks(name, code, start, end):
+    """Yield the bytes start..end (included) of the synthetic apk."""
+    seed = hashlib.sha256("{0}:{1}".format(name, code).encode("utf-8"))
+    block = seed.digest() * (FAKE_BLOB_BLOCK_SIZE // seed.digest_size)
+    pos = start
+    while pos <= end:
+        offset = pos % len(block)
+        chunk = block[offset:offset + end - pos + 1]
+        pos += len(chunk)
+        yield chunk
+
+
+class FakePlay(object):
+    """
+    Synthetic Google Play catalog answering raw requests.
+    handle() returns a FakeResponse whose body is either bytes or an
+    iterable of chunks for apk downloads. clock is used for rate limiting
+    and can be replaced by a virtual one. owned_rate is the fraction of the
+    apps the account owns, delivery answers only for them and purchased
+    ones.
+    """
+
+    def __init__(self, packages=DEFAULT_FAKE_PACKAGES,
+                 apk_size=DEFAULT_FAKE_APK_SIZE,
+                 categories=DEFAULT_FAKE_CATEGORIES,
+                 reviews=DEFAULT_FAKE_REVIEWS,
+                 error_rate=0.0, rate_limit=None, owned_rate=1.0, seed=0,
+                 clock=time.time, base_url="http://127.0.0.1"):
+        self.apps = OrderedDict()
+        self.categories = list(categories)
+        self.reviews = reviews
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self.base_url = base_url
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = rate_limit
+        self.tokens_time = None
+        self.requests = {}
+        self.bytes_sent = 0
+        self.delivery_generation = 0
+        self.token_generation = 0
+        self.owned = set()
+        for index in range(packages):
+            name = "com.fakeplay.app{0:05d}".format(index)
+            self.add_app(
+                name, size=apk_size,
+                category=self.categories[index % len(self.categories)])
+            if owned_rate >= 1 or self.random.random() < owned_rate:
+                self.owned.add(name)
+
+    def add_app(self, name, code=1, size=DEFAULT_FAKE_APK_SIZE, offer=1,
+                category=None):
+        self.apps[name] = FakeApp(
+            name, code, size, offer, category or self.categories[0])
+
+    def release(self, names):
+        """Publish a new version of the apps."""
+        for name in names:
+            self.apps[name] = self.apps[name]._replace(
+                code=self.apps[name].code + 1)
+
+    def expire_deliveries(self):
+        """Make the download cookies of the past purchases invalid."""
+        with self.lock:
+            self.delivery_generation += 1
+
+    def expire_tokens(self):
+        """Make the auth tokens given so far invalid, as after a day."""
+        with self.lock:
+            self.token_generation += 1
+
+    def _auth_token(self):
+        return "{0}.{1}".format(FAKE_AUTH_TOKEN, self.token_generation)
+
+    def _delivery_cookie(self):
+        return "{0}.{1}".format(FAKE_AUTH_TOKEN, self.delivery_generation)
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+
+    def _count(self, endpoint, size):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent += size
+
+    def _throttled(self):
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = self.clock()
+            if self.tokens_time is not None:
+                self.tokens = min(
+                    self.rate_limit,
+                    self.tokens + (now - self.tokens_time) * self.rate_limit)
+            self.tokens_time = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+    def _failed(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def handle(self, method, path, body=b"", headers=None):
+        headers = headers or {}
+        url = urlparse(path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "auth":
+            endpoint = "auth"
+        elif parts[0] == "fdfe" and len(parts) == 2:
+            endpoint = parts[1]
+        elif parts[0] == "blob" and len(parts) == 3:
+            endpoint = "blob"
+        else:
+            endpoint = None
+        if self._throttled():
+            response = self._text(429, "Too many requests")
+        elif self._failed():
+            response = self._text(500, "Injected error")
+        elif endpoint == "auth":
+            response = self._text(
+                200, "SID=fake\nLSID=fake\nAuth={0}\n".format(
+                    self._auth_token()))
+        elif endpoint == "blob":
+            response = self._blob(parts[1], parts[2], headers)
+        elif endpoint not in API_ENDPOINTS:
+            response = self._text(404, "Not found")
+        elif headers.get("Authorization") != "GoogleLogin auth={0}".format(
+                self._auth_token()):
+            response = self._text(401, "Unauthorized")
+        else:
+            if method == "POST" and endpoint != "bulkDetails":
+                query.update((k, v[0]) for k, v in parse_qs(
+                    body.decode("utf-8")).items())
+            message = googleplay_pb2.ResponseWrapper()
+            status = API_ENDPOINTS[endpoint](self, message, query, body)
+            data = message.SerializeToString()
+            response = FakeResponse(
+                status, {"Content-Type": "application/x-protobuf"}, data,
+                len(data))
+        self._count(endpoint or "unknown", response.size)
+        return response
+
+    def _text(self, status, text):
+        data = text.encode("utf-8")
+        return FakeResponse(
+            status, {"Content-Type": "text/plain"}, data, len(data))
+
+    def _blob(self, name, code, headers):
+        app = self.apps.get(name)
+        if app is None or not code.isdigit():
+            return self._text(404, "Not found")
+        cookie = "{0}={1}".format(FAKE_COOKIE_NAME, self._delivery_cookie())
+        if cookie not in (headers.get("Cookie") or "").split("; "):
+            return self._text(403, "Download cookie has expired")
+        try:
+            byte_range = parse_range(headers.get("Range"), app.size)
+        except ValueError:
+            return self._text(416, "Range not satisfiable")
+        response_headers = {
+            "Content-Type": "application/vnd.android.package-archive",
+            "Accept-Ranges": "bytes",
+        }
+        status = 200
+        start, end = 0, app.size - 1
+        if byte_range is not None:
+            status = 206
+            start, end = byte_range
+            response_headers["Content-Range"] = "bytes {0}-{1}/{2}".format(
+                start, end, app.size)
+        return FakeResponse(
+            status, response_headers, blob_chunks(name, code, start, end),
+            end - start + 1)
+
+    def _fill_doc(self, doc, app):
+        doc.docid = app.name
+        doc.backendDocid = app.name
+        doc.docType = 1
+        doc.backendId = 3
+        doc.title = app.name.split(".")[-1]
+        doc.creator = "Fakeplay"
+        doc.descriptionHtml = FAKE_DESCRIPTION
+        offer = doc.offer.add()
+        offer.offerType = app.offer
+        offer.micros = 0
+        offer.currencyCode = "USD"
+        offer.formattedAmount = "Free"
+        for index in range(FAKE_IMAGES):
+            image = doc.image.add()
+            image.imageType = index
+            image.imageUrl = "{0}/image/{1}/{2}".format(
+                self.base_url, app.name, index)
+        details = doc.details.appDetails
+        details.packageName = app.name
+        details.versionCode = app.code
+        details.versionString = "{0}.0".format(app.code)
+        details.installationSize = app.size
+        details.developerName = "Fakeplay"
+        details.appCategory.append(app.category)
+        doc.aggregateRating.starRating = 4.0
+        doc.detailsUrl = "details?doc={0}".format(app.name)
+
+    def _fill_container(self, doc, apps, query, path):
+        size = int(query.get("n", DEFAULT_FAKE_PAGE_SIZE))
+        offset = int(query.get("o", 0))
+        for app in apps[offset:offset + size]:
+            self._fill_doc(doc.child.add(), app)
+        if offset + size < len(apps):
+            doc.containerMetadata.nextPageUrl = "{0}&n={1}&o={2}".format(
+                path, size, offset + size)
+        doc.containerMetadata.estimatedResults = len(apps)
+
+    def details(self, message, query, body):
+        app = self.apps.get(query.get("doc"))
+        if app is None:
+            return 404
+        self._fill_doc(message.payload.detailsResponse.docV2, app)
+        return 200
+
+    def bulk_details(self, message, query, body):
+        request = googleplay_pb2.BulkDetailsRequest.FromString(body)
+        response = message.payload.bulkDetailsResponse
+        for name in request.docid:
+            entry = response.entry.add()
+            if name in self.apps:
+                self._fill_doc(entry.doc, self.apps[name])
+        return 200
+
+    def search(self, message, query, body):
+        text = query.get("q", "")
+        apps = [app for app in self.apps.values() if text in app.name]
+        doc = message.payload.searchResponse.doc.add()
+        doc.docid = "search"
+        self._fill_container(
+            doc, apps, query, "search?c=3&q={0}".format(quote(text)))
+        return 200
+
+    def browse(self, message, query, body):
+        response = message.payload.browseResponse
+        for category in self.categories:
+            link = response.category.add()
+            link.name = category.title()
+            link.dataUrl = "browse?c=3&cat={0}".format(category)
+        return 200
+
+    def list(self, message, query, body):
+        category = query.get("cat")
+        subcategory = query.get("ctr")
+        if category not in self.categories:
+            return 404
+        response = message.payload.listResponse
+        if subcategory is None:
+            for name in FAKE_SUBCATEGORIES:
+                response.doc.add().docid = name
+            return 200
+        if subcategory not in FAKE_SUBCATEGORIES:
+            return 404
+        apps = [app for app in self.apps.values() if app.category == category]
+        if subcategory != FAKE_SUBCATEGORIES[0]:
+            apps.reverse()
+        doc = response.doc.add()
+        doc.docid = subcategory
+        self._fill_container(doc, apps, query, "list?c=3&cat={0}&ctr={1}".
+                             format(category, subcategory))
+        return 200
+
+    def reviews_page(self, message, query, body):
+        name = query.get("doc")
+        if name not in self.apps:
+            return 404
+        size = int(query.get("n", DEFAULT_FAKE_PAGE_SIZE))
+        offset = int(query.get("o", 0))
+        response = message.payload.reviewResponse
+        for index in range(offset, min(offset + size, self.reviews)):
+            review = response.getResponse.review.add()
+            review.commentId = "{0}:{1}".format(name, index)
+            review.authorName = "user{0}".format(index)
+            review.documentVersion = str(self.apps[name].code)
+            review.timestampMsec = 1000 * index
+            review.starRating = 1 + index % 5
+            review.title = "Review {0}".format(index)
+            review.comment = "Synthetic review."
+        response.getResponse.matchingCount = self.reviews
+        if offset + size < self.reviews:
+            response.nextPageUrl = "rev?doc={0}&sort={1}&n={2}&o={3}".format(
+                name, query.get("sort", 2), size, offset + size)
+        return 200
+
+    def _fill_delivery(self, delivery, app, code):
+        delivery.downloadSize = app.size
+        delivery.signature = base64.urlsafe_b64encode(hashlib.sha1(
+            "{0}:{1}:{2}".format(app.name, code, app.size).encode("utf-8")
+        ).digest()).decode("ascii").rstrip("=")
+        delivery.downloadUrl = "{0}/blob/{1}/{2}".format(
+            self.base_url, app.name, code)
+        cookie = delivery.downloadAuthCookie.add()
+        cookie.name = FAKE_COOKIE_NAME
+        cookie.value = self._delivery_cookie()
+
+    def delivery(self, message, query, body):
+        app = self.apps.get(query.get("doc"))
+        if app is None:
+            return 404
+        response = message.payload.deliveryResponse
+        with self.lock:
+            owned = app.name in self.owned
+        if not owned:
+            # not owned, the client has to purchase the app
+            response.status = 2
+            return 200
+        response.status = 1
+        self._fill_delivery(
+            response.appDeliveryData, app, int(query.get("vc", app.code)))
+        return 200
+
+    def purchase(self, message, query, body):
+        app = self.apps.get(query.get("doc"))
+        if app is None:
+            return 404
+        with self.lock:
+            self.owned.add(app.name)
+        status = message.payload.buyResponse.purchaseStatusResponse
+        status.status = 1
+        self._fill_delivery(
+            status.appDeliveryData, app, int(query.get("vc", app.code)))
+        return 200
+
+
+API_ENDPOINTS = {
+    "details": FakePlay.details,
+    "bulkDetails": FakePlay.bulk_details,
+    "search": FakePlay.search,
+    "browse": FakePlay.browse,
+    "list": FakePlay.list,
+    "rev": FakePlay.reviews_page,
+    "delivery": FakePlay.delivery,
+    "purchase": FakePlay.purchase,
+}
+
+
+class FakePlayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes on kept alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # stands for the TCP and TLS handshakes of a new connection
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        server.delay()
+        response = server.fake.handle(self.command, self.path, body,
+                                      self.headers)
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(response.size))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        if isinstance(response.body, bytes):
+            self.wfile.write(response.body)
+            return
+        for chunk in response.body:
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(float(len(chunk)) / server.bandwidth)
+
+
+class FakePlayServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server for a FakePlay. Every request waits latency seconds
+    (plus up to latency_jitter), every new connection connect_latency
+    seconds, apk bodies are sent at bandwidth bytes per second per
+    connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, fake, latency=0.0, latency_jitter=0.0,
+                 bandwidth=None, connect_latency=0.0):
+        HTTPServer.__init__(self, address, FakePlayHandler)
+        self.fake = fake
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.latency_jitter = latency_jitter
+        self.bandwidth = bandwidth
+        self.random = random.Random()
+        host, port = self.server_address[:2]
+        self.base_url = "http://{0}:{1}".format(host, port)
+        fake.base_url = self.base_url
+
+    @property
+    def url_login(self):
+        return "{0}/auth".format(self.base_url)
+
+    @property
+    def url_api(self):
+        return "{0}/fdfe/".format(self.base_url)
+
+    def delay(self):
+        latency = self.latency
+        if self.latency_jitter:
+            latency += self.random.uniform(0, self.latency_jitter)
+        if latency:
+            time.sleep(latency)
+
+
+def start_fakeplay(fake=None, host="127.0.0.1", port=0, **kwargs):
+    """
+    Start a FakePlayServer in a daemon thread and return it.
+    Keyword arguments are passed to FakePlayServer.
+    """
+    server = FakePlayServer((host, port), fake or FakePlay(), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fakeplay", description="Local stand-in for Google Play API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--packages", type=int, default=DEFAULT_FAKE_PACKAGES)
+    parser.add_argument("--apk-size", type=int, default=DEFAULT_FAKE_APK_SIZE)
+    parser.add_argument("--reviews", type=int, default=DEFAULT_FAKE_REVIEWS)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per request")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument(
+        "--connect-latency", type=float, default=0.0,
+        help="Seconds per new connection")
+    parser.add_argument(
+        "--bandwidth", type=int, help="Bytes per second per connection")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0,
+        help="Fraction of requests answered with 500")
+    parser.add_argument(
+        "--rate-limit", type=float,
+        help="Requests per second before answering with 429")
+    parser.add_argument(
+        "--owned-rate", type=float, default=1.0,
+        help="Fraction of apps served by delivery without a purchase")
+    args = parser.parse_args()
+    fake = FakePlay(
+        packages=args.packages, apk_size=args.apk_size, reviews=args.reviews,
+        error_rate=args.error_rate, rate_limit=args.rate_limit,
+        owned_rate=args.owned_rate)
+    server = FakePlayServer(
+        (args.host, args.port), fake, latency=args.latency,
+        latency_jitter=args.latency_jitter, bandwidth=args.bandwidth,
+        connect_latency=args.connect_latency)
+    print("url_login: {0}\nurl_api: {1}".format(
+        server.url_login, server.url_api))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
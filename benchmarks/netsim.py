@@ -0,0 +1,223 @@
+"""
+In-process network simulator.
+
+SimulatedAdapter is a requests transport adapter answering from a FakePlay
+without sockets or sleeping. Every request is given a latency drawn from a
+distribution, a transfer time from the bandwidth, and a connection slot of
+its host, of which there are only so many. Connection resets are injected
+at a rate, 429 bursts come from the rate limit of the FakePlay, which runs
+on the same virtual clock.
+
+The VirtualClock keeps the virtual time of every thread: a request starts
+when both its thread and a connection of the host are free and moves the
+thread to its end. The time of the whole run is the latest of the threads,
+so the effect of the scheduler, of concurrency and of the network on the
+run time is measured without waiting for it: only the client and the
+FakePlay take real time. With one thread and a seed the outcome is
+deterministic.
+
+    simulator = SimulatedAdapter(FakePlay(packages=100000), seed=1)
+    simulate_session(api.session, simulator)
+"""
+from __future__ import absolute_import
+import io
+import math
+import random
+import threading
+import requests
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+__all__ = (
+    'SimulatedAdapter',
+    'VirtualClock',
+    'simulate_session',
+    'constant_latency',
+    'lognormal_latency',
+    'uniform_latency',
+)
+
+DEFAULT_SIM_LATENCY = 0.05
+DEFAULT_SIM_BANDWIDTH = 10 * 1024 * 1024
+DEFAULT_SIM_CONNECTIONS = 10
+
+
+def constant_latency(seconds):
+    return lambda rng: seconds
+
+
+def uniform_latency(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.5):
+    """Latencies around median with a long tail, typical of the Internet."""
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+class VirtualClock(object):
+    """
+    Virtual time of every thread, starting at 0. A new thread starts at the
+    current time of the thread which created the clock, as the threads of a
+    pool started by the code it runs.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latest = 0.0
+        self.base = 0.0
+        self.owner = threading.current_thread()
+
+    def time(self):
+        return getattr(self.local, "now", self.base)
+
+    def advance_to(self, when):
+        self.local.now = when
+        with self.lock:
+            self.latest = max(self.latest, when)
+            if threading.current_thread() is self.owner:
+                self.base = when
+
+    def sleep(self, seconds):
+        self.advance_to(self.time() + seconds)
+
+    def elapsed(self):
+        """Virtual time to the end of the latest thread."""
+        with self.lock:
+            return self.latest
+
+    def sync(self):
+        """
+        Move every thread to the latest time, as when the calling thread
+        waits for the others. Threads start from there.
+        """
+        with self.lock:
+            self.base = self.latest
+        self.local = threading.local()
+
+
+class ChunksRaw(io.RawIOBase):
+    """File-like body of a simulated response over an iterable of chunks."""
+
+    def __init__(self, chunks):
+        super(ChunksRaw, self).__init__()
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+        count = min(len(buffer), len(self.buffer))
+        buffer[:count] = self.buffer[:count]
+        self.buffer = self.buffer[count:]
+        return count
+
+    def stream(self, amt=None, decode_content=True):
+        if self.buffer:
+            yield self.buffer
+            self.buffer = b""
+        for chunk in self.chunks:
+            yield chunk
+
+    def release_conn(self):
+        pass
+
+
+class SimulatedAdapter(BaseAdapter):
+    """
+    Transport adapter answering the requests from fake, a FakePlay. latency
+    is a function of a random.Random returning seconds, bandwidth is in
+    bytes per second per connection, connections is the number of
+    connections a host, reset_rate the fraction of requests failing with a
+    connection reset.
+    """
+
+    def __init__(self, fake, latency=constant_latency(DEFAULT_SIM_LATENCY),
+                 bandwidth=DEFAULT_SIM_BANDWIDTH,
+                 connections=DEFAULT_SIM_CONNECTIONS, reset_rate=0.0,
+                 clock=None, seed=0):
+        super(SimulatedAdapter, self).__init__()
+        self.fake = fake
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.connections = connections
+        self.reset_rate = reset_rate
+        self.clock = clock or VirtualClock()
+        fake.clock = self.clock.time
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # virtual times the connections of every host are free at
+        self.slots = {}
+        self.stats = {"requests": 0, "bytes": 0, "resets": 0, "waits": 0.0}
+
+    def acquire(self, host, now):
+        """Return the index and free time of the first free connection."""
+        slots = self.slots.setdefault(host, [0.0] * self.connections)
+        index = min(range(len(slots)), key=lambda index: slots[index])
+        return index, max(now, slots[index])
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        url = urlsplit(request.url)
+        path = url.path + ("?" + url.query if url.query else "")
+        body = request.body or b""
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        now = self.clock.time()
+        with self.lock:
+            index, start = self.acquire(url.netloc, now)
+            latency = self.latency(self.random)
+            reset = self.reset_rate and self.random.random() < self.reset_rate
+            self.stats["waits"] += start - now
+            # the server sees the request after half the round trip
+            self.clock.advance_to(start + latency / 2)
+            response = None
+            if not reset:
+                response = self.fake.handle(
+                    request.method, path, body, request.headers)
+            size = response.size if response is not None else 0
+            end = start + latency + float(size) / self.bandwidth
+            self.slots[url.netloc][index] = end
+            self.stats["requests"] += 1
+            self.stats["bytes"] += size
+            if reset:
+                self.stats["resets"] += 1
+        self.clock.advance_to(end)
+        if response is None:
+            raise requests.ConnectionError(
+                "Simulated connection reset", request=request)
+        result = requests.Response()
+        result.status_code = response.status
+        result.headers = CaseInsensitiveDict(response.headers)
+        result.headers["Content-Length"] = str(response.size)
+        result.url = request.url
+        result.request = request
+        result.connection = self
+        if isinstance(response.body, bytes):
+            result.raw = io.BytesIO(response.body)
+        else:
+            result.raw = ChunksRaw(response.body)
+        if not stream:
+            result.content
+        return result
+
+    def close(self):
+        pass
+
+
+def simulate_session(session, adapter):
+    """Send all the requests of session through the simulator adapter."""
+    for prefix in list(session.adapters):
+        session.mount(prefix, adapter)
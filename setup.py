@@ -25,7 +25,8 @@ setup(
     license='MIT',
     url='https://github.com/trezorg/apkdownloader.git',
     keywords='android, python, apk',
-    packages=find_packages(),
+    packages=find_packages(
+        exclude=['tests', 'tests.*', 'benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=read('requirements.txt').splitlines(),
     test_suite='nose.collector',
@@ -0,0 +1,49 @@
+"""
+Tests of the benchmark harness.
+"""
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import apkdownloader.apk
+from benchmarks.bench import run_client
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stats = os.path.join(self.directory, "stats.json")
+        self.main = apkdownloader.apk.main
+        self.argv = sys.argv
+
+    def tearDown(self):
+        apkdownloader.apk.main = self.main
+        sys.argv = self.argv
+        shutil.rmtree(self.directory)
+
+    def test_stats_of_a_failed_run(self):
+        def main():
+            sys.exit(1)
+
+        apkdownloader.apk.main = main
+        with self.assertRaises(SystemExit) as context:
+            run_client(self.stats, [])
+        self.assertEqual(context.exception.code, 1)
+        with open(self.stats) as f:
+            stats = json.load(f)
+        self.assertEqual(stats["exit_code"], 1)
+        self.assertIn("client_time", stats)
+
+    def test_stats_of_a_run(self):
+        apkdownloader.apk.main = lambda: None
+        run_client(self.stats, [])
+        with open(self.stats) as f:
+            self.assertEqual(json.load(f)["exit_code"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+Tests of the record and replay of the API traffic.
+"""
+from __future__ import absolute_import
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from apkdownloader.cassette import (
+    ANONYMOUS_HOST,
+    RecordingAdapter,
+    ReplayAdapter,
+    read_cassette,
+)
+from benchmarks.fakeplay import FakePlay, start_fakeplay
+from apkdownloader.googleplay import GooglePlayAPI
+
+PACKAGES = 5
+APK_SIZE = 40000
+
+
+def run_client(api, names):
+    """Return the answers of a short update run."""
+    answers = [api.bulkDetailsInfo(names)]
+    answers.append(api.details(names[0]).docV2.docid)
+    for info in answers[0][:2]:
+        delivery = api.acquire(info.name, info.code, info.offer)
+        response = api.fetch(delivery, stream=True)
+        answers.append((response.status_code, len(response.content)))
+    return answers
+
+
+class RecordReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cassette = os.path.join(self.directory, "run.cassette.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_api(self, server, **kwargs):
+        return GooglePlayAPI(
+            androidId="0123456789abcdef", email="test@example.com",
+            password="secret", url_login=server.url_login,
+            url_api=server.url_api, **kwargs)
+
+    def test_replay(self):
+        fake = FakePlay(packages=PACKAGES, apk_size=APK_SIZE)
+        names = list(fake.apps)
+        server = start_fakeplay(fake)
+        try:
+            api = self.create_api(server, record=self.cassette)
+            recorded = run_client(api, names)
+            api.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        api = self.create_api(server, replay=self.cassette)
+        try:
+            replayed = run_client(api, names)
+        finally:
+            api.close()
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(recorded[2:], [(200, APK_SIZE)] * 2)
+        with gzip.open(self.cassette, "rb") as f:
+            data = f.read()
+        contents = b"".join(
+            record["content"] or b"" for record in read_cassette(
+                self.cassette))
+        for text in (data, contents):
+            # auth tokens and delivery cookies
+            self.assertNotIn(b"fakeplay-token", text)
+            self.assertNotIn(b"secret", text)
+            # download URLs
+            self.assertNotIn(b"/blob/", text)
+        self.assertIn(b"Auth=anonymized", contents)
+
+
+class RedirectAdapter(BaseAdapter):
+    """Answers a download URL with a redirect to a signed CDN URL."""
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        if request.url.startswith("https://play.example.com/"):
+            response.status_code = 302
+            response.headers["Location"] = \
+                "https://cdn.example.com/apk?token=secret"
+            response.raw = io.BytesIO(b"")
+        else:
+            response.status_code = 200
+            response.headers["Content-Length"] = "4"
+            response.raw = io.BytesIO(b"data")
+        return response
+
+    def close(self):
+        pass
+
+
+class RedirectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cassette = os.path.join(self.directory, "run.cassette.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_redirect_target_is_anonymized(self):
+        session = requests.Session()
+        recorder = RecordingAdapter(
+            RedirectAdapter(), self.cassette,
+            hosts=set(["android.clients.google.com"]))
+        session.mount("https://", recorder)
+        url = "https://play.example.com/download?id=app"
+        response = session.get(url, stream=True)
+        self.assertEqual(response.content, b"data")
+        session.close()
+        with gzip.open(self.cassette, "rb") as f:
+            data = f.read()
+        self.assertNotIn(b"secret", data)
+        self.assertNotIn(b"example.com", data)
+        session = requests.Session()
+        session.mount("https://", ReplayAdapter(self.cassette))
+        # a replayed client gets the anonymized URL from delivery data
+        url = "{0}/{1}".format(
+            ANONYMOUS_HOST, os.path.basename(
+                list(read_cassette(self.cassette))[0]["path"]))
+        response = session.get(url, stream=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.content), 4)
+
+
+class LoginAdapter(BaseAdapter):
+    """Refuses the first login, accepts the next ones."""
+
+    def __init__(self):
+        super(LoginAdapter, self).__init__()
+        self.logins = 0
+
+    def send(self, request, **kwargs):
+        self.logins += 1
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        if self.logins == 1:
+            response.status_code = 403
+            response.raw = io.BytesIO(b"Error=BadAuthentication\n")
+        else:
+            response.status_code = 200
+            response.raw = io.BytesIO(b"SID=sid\nAuth=token\n")
+        return response
+
+    def close(self):
+        pass
+
+
+class ReplayLoginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cassette = os.path.join(self.directory, "run.cassette.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def login(self, adapter, password):
+        session = requests.Session()
+        session.mount("https://", adapter)
+        response = session.post(
+            "https://android.clients.google.com/auth",
+            data={"Passwd": password})
+        return response.status_code, response.content
+
+    def test_logins_are_replayed_in_order(self):
+        recorder = RecordingAdapter(LoginAdapter(), self.cassette)
+        recorded = [self.login(recorder, "secret") for _ in range(2)]
+        recorder.close()
+        replayer = ReplayAdapter(self.cassette)
+        # the login bodies are not recorded, any one matches
+        replayed = [self.login(replayer, "other{0}".format(index))
+                    for index in range(2)]
+        self.assertEqual([status for status, _ in replayed], [403, 200])
+        self.assertEqual(replayed[0], recorded[0])
+        self.assertEqual(replayed[1][1], b"SID=anonymized\nAuth=anonymized\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,231 @@
+"""
+End to end tests of the client against a local FakePlay server.
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from apkdownloader.apk import acquire_package, fetch_package, update_packages
+from apkdownloader.circuit import CircuitOpenError
+from apkdownloader.db import (
+    create_db,
+    disconnect,
+    get_apks_records,
+    update_apk_info,
+    ApkInfo,
+)
+from benchmarks.fakeplay import FakePlay, blob_chunks, start_fakeplay
+from apkdownloader.googleplay import GooglePlayAPI, RequestError
+
+PACKAGES = 20
+APK_SIZE = 50000
+
+
+def create_api(server, **kwargs):
+    return GooglePlayAPI(
+        androidId="0123456789abcdef", email="test@example.com",
+        password="test", url_login=server.url_login,
+        url_api=server.url_api, **kwargs)
+
+
+class FakePlayTestCase(unittest.TestCase):
+
+    fake_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakePlay(
+            packages=PACKAGES, apk_size=APK_SIZE, **cls.fake_options)
+        cls.server = start_fakeplay(cls.fake)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.fake.reset_stats()
+        self.api = create_api(self.server)
+
+    def tearDown(self):
+        self.api.close()
+
+
+class BulkDetailsTest(FakePlayTestCase):
+
+    def test_catalog(self):
+        names = list(self.fake.apps) + ["com.fakeplay.missing"]
+        infos = self.api.bulkDetailsInfo(names)
+        self.assertEqual(len(infos), len(names))
+        self.assertIsNone(infos[-1])
+        for name, info in zip(names, infos[:-1]):
+            app = self.fake.apps[name]
+            self.assertEqual(info.name, name)
+            self.assertEqual(info.code, app.code)
+            self.assertEqual(info.size, app.size)
+
+    def test_released_version(self):
+        name = list(self.fake.apps)[0]
+        code = self.fake.apps[name].code
+        self.fake.release([name])
+        self.assertEqual(self.api.bulkDetailsInfo([name])[0].code, code + 1)
+
+    def test_single_login(self):
+        self.api.bulkDetailsInfo(list(self.fake.apps))
+        self.api.bulkDetailsInfo(list(self.fake.apps))
+        self.assertEqual(self.fake.requests["auth"], 1)
+
+
+class DownloadTest(FakePlayTestCase):
+
+    fake_options = {"owned_rate": 0.5, "seed": 1}
+
+    def expected_body(self, app):
+        return b"".join(blob_chunks(app.name, app.code, 0, app.size - 1))
+
+    def test_download(self):
+        for app in self.fake.apps.values():
+            response = self.api.download(app.name, app.code, app.offer)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, self.expected_body(app))
+
+    def test_owned_apps_are_not_purchased(self):
+        owned = [app for app in self.fake.apps.values()
+                 if app.name in self.fake.owned]
+        self.assertTrue(owned)
+        for app in owned:
+            self.api.acquire(app.name, app.code, app.offer)
+        self.assertEqual(self.fake.requests["delivery"], len(owned))
+        self.assertNotIn("purchase", self.fake.requests)
+
+    def test_download_host_is_warmed_up_once(self):
+        app = list(self.fake.apps.values())[0]
+        delivery = self.api.acquire(app.name, app.code, app.offer)
+        self.assertFalse(self.api.warmed_hosts)
+        self.api.warm_connections = 2
+        for thread in self.api._warm_up_host(delivery.downloadUrl):
+            thread.join()
+        self.assertEqual(self.api._warm_up_host(delivery.downloadUrl), [])
+        self.assertEqual(self.api.warmed_hosts, set(
+            [self.server.base_url + "/"]))
+        self.assertEqual(self.fake.requests["unknown"], 2)
+
+
+class ExpiredDeliveryTest(FakePlayTestCase):
+
+    def setUp(self):
+        super(ExpiredDeliveryTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, "apk.db")
+        create_db(self.db)
+        app = list(self.fake.apps.values())[0]
+        self.info = ApkInfo(
+            app.name, app.code, "{0}.0".format(app.code), app.offer, app.size)
+
+    def tearDown(self):
+        disconnect(self.db)
+        shutil.rmtree(self.directory)
+        super(ExpiredDeliveryTest, self).tearDown()
+
+    def test_expired_cookie_is_refused(self):
+        delivery = self.api.acquire(
+            self.info.name, self.info.code, self.info.offer)
+        self.fake.expire_deliveries()
+        self.assertEqual(self.api.fetch(delivery).status_code, 403)
+
+    def test_cached_delivery_is_acquired_again(self):
+        acquire_package(self.api, self.db, self.info)
+        delivery, cached = acquire_package(self.api, self.db, self.info)
+        self.assertTrue(cached)
+        self.fake.expire_deliveries()
+        stream = fetch_package(self.api, self.db, self.info, delivery, cached)
+        try:
+            self.assertEqual(stream.status_code, 200)
+            self.assertEqual(len(stream.content), self.info.size)
+        finally:
+            stream.close()
+        self.assertEqual(self.fake.requests["delivery"], 2)
+
+
+class UpdateTest(FakePlayTestCase):
+
+    def setUp(self):
+        super(UpdateTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, "apk.db")
+        create_db(self.db)
+        self.options = {
+            "db": self.db,
+            "directory": self.directory,
+            "workers": 3,
+            "dry_run": False,
+            "force": False,
+            "info": False,
+            "recreate": False,
+        }
+
+    def tearDown(self):
+        disconnect(self.db)
+        shutil.rmtree(self.directory)
+        super(UpdateTest, self).tearDown()
+
+    def test_parallel_update(self):
+        names = list(self.fake.apps)
+        for app in self.fake.apps.values():
+            update_apk_info(self.db, ApkInfo(
+                app.name, app.code, "{0}.0".format(app.code), app.offer,
+                app.size))
+        outdated = names[::3]
+        self.fake.release(outdated)
+        self.assertEqual(update_packages(self.api, self.options, names), [])
+        records = get_apks_records(self.db)
+        for name in outdated:
+            app = self.fake.apps[name]
+            self.assertEqual(records[name].code, app.code)
+            filename = os.path.join(
+                self.directory, "{0}.{1}.0.apk".format(name, app.code))
+            self.assertEqual(os.path.getsize(filename), app.size)
+        self.assertEqual(self.fake.requests["blob"], len(outdated))
+
+
+class ServerErrorTest(FakePlayTestCase):
+
+    fake_options = {"error_rate": 1.0}
+
+    def setUp(self):
+        super(ServerErrorTest, self).setUp()
+        self.api.close()
+        self.api = create_api(
+            self.server, auth_sub_token="fakeplay-token.0",
+            breaker_threshold=3)
+
+    def test_server_error_is_raised(self):
+        with self.assertRaises(RequestError):
+            self.api.details(list(self.fake.apps)[0])
+
+    def test_breaker_opens(self):
+        name = list(self.fake.apps)[0]
+        for _ in range(3):
+            with self.assertRaises(RequestError):
+                self.api.details(name)
+        requests = sum(self.fake.requests.values())
+        with self.assertRaises(CircuitOpenError):
+            self.api.details(name)
+        self.assertEqual(sum(self.fake.requests.values()), requests)
+
+
+class RateLimitTest(FakePlayTestCase):
+
+    fake_options = {"rate_limit": 2}
+
+    def test_throttled_request_is_raised(self):
+        name = list(self.fake.apps)[0]
+        with self.assertRaises(RequestError) as context:
+            for _ in range(10):
+                self.api.details(name)
+        self.assertIn("429", str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+"""
+Tests of the in process simulation of the update pipeline.
+"""
+from __future__ import absolute_import
+import unittest
+from benchmarks.bench import run_simulation
+
+PACKAGES = 200
+OUTDATED = 10
+APK_SIZE = 32 * 1024
+
+
+class SimulationTest(unittest.TestCase):
+
+    def test_update(self):
+        result = run_simulation(PACKAGES, OUTDATED, APK_SIZE, workers=2)
+        self.assertEqual(result["failures"], 0)
+        self.assertEqual(result["requests_by_endpoint"]["blob"], 20)
+        self.assertGreater(result["bytes"], 20 * APK_SIZE)
+        self.assertGreater(result["wall_time"], 0)
+
+    def test_resets_are_counted(self):
+        result = run_simulation(
+            PACKAGES, OUTDATED, APK_SIZE, workers=2, reset_rate=0.3, seed=1)
+        self.assertGreater(result["resets"], 0)
+        self.assertGreater(result["failures"], 0)
+        self.assertLessEqual(result["failures"], 20)
+
+    def test_rate_limit_is_counted(self):
+        result = run_simulation(
+            PACKAGES, OUTDATED, APK_SIZE, workers=2, rate_limit=5)
+        self.assertGreater(result["failures"], 0)
+        self.assertLessEqual(result["failures"], 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
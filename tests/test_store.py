@@ -0,0 +1,101 @@
+"""
+Tests of the content-addressed apk storage.
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from apkdownloader.db import (
+    create_db,
+    disconnect,
+    delete_apks_records,
+    get_unreferenced_blobs,
+    update_apk_file,
+)
+from apkdownloader.store import BlobStore
+
+
+class BlobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, "apk.db")
+        create_db(self.db)
+        self.store = BlobStore(self.directory, self.db)
+
+    def tearDown(self):
+        disconnect(self.db)
+        shutil.rmtree(self.directory)
+
+    def add_apk(self, name, data):
+        digest, size = self.store.write([data])
+        filename = os.path.join(self.directory, "{0}.1.0.apk".format(name))
+        self.store.link(digest, filename)
+        update_apk_file(
+            self.db, name, os.path.basename(filename), size, digest)
+        return digest, filename
+
+
+class SharedBlobTest(BlobStoreTestCase):
+
+    def test_collected_after_every_name_is_deleted(self):
+        digest, first = self.add_apk("com.example.one", b"same data")
+        _, second = self.add_apk("com.example.two", b"same data")
+        os.remove(first)
+        os.remove(second)
+        delete_apks_records(self.db, ("com.example.one", "com.example.two"))
+        self.assertEqual(get_unreferenced_blobs(self.db), [digest])
+        self.assertEqual(self.store.collect(), 1)
+        self.assertFalse(os.path.exists(self.store.blob_path(digest)))
+
+    def test_kept_while_a_name_references_it(self):
+        digest, first = self.add_apk("com.example.one", b"same data")
+        self.add_apk("com.example.two", b"same data")
+        os.remove(first)
+        delete_apks_records(self.db, ("com.example.one",))
+        self.assertEqual(get_unreferenced_blobs(self.db), [])
+        self.assertEqual(self.store.collect(), 0)
+        self.assertTrue(os.path.exists(self.store.blob_path(digest)))
+
+
+class SymlinkTest(BlobStoreTestCase):
+
+    def setUp(self):
+        super(SymlinkTest, self).setUp()
+        self.link = os.link
+
+        def refuse(source, destination):
+            raise OSError("hard links are not supported")
+
+        # a filesystem without hard links
+        os.link = refuse
+
+    def tearDown(self):
+        os.link = self.link
+        super(SymlinkTest, self).tearDown()
+
+    def test_link_falls_back_to_symlink(self):
+        digest, filename = self.add_apk("com.example.one", b"data")
+        self.assertTrue(os.path.islink(filename))
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_linked_blob_survives_recreate(self):
+        digest, filename = self.add_apk("com.example.one", b"data")
+        disconnect(self.db)
+        create_db(self.db, force=True)
+        self.assertEqual(self.store.collect(unknown=True), 0)
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+
+    def test_unlinked_blob_is_collected(self):
+        digest, filename = self.add_apk("com.example.one", b"data")
+        os.remove(filename)
+        delete_apks_records(self.db, ("com.example.one",))
+        self.assertEqual(self.store.collect(), 1)
+        self.assertFalse(os.path.exists(self.store.blob_path(digest)))
+
+
+if __name__ == "__main__":
+    unittest.main()
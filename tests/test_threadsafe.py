@@ -0,0 +1,66 @@
+"""
+Tests of one GooglePlayAPI shared by threads.
+"""
+from __future__ import absolute_import
+import unittest
+from benchmarks.bench import run_stress
+from benchmarks.fakeplay import FakePlay, start_fakeplay
+from apkdownloader.googleplay import GooglePlayAPI, PrefetchCache, RequestError
+
+
+class StressTest(unittest.TestCase):
+
+    def test_shared_api(self):
+        result = run_stress(8, calls=20)
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(result["calls"], 160)
+        self.assertLessEqual(result["logins"], result["expirations"] + 1)
+
+
+class PrefetchCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = PrefetchCache(size=2)
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.put("c", b"3")
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.get("b"), b"2")
+        # put again, b becomes the latest one
+        cache.put("b", b"4")
+        cache.put("d", b"5")
+        self.assertNotIn("c", cache)
+        self.assertEqual(cache.get("b"), b"4")
+        self.assertEqual(cache.get("d"), b"5")
+        self.assertIsNone(cache.get("a"))
+
+
+class RefreshTokenTest(unittest.TestCase):
+
+    def test_no_password(self):
+        api = GooglePlayAPI(
+            androidId="0123456789abcdef", auth_sub_token="stale")
+        self.assertFalse(api.refresh_token("stale"))
+        self.assertEqual(api.get_token(), "stale")
+
+    def test_refused_token_without_password(self):
+        fake = FakePlay(packages=1)
+        server = start_fakeplay(fake)
+        api = GooglePlayAPI(
+            androidId="0123456789abcdef", auth_sub_token="fakeplay-token.0",
+            url_login=server.url_login, url_api=server.url_api)
+        try:
+            fake.expire_tokens()
+            with self.assertRaises(RequestError):
+                api.details(list(fake.apps)[0])
+            self.assertEqual(fake.requests["details"], 1)
+            self.assertNotIn("auth", fake.requests)
+        finally:
+            api.close()
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()